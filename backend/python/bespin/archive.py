@@ -0,0 +1,230 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+
+"""Streaming writers for tar.gz and zip archives.
+
+The tarfile and zipfile modules want a file to write the whole archive
+into (zipfile even seeks back to fill in each member's header). These
+generators produce the archive bytes as they go instead, reading each
+member in CHUNK_SIZE pieces, so that an archive can be sent as it is
+made without holding it in memory or on disk. Members are given as
+(name, location) pairs, where location is the file on disk to read
+(or None, for a directory entry in a tarball)."""
+import os
+import time
+import zlib
+import struct
+import tarfile
+import zipfile
+
+CHUNK_SIZE = 65536
+
+# we don't know the original permissions.
+# files are read for all, write only by user. directories are also
+# executable for all.
+FILE_MODE = 420
+DIR_MODE = 493
+
+# members at least this big get zip64 headers (this is the limit
+# used by the zipfile module)
+ZIP64_LIMIT = (1 << 31) - 1
+
+def _compressor():
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                            -zlib.MAX_WBITS)
+
+def _read_chunks(location, size):
+    """Yields exactly size bytes from the file at location. If the
+    file shrinks while it is being read, the rest is filled with NULs,
+    so that the sizes already written into the archive stay true."""
+    f = open(location, "rb")
+    try:
+        remaining = size
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                yield "\0" * remaining
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+class _GzipStream(object):
+    """Compresses data into the gzip format, one piece at a time."""
+
+    def __init__(self, mtime):
+        self.mtime = mtime
+        self.compressor = _compressor()
+        self.crc = zlib.crc32("")
+        self.size = 0
+
+    def header(self):
+        return "\037\213\010\000" + struct.pack("<L", long(self.mtime)) \
+                + "\002\377"
+
+    def compress(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush() + struct.pack("<LL",
+                    self.crc & 0xffffffffL, self.size & 0xffffffffL)
+
+def tar_gz_stream(members, mtime=None):
+    """Generates a gzipped tarball of the members."""
+    if mtime is None:
+        mtime = time.time()
+    gz = _GzipStream(mtime)
+    yield gz.header()
+    offset = 0
+    for name, location in members:
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mtime = mtime
+        if location is None:
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = DIR_MODE
+            size = 0
+        else:
+            tarinfo.mode = FILE_MODE
+            size = tarinfo.size = os.path.getsize(location)
+        header = tarinfo.tobuf()
+        offset += len(header)
+        data = gz.compress(header)
+        if data:
+            yield data
+        if not size:
+            continue
+        for chunk in _read_chunks(location, size):
+            data = gz.compress(chunk)
+            if data:
+                yield data
+        padding = -size % tarfile.BLOCKSIZE
+        data = gz.compress("\0" * padding)
+        if data:
+            yield data
+        offset += size + padding
+
+    # two empty blocks end the archive, which is then padded out
+    # to a whole record, just like tarfile does
+    offset += tarfile.BLOCKSIZE * 2
+    padding = tarfile.BLOCKSIZE * 2 + (-offset % tarfile.RECORDSIZE)
+    yield gz.compress("\0" * padding) + gz.flush()
+
+def _dos_date_time(date_time):
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+    return dosdate, dostime
+
+def zip_stream(members, date_time=None):
+    """Generates a deflated zip file of the members. Each member's
+    CRC and sizes follow its data in a data descriptor, because they
+    are not known when the member's header goes out."""
+    if date_time is None:
+        date_time = time.gmtime()[:6]
+    dosdate, dostime = _dos_date_time(date_time)
+    # bit 3: sizes and CRC are in the data descriptor
+    flags = 0x08
+    entries = []
+    offset = 0
+
+    for name, location in members:
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        size = os.path.getsize(location)
+        zip64 = size >= ZIP64_LIMIT
+        if zip64:
+            version = 45
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            header_sizes = 0xffffffffL
+        else:
+            version = 20
+            extra = ""
+            header_sizes = 0
+        header = struct.pack("<4sHHHHHLLLHH", "PK\003\004", version, flags,
+                    zipfile.ZIP_DEFLATED, dostime, dosdate, 0, header_sizes,
+                    header_sizes, len(name), len(extra)) + name + extra
+        yield header
+
+        compressor = _compressor()
+        crc = zlib.crc32("")
+        compressed_size = 0
+        for chunk in _read_chunks(location, size):
+            crc = zlib.crc32(chunk, crc)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xffffffffL
+        if zip64:
+            descriptor = struct.pack("<4sLQQ", "PK\007\010", crc,
+                                     compressed_size, size)
+        else:
+            descriptor = struct.pack("<4sLLL", "PK\007\010", crc,
+                                     compressed_size, size)
+        yield data + descriptor
+
+        entries.append((name, version, crc, compressed_size, size, offset))
+        offset += len(header) + compressed_size + len(descriptor)
+
+    central_offset = offset
+    central = []
+    for name, version, crc, compressed_size, size, entry_offset in entries:
+        zip64_values = []
+        if size >= ZIP64_LIMIT:
+            zip64_values.extend([size, compressed_size])
+            size = compressed_size = 0xffffffffL
+        if entry_offset >= ZIP64_LIMIT:
+            zip64_values.append(entry_offset)
+            entry_offset = 0xffffffffL
+        if zip64_values:
+            version = 45
+            extra = struct.pack("<HH" + "Q" * len(zip64_values), 1,
+                                8 * len(zip64_values), *zip64_values)
+        else:
+            extra = ""
+        central.append(struct.pack("<4sBBBBHHHHLLLHHHHHLL", "PK\001\002",
+                    version, 3, version, 0, flags, zipfile.ZIP_DEFLATED,
+                    dostime, dosdate, crc, compressed_size, size, len(name),
+                    len(extra), 0, 0, 0, FILE_MODE << 16L, entry_offset)
+                    + name + extra)
+    central = "".join(central)
+    central_size = len(central)
+
+    count = len(entries)
+    if count >= 0xffff or central_offset >= ZIP64_LIMIT \
+            or central_size >= ZIP64_LIMIT:
+        zip64_end_offset = central_offset + central_size
+        central += struct.pack("<4sQHHLLQQQQ", "PK\006\006", 44, 45, 45,
+                    0, 0, count, count, central_size, central_offset)
+        central += struct.pack("<4sLQL", "PK\006\007", 0,
+                               zip64_end_offset, 1)
+        count = min(count, 0xffff)
+        central_size = min(central_size, 0xffffffffL)
+        central_offset = min(central_offset, 0xffffffffL)
+    yield central + struct.pack("<4sHHHHLLH", "PK\005\006", 0, 0, count,
+                                count, central_size, central_offset, 0)
@@ -0,0 +1,211 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+
+"""Benchmarks for the file storage code, run with "paver bench".
+They work on synthetic projects in a temporary directory and
+do not need a database."""
+import os
+import re
+import time
+import random
+import tempfile
+
+from path import path as path_obj
+
+from bespin import config, filesystem, textsearch
+
+WORDS = ["app", "util", "model", "view", "controller", "test", "index",
+    "style", "main", "config", "helper", "widget", "editor", "parser",
+    "server", "client", "theme", "buffer", "layout", "event"]
+
+EXTENSIONS = [".js", ".py", ".css", ".html", ".txt"]
+
+def _timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def _synthetic_paths(count, seed=0):
+    """Returns count relative file paths in a tree that is a few
+    directories deep, always the same for a given seed."""
+    rand = random.Random(seed)
+    paths = set()
+    while len(paths) < count:
+        depth = rand.randint(0, 4)
+        dirs = [rand.choice(WORDS[:8]) for i in range(depth)]
+        name = "%s_%s%s%s" % (rand.choice(WORDS), rand.choice(WORDS),
+                    rand.randint(0, 999), rand.choice(EXTENSIONS))
+        paths.add("/".join(dirs + [name]))
+    return sorted(paths)
+
+def _make_project(root, name="bench"):
+    location = root / name
+    location.makedirs()
+    return filesystem.Project(None, name, location)
+
+def _regexp_search(project, query, limit=20):
+    """The REGEXP scan of the search cache that the file search
+    used before the index, kept here as the baseline."""
+    def regexp(expr, item):
+        item = item.rsplit("/", 1)[-1]
+        return re.search(expr, item, re.UNICODE|re.I) is not None
+    conn = project.metadata.connection
+    conn.create_function("regexp", 2, regexp)
+    search_re = ".*".join([re.escape(char) for char in query])
+    rs = conn.execute(
+        "SELECT filename FROM search_cache WHERE filename REGEXP ?",
+        (search_re,))
+    matches = [filesystem._SearchMatch(query, item[0]) for item in rs]
+    return [str(match) for match in sorted(matches)[:limit]]
+
+def bench_search(count=100000):
+    """Filename search on a project with count files."""
+    root = path_obj(tempfile.mkdtemp())
+    try:
+        project = _make_project(root)
+        paths = _synthetic_paths(count)
+        elapsed, ignored = _timed(project.metadata.cache_replace, paths)
+        print "Indexed %s paths in %.2fs" % (count, elapsed)
+
+        for query in ["e", "mv", "edpar", "wdgt3", "thmbuf12", "zzz"]:
+            regexp_time, expected = _timed(_regexp_search, project, query)
+            index_time, result = _timed(project.search_files, query)
+            cached_time, ignored = _timed(project.search_files, query)
+            assert result == expected, "Results differ for %r" % query
+            print "%-10s regexp %7.1fms  index %7.1fms  cached %5.2fms" % (
+                query, regexp_time * 1000, index_time * 1000,
+                cached_time * 1000)
+    finally:
+        root.rmtree()
+
+def _write_tree(location, paths):
+    for relpath in paths:
+        f = location / relpath
+        d = f.dirname()
+        if not d.exists():
+            d.makedirs()
+        f.write_bytes(relpath)
+
+def _backdate(location):
+    """Makes the directory mtimes old enough for rescan to trust."""
+    old = time.time() - 3600
+    for d in [location] + list(location.walkdirs()):
+        os.utime(d, (old, old))
+
+def _walk_all(location):
+    """A full walk of the tree, as every rescan did before the snapshot."""
+    total = 0
+    for f in location.walkfiles():
+        total += f.size
+    return total
+
+def bench_rescan(count=50000):
+    """Project rescans of a tree with count files on disk."""
+    root = path_obj(tempfile.mkdtemp())
+    try:
+        project = _make_project(root)
+        paths = _synthetic_paths(count)
+        _write_tree(project.location, paths)
+        _backdate(project.location)
+
+        elapsed, ignored = _timed(_walk_all, project.location)
+        print "Full walk of %s files: %.2fs" % (count, elapsed)
+        elapsed, ignored = _timed(project.scan_files)
+        print "First scan (no snapshot): %.2fs" % elapsed
+        elapsed, ignored = _timed(project.scan_files)
+        print "Rescan, nothing changed: %.3fs" % elapsed
+
+        rand = random.Random(1)
+        for changes in [1, 10, 100]:
+            for relpath in rand.sample(paths, changes):
+                (project.location / (relpath + ".new")).write_bytes("x")
+            elapsed, ignored = _timed(project.scan_files)
+            print "Rescan, %s files added: %.3fs" % (changes, elapsed)
+    finally:
+        root.rmtree()
+
+def _write_text_tree(location, paths, lines=50, seed=0):
+    """Writes paths with lines of random words in each."""
+    rand = random.Random(seed)
+    for relpath in paths:
+        f = location / relpath
+        d = f.dirname()
+        if not d.exists():
+            d.makedirs()
+        f.write_bytes("\n".join(
+            " ".join(rand.choice(WORDS) + str(rand.randint(0, 999))
+                     for i in range(8))
+            for j in range(lines)))
+
+def bench_grep(count=10000):
+    """Content search of a project with count text files."""
+    root = path_obj(tempfile.mkdtemp())
+    old_index = config.c.text_index
+    old_workers = config.c.text_search_workers
+    try:
+        project = _make_project(root)
+        paths = _synthetic_paths(count)
+        _write_text_tree(project.location, paths)
+        project.scan_files()
+
+        def run(query):
+            return sorted(textsearch.search(project, query, limit=0))
+
+        config.c.text_index = False
+        queries = ["editor123", "zzz"]
+        expected = {}
+        for workers in [1, 4]:
+            config.c.text_search_workers = workers
+            for query in queries:
+                elapsed, expected[query] = _timed(run, query)
+                print "%-10s scan, %s workers %8.1fms (%s lines)" % (
+                    query, workers, elapsed * 1000, len(expected[query]))
+
+        config.c.text_index = True
+        index = textsearch.TrigramIndex(project)
+        filenames = [name.encode("utf-8")
+                     for name in project.metadata.get_file_list()]
+        elapsed, ignored = _timed(index.update, filenames)
+        print "Built the trigram index in %.2fs" % elapsed
+        for query in queries:
+            elapsed, result = _timed(run, query)
+            assert result == expected[query], "Results differ for %r" % query
+            print "%-10s indexed          %8.1fms" % (query, elapsed * 1000)
+    finally:
+        config.c.text_index = old_index
+        config.c.text_search_workers = old_workers
+        root.rmtree()
+
+benchmarks = dict(search=bench_search, rescan=bench_rescan, grep=bench_grep)
+
+def run(names=None):
+    """Runs the named benchmarks (a comma separated string),
+    or all of them."""
+    if names:
+        names = names.split(",")
+    else:
+        names = sorted(benchmarks.keys())
+    for name in names:
+        print "== %s: %s" % (name, benchmarks[name].__doc__)
+        benchmarks[name]()
@@ -0,0 +1,236 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Content-addressed storage for project files.
+
+When config.c.blob_store is on, file contents are stored once under
+config.c.fsroot/.blobs, named by their SHA-1, and project files are
+hard links to those blobs. Identical files (the template projects that
+every user gets, or the same library imported into many projects) then
+take up the disk space of one.
+
+A linked file must never be written in place, because every other
+project sharing the blob would see the change. Saving always links a
+new blob over the old name with a rename, which leaves the old inode
+alone (copy-on-write). Anything else that writes project files directly
+should call break_link first.
+
+A linked file has the blob's inode, and so its mtime and ctime as
+well, which are those of whichever save first stored the contents.
+The project metadata records when each linked file was saved (see
+ProjectMetadata.set_link_times), and that is what File.info reports.
+
+The link count of a blob is its reference count: a blob whose only
+link is the one in the store is no longer used by any project and is
+removed by collect_garbage (see the bespin_blob_gc command)."""
+import os
+import sys
+import time
+import errno
+import logging
+import tempfile
+from hashlib import sha1
+from uuid import uuid4
+
+from bespin import config
+
+log = logging.getLogger("bespin.blobstore")
+
+BLOB_DIR = ".blobs"
+
+# temporary files older than this (in seconds) are left over from
+# failed saves, and are removed by collect_garbage
+TEMP_FILE_AGE = 3600
+
+CHUNK_SIZE = 65536
+
+def _file_mode():
+    # the umask can only be read by setting it, which is done once,
+    # before there are other threads creating files
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+# the mode that mkstemp's 0600 is changed to, so that linked files
+# get the mode that a file created normally would
+FILE_MODE = _file_mode()
+
+def _store_location():
+    return os.path.join(config.c.fsroot, BLOB_DIR)
+
+def blob_location(digest):
+    """Returns the filename of the blob with the given hex digest."""
+    return os.path.join(_store_location(), digest[:2], digest[2:4], digest)
+
+def _temp_file():
+    tempdir = os.path.join(_store_location(), "tmp")
+    if not os.path.isdir(tempdir):
+        try:
+            os.makedirs(tempdir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    fd, name = tempfile.mkstemp(dir=tempdir)
+    os.chmod(name, FILE_MODE)
+    return os.fdopen(fd, "wb"), name
+
+def _add_blob(tempname, digest):
+    """Moves the file tempname into the store as digest, unless that
+    blob is already there. Returns the blob's filename."""
+    location = blob_location(digest)
+    if os.path.exists(location):
+        os.remove(tempname)
+        return location
+    blob_dir = os.path.dirname(location)
+    if not os.path.isdir(blob_dir):
+        try:
+            os.makedirs(blob_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    os.rename(tempname, location)
+    return location
+
+def store_bytes(contents):
+    """Puts contents (a str) into the store. Returns the blob's
+    filename."""
+    digest = sha1(contents).hexdigest()
+    location = blob_location(digest)
+    if os.path.exists(location):
+        return location
+    out, tempname = _temp_file()
+    try:
+        out.write(contents)
+    finally:
+        out.close()
+    return _add_blob(tempname, digest)
+
+def store_stream(fileobj, reopen=False):
+    """Puts the contents of fileobj into the store, reading it a chunk
+    at a time. Returns a tuple of the blob's filename and its size.
+    If reopen is True, the tuple also has the stored contents opened
+    for reading, which stay readable even if collect_garbage removes
+    the blob before it is linked anywhere. The caller closes it."""
+    hash = sha1()
+    size = 0
+    out, tempname = _temp_file()
+    stored = None
+    try:
+        try:
+            while True:
+                data = fileobj.read(CHUNK_SIZE)
+                if not data:
+                    break
+                hash.update(data)
+                size += len(data)
+                out.write(data)
+        finally:
+            out.close()
+        if reopen:
+            # opened before the file is in the store, where it can be
+            # collected
+            stored = open(tempname, "rb")
+        location = _add_blob(tempname, hash.hexdigest())
+    except:
+        if stored is not None:
+            stored.close()
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+    if reopen:
+        return location, size, stored
+    return location, size
+
+def link_into(blob, destination):
+    """Makes destination a link to the blob, replacing whatever file
+    was there without modifying it. Returns False if the link cannot
+    be made (for instance, because the filesystem does not support
+    hard links), in which case destination is untouched."""
+    templink = "%s.%s.bespinlink" % (destination, uuid4().hex)
+    try:
+        os.link(blob, templink)
+    except OSError, e:
+        log.debug("Could not link %s to %s: %s", blob, destination, e)
+        return False
+    try:
+        os.rename(templink, destination)
+    except OSError:
+        os.remove(templink)
+        raise
+    return True
+
+def break_link(location):
+    """Removes location if it is a link to a blob, so that it can be
+    written to without changing the blob."""
+    try:
+        if os.stat(location).st_nlink > 1:
+            os.remove(location)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def collect_garbage():
+    """Removes the blobs that are no longer linked from any project,
+    along with leftover temporary files. Returns the number of blobs
+    removed."""
+    store = _store_location()
+    if not os.path.isdir(store):
+        return 0
+    removed = 0
+    too_old = time.time() - TEMP_FILE_AGE
+    for dirpath, dirnames, filenames in os.walk(store):
+        in_tempdir = os.path.basename(dirpath) == "tmp"
+        for name in filenames:
+            location = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(location)
+                if in_tempdir:
+                    if stat.st_mtime < too_old:
+                        os.remove(location)
+                elif stat.st_nlink == 1:
+                    os.remove(location)
+                    removed += 1
+            except OSError, e:
+                # a blob can be linked again or removed by another
+                # collection while we look at it
+                if e.errno != errno.ENOENT:
+                    raise
+    return removed
+
+def command(args=None):
+    """Runs collect_garbage. Takes the same profile and config file
+    arguments as bespin_worker."""
+    if args is None:
+        args = sys.argv[1:]
+
+    if args:
+        config.set_profile(args.pop(0))
+    else:
+        config.set_profile("dev")
+
+    if args:
+        config.load_pyconfig(args.pop(0))
+
+    config.activate_profile()
+    removed = collect_garbage()
+    log.info("Removed %s unused blobs", removed)
@@ -37,12 +37,21 @@ from path import path
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm.interfaces import SessionExtension
 
 from bespin import stats, auth
 
 class InvalidConfiguration(Exception):
     pass
 
+class SessionUse(SessionExtension):
+    """Sets bespin_used on a session once it begins a transaction on
+    a connection. bespin.controllers.db_middleware uses it to leave
+    alone the sessions that never touched the database, and clears
+    it again."""
+    def after_begin(self, session, transaction, connection):
+        session.bespin_used = True
+
 class Bunch(dict):
     def __getattr__(self, attr):
         try:
@@ -140,6 +149,32 @@ c.fslevels = 3
 
 c.max_import_file_size = 20000000
 
+# number of idle project metadata databases that are kept
+# open between requests (see bespin.filesystem.ProjectMetadata)
+c.metadata_pool_size = 50
+
+# deleted projects and directories are moved into the owner's
+# .trash directory, where they can be restored from for this many
+# seconds before a background job removes them for good
+c.trash_keep_seconds = 3600
+
+# store file contents once, in fsroot/.blobs, with hard links to
+# them from the projects (see bespin.blobstore). Unused blobs are
+# removed by running bespin_blob_gc.
+c.blob_store = False
+
+# number of threads that read files for a content search, and
+# whether to keep a trigram index of the file contents in the
+# project metadata to narrow down the files that are read
+# (see bespin.textsearch)
+c.text_search_workers = 4
+c.text_index = False
+
+# the trash purge sleeps for purge_pause seconds after removing
+# each purge_batch_size files, so that it does not hog the disk
+c.purge_batch_size = 500
+c.purge_pause = 0.05
+
 c.log_requests_to_stdout = False
 c.log_to_stdout = False
 
@@ -257,7 +292,9 @@ def activate_profile():
         engine_options['pool_recycle'] = 14400
         
     c.dbengine = create_engine(c.dburl, **engine_options)
-    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine))
+    from bespin import database
+    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine,
+        extension=[SessionUse(), database.CacheExtension()]))
     c.fsroot = path(c.fsroot)
 
     c.static_dir = path(c.static_dir)
@@ -306,6 +343,21 @@ def activate_profile():
     if c.lockout_period:
         c.lockout_period = int(c.lockout_period)
 
+    if isinstance(c.metadata_pool_size, basestring):
+        c.metadata_pool_size = int(c.metadata_pool_size)
+
+    if isinstance(c.trash_keep_seconds, basestring):
+        c.trash_keep_seconds = int(c.trash_keep_seconds)
+
+    if isinstance(c.purge_batch_size, basestring):
+        c.purge_batch_size = int(c.purge_batch_size)
+
+    if isinstance(c.purge_pause, basestring):
+        c.purge_pause = float(c.purge_pause)
+
+    if isinstance(c.text_search_workers, basestring):
+        c.text_search_workers = int(c.text_search_workers)
+
     if c.login_failure_tracking == "redis":
         if not redis_client:
             raise InvalidConfiguration("Login failure tracking is set to redis, but redis is not configured")
@@ -29,7 +29,7 @@ import logging
 from datetime import date
 import socket
 import urllib
-from hashlib import sha256
+from hashlib import sha1, sha256
 
 from urlrelay import URLRelay, register
 from paste.auth import auth_tkt
@@ -41,9 +41,9 @@ from bespin.config import c
 from bespin.framework import expose, BadRequest
 from bespin import vcs, deploy
 from bespin.database import User, get_project
-from bespin.filesystem import NotAuthorized, OverQuota, File
+from bespin.filesystem import NotAuthorized, OverQuota, File, Directory
 from bespin.utils import send_email_template
-from bespin import jsontemplate, filesystem, queue
+from bespin import jsontemplate, filesystem, queue, archive, textsearch
 
 log = logging.getLogger("bespin.controllers")
 
@@ -215,8 +215,11 @@ def delete_setting(request, response):
         response.status = "404 Not Found"
     return response()
 
-def _split_path(request):
-    path = request.kwargs['path']
+def _split_path(request, path=None):
+    """Splits path (by default, the one in the URL) into the owner,
+    the project name and the path within the project."""
+    if path is None:
+        path = request.kwargs['path']
     result = path.split('/', 1)
     if len(result) < 2:
         raise BadRequest("Project and path are both required.")
@@ -248,7 +251,10 @@ def putfile(request, response):
             raise BadRequest("Path ended in '/' indicating directory, but request contains ")
         project.create_directory(path)
     elif path:
-        project.save_file(path, request.body)
+        # like WebOb's body, a request without a Content-Length has
+        # no body, rather than one that lasts until the input ends
+        project.save_file_stream(path, request.environ['wsgi.input'],
+                                 request.content_length or 0)
     return response()
 
 @expose(r'^/file/at/(?P<path>.*)$', 'GET')
@@ -261,11 +267,43 @@ def getfile(request, response):
     mode = request.GET.get('mode', 'rw')
     revision = request.GET.get('revision', None)
 
+    if revision is None:
+        file_obj = project.get_file_object(path)
+        return _send_file(request, response, file_obj, "zombie/brains")
+
     contents = project.get_file(path, mode, revision=revision)
     response.body = contents
     response.content_type = "zombie/brains"
     return response()
 
+def _send_file(request, response, file_obj, content_type):
+    """Responds with the contents of file_obj, read from disk a chunk
+    at a time. Range requests get just the bytes asked for. Other
+    requests go through the server's wsgi.file_wrapper when it has
+    one, which can send the file without copying it through Python."""
+    etag = file_obj.content_hash
+    stream = file_obj.data_stream()
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and not request.range:
+        response.app_iter = file_wrapper(stream.fileobj,
+                                         archive.CHUNK_SIZE)
+    else:
+        response.app_iter = stream
+    response.content_length = stream.size
+    response.content_type = content_type
+    response.headers['Accept-Ranges'] = 'bytes'
+    _allow_revalidation(response, etag)
+    return response()
+
+def _allow_revalidation(response, etag):
+    """Gives the response a strong ETag, and lets clients keep it and
+    revalidate it with If-None-Match (which gets a 304 Not Modified
+    when the ETag still matches) in place of the usual no-store."""
+    response.etag = etag
+    response.conditional_response = True
+    response.headers['Cache-Control'] = "private, no-cache"
+    del response.headers['Pragma']
+
 @expose(r'^/history/at/(?P<path>.*)$', 'GET')
 def history_at(request, response):
     user = request.user
@@ -319,11 +357,23 @@ def listfiles(request, response):
         if project:
             project = get_project(user, owner, project)
 
-        files = project.list_files(path)
-
-        for item in files:
-            reply = { 'name':item.short_name }
-            _populate_stats(item, reply)
+        after = request.GET.get("after")
+        try:
+            limit = int(request.GET.get("limit"))
+        except (TypeError, ValueError):
+            limit = None
+        if limit is not None and limit <= 0:
+            limit = None
+
+        entries = project.list_directory(path, after, limit)
+
+        for entry in entries:
+            reply = { 'name':entry.short_name, 'size':entry.size }
+            if entry.is_directory:
+                reply['files'] = entry.files
+            else:
+                reply['created'] = entry.created.strftime("%Y%m%dT%H%M%S")
+                reply['modified'] = entry.modified.strftime("%Y%m%dT%H%M%S")
             result.append(reply)
 
     return _respond_json(response, result)
@@ -384,6 +434,24 @@ def file_list_all(request, response):
     
     return _respond_json(response, files)
 
+@expose(r'^/file/changes/(?P<project_name>.*)$', 'GET')
+def file_changes(request, response):
+    """Returns the changes to the project's files since the cursor
+    given as since, up to limit (default 1000) of them, as JSON:
+    {cursor, reset, changes: [[action, path], ...]}. A client starts
+    without since, lists the files and then polls with the cursor it
+    was given. When reset is true, it must list the files again."""
+    user = request.user
+    cursor = request.GET.get("since")
+    try:
+        limit = int(request.GET.get("limit", 1000))
+    except ValueError:
+        limit = 1000
+    project_name = request.kwargs['project_name']
+    project = get_project(user, user, project_name)
+    result = project.changes_since(cursor, limit)
+    return _respond_json(response, result)
+
 @expose(r'^/file/search/(?P<project_name>.*)$', 'GET')
 def file_search(request, response):
     user = request.user
@@ -400,11 +468,74 @@ def file_search(request, response):
     result = project.search_files(query, limit, include)
     return _respond_json(response, result)
 
+@expose(r'^/file/grep/(?P<project_name>.*)$', 'GET')
+def file_grep(request, response):
+    """Searches the contents of the project's files. q is the string
+    to look for, or a regular expression if regex=1. The search
+    ignores case unless case=1. The response is a JSON list of
+    [filename, line number, line] for the first limit (default 500)
+    matching lines, which is sent as the files are read."""
+    user = request.user
+    query = request.GET.get("q", "")
+    if not query:
+        raise BadRequest("Missing q=")
+    regex = request.GET.get("regex") == "1"
+    ignore_case = request.GET.get("case") != "1"
+    try:
+        limit = int(request.GET.get("limit", 500))
+    except ValueError:
+        limit = 500
+    project_name = request.kwargs['project_name']
+
+    project = get_project(user, user, project_name)
+    try:
+        matches = textsearch.search(project, query, regex, ignore_case,
+                                    limit)
+    except textsearch.SearchError, e:
+        raise BadRequest(str(e))
+
+    def results():
+        yield "["
+        first = True
+        for match in matches:
+            if first:
+                first = False
+            else:
+                yield ","
+            yield simplejson.dumps(match)
+        yield "]"
+
+    response.content_type = "application/json"
+    response.app_iter = results()
+    return response()
+
+@expose(r'^/file/symbols/(?P<project_name>.*)$', 'GET')
+def file_symbols(request, response):
+    """Looks up the functions, classes and variables defined in the
+    project whose names match q. The response is a JSON list of
+    {name, kind, file, line} for the best limit (default 20) matches."""
+    user = request.user
+    query = request.GET.get("q", "")
+    if isinstance(query, str):
+        query = query.decode("utf-8", "replace")
+    try:
+        limit = int(request.GET.get("limit", 20))
+    except ValueError:
+        limit = 20
+    project_name = request.kwargs['project_name']
+
+    project = get_project(user, user, project_name)
+    result = project.find_symbols(query, limit)
+    return _respond_json(response, result)
+
 def _populate_stats(item, result):
     if isinstance(item, File):
         result['size'] = item.saved_size
         result['created'] = item.created.strftime("%Y%m%dT%H%M%S")
         result['modified'] = item.modified.strftime("%Y%m%dT%H%M%S")
+    elif isinstance(item, Directory):
+        result['size'] = item.saved_size
+        result['files'] = item.file_count
     
 @expose(r'^/file/stats/(?P<path>.+)$', 'GET')
 def filestats(request, response):
@@ -416,7 +547,110 @@ def filestats(request, response):
     file_obj = project.get_file_object(path)
     result = {}
     _populate_stats(file_obj, result)
-    return _respond_json(response, result)
+    response.body = simplejson.dumps(result)
+    response.content_type = "application/json"
+    _allow_revalidation(response, sha1(response.body).hexdigest())
+    return response()
+
+@expose(r'^/file/batch/$', 'POST')
+def file_batch(request, response):
+    """Returns the contents and stats of a list of files in one response,
+    such as all of the files to reopen when the editor starts. The
+    request body is a JSON list of paths (as in /file/at/, with an
+    optional owner+ prefix), or of objects with a path and, optionally,
+    the hash of the contents the client already has. The response is a
+    JSON list with an object for each path, holding the path, its stats
+    and its contents (left out when the hash matches), or else an error
+    with the HTTP status it would have had on its own. Each project is
+    looked up once."""
+    user = request.user
+    try:
+        entries = simplejson.loads(request.body)
+    except ValueError:
+        raise BadRequest("Request body must be a JSON list of paths")
+    if not isinstance(entries, list):
+        raise BadRequest("Request body must be a JSON list of paths")
+
+    items = []
+    projects = {}
+    for entry in entries:
+        if isinstance(entry, dict):
+            path = entry.get("path")
+            known_hash = entry.get("hash")
+        else:
+            path = entry
+            known_hash = None
+        if not isinstance(path, basestring):
+            raise BadRequest("Each entry must have a path")
+        try:
+            owner, project_name, filename = _split_path(request, path)
+        except BadRequest, e:
+            items.append((path, e, None, None))
+            continue
+        key = path.split('/', 1)[0]
+        if key not in projects:
+            try:
+                if owner is None:
+                    raise filesystem.FileNotFound("Unknown user: %s"
+                                                  % key.partition('+')[0])
+                projects[key] = get_project(user, owner, project_name)
+            except Exception, e:
+                projects[key] = e
+        items.append((path, projects[key], filename, known_hash))
+
+    response.content_type = "application/json"
+    response.app_iter = _batch_results(items)
+    return response()
+
+_batch_errors = [
+    (filesystem.NotAuthorized, "401 Not Authorized"),
+    (filesystem.FileNotFound, "404 Not Found"),
+    (filesystem.FileConflict, "409 Conflict"),
+    (filesystem.FSException, "400 Bad Request"),
+    (filesystem.BadValue, "400 Bad Request"),
+    (BadRequest, "400 Bad Request"),
+]
+
+def _batch_error(path, e):
+    """Returns the entry for a path that failed with e. Unexpected
+    errors are logged and reported as a 500 for just that path, since
+    the response has already started."""
+    for exception_class, status in _batch_errors:
+        if isinstance(e, exception_class):
+            return dict(path=path, error=status, message=str(e))
+    log.error("Error in batch fetch of %s: %r", path, e)
+    return dict(path=path, error="500 Internal Server Error",
+                message="Internal error")
+
+def _batch_results(items):
+    """Generates the JSON list for file_batch, reading one file at a
+    time."""
+    yield "["
+    first = True
+    for path, project, filename, known_hash in items:
+        if isinstance(project, Exception):
+            result = _batch_error(path, project)
+        else:
+            try:
+                file_obj = project.get_file_object(filename)
+                result = dict(path=path)
+                _populate_stats(file_obj, result)
+                result['hash'] = file_obj.content_hash
+                if result['hash'] != known_hash:
+                    data = file_obj.data
+                    try:
+                        result['contents'] = data.decode("utf-8")
+                    except UnicodeDecodeError:
+                        result['contents'] = data.encode("base64")
+                        result['encoding'] = "base64"
+            except Exception, e:
+                result = _batch_error(path, e)
+        if first:
+            first = False
+        else:
+            yield ","
+        yield simplejson.dumps(result)
+    yield "]"
 
 # Edits may be changing with collab. Commented out for now
 # DELETE once we know these are done...
@@ -493,6 +727,37 @@ def _replace_block(html_lines, begin, end, new_content):
     html_lines.insert(start_marker, new_content)
     return html_lines
 
+# ((path, mtime, size, th_src, using_dojo_source), body, ETag) of
+# the last editor.html that was rendered
+_editor_page = None
+
+def _render_editor_page():
+    """Returns the body and ETag of editor.html as it is served with
+    the current configuration. The page is only rendered again when
+    the file or the configuration changes."""
+    global _editor_page
+    filename = "%s/editor.html" % (c.static_dir,)
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime, stat.st_size, c.th_src,
+           c.using_dojo_source)
+    cached = _editor_page
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+
+    body = open(filename).read()
+    if c.th_src:
+        bodylines = body.split("\n")
+        bodylines = _replace_block(bodylines, "<!-- begin Th -->", 
+                        "<!-- end Th -->", TH_SRC_BLOCK)
+        body = "\n".join(bodylines)
+        
+    if c.using_dojo_source:
+        body = body.replace("dojo.js.uncompressed.js", "dojo.js")
+
+    etag = sha1(body).hexdigest()
+    _editor_page = (key, body, etag)
+    return body, etag
+
 @expose(r'^/editor\.html', 'GET', auth=False, skip_token_check=True)
 def editor_page(request, response):
     """Ensure that the user is logged in. Redirect them to the front
@@ -505,18 +770,9 @@ def editor_page(request, response):
     else:
         response.status = "200 OK"
         response.content_type = "text/html"
-        body = open("%s/editor.html" % (c.static_dir, 
-                )).read()
-        if c.th_src:
-            bodylines = body.split("\n")
-            bodylines = _replace_block(bodylines, "<!-- begin Th -->", 
-                            "<!-- end Th -->", TH_SRC_BLOCK)
-            body = "\n".join(bodylines)
-            
-        if c.using_dojo_source:
-            body = body.replace("dojo.js.uncompressed.js", "dojo.js")
-            
+        body, etag = _render_editor_page()
         response.body = body
+        _allow_revalidation(response, etag)
     return response()
 
 @expose(r'^/project/import/(?P<project_name>[^/]+)', "POST")
@@ -588,20 +844,14 @@ def export_project(request, response):
     project = get_project(user, user, project_name)
     
     if extension == ".zip":
-        func = project.export_zipfile
+        func = project.export_zipfile_stream
         response.content_type = "application/zip"
     else:
         response.content_type = "application/x-tar-gz"
-        func = project.export_tarball
+        func = project.export_tarball_stream
     
-    output = func()
-    def filegen():
-        data = output.read(8192)
-        while data:
-            yield data
-            data = output.read(8192)
-        raise StopIteration
-    response.app_iter = filegen()
+    # the archive is generated as it is sent
+    response.app_iter = func()
     return response()
     
 @expose(r'^/preview/at/(?P<path>.+)$')
@@ -615,9 +865,7 @@ def preview_file(request, response):
     project = get_project(user, owner, project)
     
     file_obj = project.get_file_object(path)
-    response.body = str(file_obj.data)
-    response.content_type = file_obj.mimetype
-    return response()
+    return _send_file(request, response, file_obj, file_obj.mimetype)
     
 @expose(r'^/project/rename/(?P<project_name>.+)/$', 'POST')
 def rename_project(request, response):
@@ -630,6 +878,17 @@ def rename_project(request, response):
     response.content_type = "text/plain"
     return response()
 
+@expose(r'^/project/trash/$', 'GET')
+def list_trash(request, response):
+    return _respond_json(response, filesystem.list_trash(request.user))
+
+@expose(r'^/project/trash/restore/(?P<trash_id>[^/]+)$', 'POST')
+def restore_from_trash(request, response):
+    filesystem.restore_from_trash(request.user, request.kwargs['trash_id'])
+    response.body = ""
+    response.content_type = "text/plain"
+    return response()
+
 @expose(r'^/network/followers/', 'GET')
 def follow(request, response):
     return _users_followed_response(request.user, response)
@@ -704,8 +963,9 @@ def _respond_json(response, data):
     return response()
 
 def _lookup_usernames(usernames):
+    found = User.find_users(usernames)
     def lookup_username(username):
-        user = User.find_user(username)
+        user = found.get(username)
         if user == None:
             raise BadRequest("Username not found: %s" % username)
         return user
@@ -1113,12 +1373,28 @@ def run_deploy(request, response):
     return response()
 
 
+def _used_session():
+    """Returns the session of the current thread if it has touched
+    the database (or has changes to flush) since it was last
+    committed, or None. Sessions are only created when something asks
+    for one, so this is None for requests that never use the
+    database."""
+    registry = c.session_factory.registry
+    if not registry.has():
+        return None
+    session = registry()
+    # bespin_used is set by config.SessionUse
+    if session.new or session.dirty or session.deleted \
+            or getattr(session, 'bespin_used', False):
+        return session
+    return None
+
 def db_middleware(app):
+    """Commits (or, after an error, rolls back) the database work
+    done by the request. Requests that never use the database, like
+    those for static files, leave the session and the connection
+    pool alone. The exposed handlers set bespin.docommit."""
     def wrapped(environ, start_response):
-        from bespin import model
-        from sqlalchemy.orm import scoped_session
-        session = c.session_factory()
-        environ['bespin.docommit'] = True
         try:
             # If you need to work out what <script> tags to insert into a
             # page to get Dojo to behave properly, then uncomment these 3
@@ -1129,16 +1405,23 @@ def db_middleware(app):
             result = app(environ, start_response)
             if result == None:
                 log.error("WSGI response == None")
-            if environ['bespin.docommit']:
-                session.commit()
-            else:
-                session.rollback()
+            session = _used_session()
+            if session is not None:
+                if environ.get('bespin.docommit', True):
+                    session.commit()
+                else:
+                    session.rollback()
+                session.bespin_used = False
         except:
-            session.rollback()
+            session = _used_session()
+            if session is not None:
+                session.rollback()
+                session.bespin_used = False
             c.stats.incr("exceptions_DATE")
             log.exception("Error raised during request: %s", environ)
             raise
-        c.stats.disconnect()
+        if 'bespin.docommit' in environ:
+            c.stats.disconnect()
         return result
     return wrapped
 
@@ -1150,55 +1433,124 @@ def pathpopper_middleware(app, num_to_pop=1):
         return app(environ, start_response)
     return new_app
 
+# the most /getscript modules that are kept in memory
+SCRIPT_CACHE_SIZE = 1000
+
+# the headers that describe a wrapped module, and are cached with it.
+# The others (cookies, for one) belong to the request that got them.
+_SCRIPT_HEADERS = ('content-type', 'etag', 'cache-control', 'last-modified')
+
+# the compiled jsmodule.jsont
+_script_template = None
+
+# script path -> (ETag of the script, module headers, wrapped script)
+_script_cache = {}
+
+def _wrap_script(contents, script_name):
+    global _script_template
+    if _script_template is None:
+        _script_template = jsontemplate.FromFile(open(
+            os.path.dirname(os.path.abspath(__file__)) + "/jsmodule.jsont"))
+    return _script_template.expand(dict(script=contents,
+                                        script_name=script_name))
+
 def scriptwrapper_middleware(app):
+    """Wraps the scripts requested as /getscript/<path> into modules.
+    The wrapped scripts are kept in memory and reused for as long as
+    the ETag of the script (its modification time, for static files)
+    stays the same. Other requests are passed through untouched."""
     def new_app(environ, start_response):
+        if not environ.get('PATH_INFO', '').startswith("/getscript"):
+            return app(environ, start_response)
         req = Request(environ)
-        if req.path_info.startswith("/getscript"):
-            req.path_info_pop()
-            process_script = True
-        else:
-            process_script = False
+        req.path_info_pop()
+        script_name = "/getscript" + req.path_info
+        head = environ['REQUEST_METHOD'] == 'HEAD'
+        if head:
+            # the script itself is needed to know the module's length
+            environ['REQUEST_METHOD'] = 'GET'
+        client_etag = environ.pop('HTTP_IF_NONE_MATCH', None)
+        environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+        # the script is wrapped as text, so it must not come gzipped
+        environ.pop('HTTP_ACCEPT_ENCODING', None)
+
+        cached = _script_cache.get(req.path_info)
+        if cached is not None:
+            environ['HTTP_IF_NONE_MATCH'] = cached[0]
         result = req.get_response(app)
-        if process_script and result.status.startswith("200"):
-            contents = result.body
-            template = jsontemplate.FromFile(open(os.path.dirname(os.path.abspath(__file__)) + "/jsmodule.jsont"))
-            newbody = template.expand(dict(script=contents, 
-                                      script_name="/getscript" + req.path_info))
-            result.headers['Content-Length'] = str(len(newbody))
+        if cached is not None and result.status.startswith("304"):
+            etag, module_headers, newbody = cached
+        elif result.status.startswith("200"):
+            etag = result.headers.get('ETag')
+            newbody = _wrap_script(result.body, script_name)
+            if etag:
+                # the module is not the same entity as the script
+                result.headers['ETag'] = '"%s-module"' % \
+                    etag.replace('W/', '', 1).strip('"')
+            module_headers = [(name, value)
+                              for name, value in result.headers.items()
+                              if name.lower() in _SCRIPT_HEADERS]
+            if etag:
+                if len(_script_cache) >= SCRIPT_CACHE_SIZE:
+                    _script_cache.clear()
+                _script_cache[req.path_info] = (etag, module_headers,
+                                                newbody)
+        else:
             start_response(result.status, result.headers.items())
-            return [newbody]
-        start_response(result.status, result.headers.items())
-        return [result.body]
+            if head:
+                return [""]
+            return result.app_iter
+
+        headers = [(name, value) for name, value in result.headers.items()
+                   if name.lower() not in _SCRIPT_HEADERS
+                   and name.lower() != 'content-length']
+        headers.extend(module_headers)
+        module_etag = dict(module_headers).get('ETag')
+        if client_etag and module_etag and module_etag in \
+                [value.strip() for value in client_etag.split(",")]:
+            start_response("304 Not Modified",
+                [(name, value) for name, value in headers
+                 if name.lower() != 'content-type'])
+            return [""]
+        headers.append(('Content-Length', str(len(newbody))))
+        start_response("200 OK", headers)
+        if head:
+            return [""]
+        return [newbody]
     return new_app
 
 def make_app():
     from webob import Response
-    import static
-    static_app = static.Cling(c.static_dir)
+    from bespin.staticfiles import StaticFiles, static_middleware
+    static_app = StaticFiles(c.static_dir)
     if c.static_override:
         from paste.cascade import Cascade
-        static_app = Cascade([static.Cling(c.static_override), static_app])
+        static_app = Cascade([StaticFiles(c.static_override), static_app])
 
-    docs_app = pathpopper_middleware(static.Cling(c.docs_dir))
-    code_app = pathpopper_middleware(static.Cling(c.static_dir + "/js"), 2)
+    docs_app = pathpopper_middleware(StaticFiles(c.docs_dir))
+    code_app = pathpopper_middleware(StaticFiles(c.static_dir + "/js"), 2)
 
     register("^/docs/code/", code_app)
     register("^/docs/", docs_app)
+    static_apps = [static_app, docs_app, code_app]
     
     for location, directory in c.static_map.items():
         topop = 1 + location.count('/')
-        more_static = pathpopper_middleware(static.Cling(directory), topop)
+        more_static = pathpopper_middleware(StaticFiles(directory), topop)
         register("^/%s/" % location, more_static)
+        static_apps.append(more_static)
 
-    app = URLRelay(default=static_app)
-    app = auth_tkt.AuthTKTMiddleware(app, c.secret, secure=c.secure_cookie, 
+    relay = URLRelay(default=static_app)
+    app = auth_tkt.AuthTKTMiddleware(relay, c.secret, secure=c.secure_cookie, 
                 include_ip=False, httponly=c.http_only_cookie,
                 current_domain_cookie=True, wildcard_cookie=True)
     app = db_middleware(app)
-    
+    app = scriptwrapper_middleware(app)
+
+    # static files skip the authentication and the database
+    app = static_middleware(app, relay, static_apps)
+
     if c.log_requests_to_stdout:
         from paste.translogger import TransLogger
         app = TransLogger(app)
-        
-    app = scriptwrapper_middleware(app)
     return app
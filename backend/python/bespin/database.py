@@ -23,6 +23,8 @@
 
 """Data classes for working with files/projects/users."""
 from datetime import datetime
+import copy
+import time
 import logging
 from uuid import uuid4
 import simplejson
@@ -35,9 +37,13 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, PickleType, String, Integer,
                     Boolean, ForeignKey, Binary,
                     DateTime, Text)
-from sqlalchemy.orm import relation
+from sqlalchemy.orm import (relation, contains_eager, eagerload,
+                            class_mapper, MapperExtension, object_session)
+from sqlalchemy.orm.attributes import set_committed_value, instance_state
+from sqlalchemy.orm.interfaces import SessionExtension
 from sqlalchemy.exc import DBAPIError
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import UniqueConstraint, Index
+from sqlalchemy.sql import select, union, union_all, and_
 
 from bespin import config, filesystem
 from bespin.utils import _check_identifiers, BadValue
@@ -45,6 +51,185 @@ from bespin.filesystem import get_project, Project, LockError
 
 log = logging.getLogger("bespin.model")
 
+# the levels of access to a project returned by User.project_access
+NO_ACCESS = 0
+READ_ACCESS = 1
+WRITE_ACCESS = 2
+
+# seconds for which an access level is cached. Sharing changes made by
+# this process drop the cached levels they affect right away, but
+# changes made by other processes are only seen once levels expire.
+ACL_CACHE_SECONDS = 30
+
+# maximum number of access levels kept in memory
+ACL_CACHE_SIZE = 10000
+
+# (owner id, project name, user id) -> (expiry time, generation,
+# access level)
+_acl_cache = {}
+
+# bumped whenever a transaction that changed sharing ends. Only the
+# levels cached in the current generation are used, so that a level
+# looked up while the change was not yet committed does not outlive it.
+_acl_generation = 0
+
+# seconds for which the users looked up by username are cached. Like
+# access levels, users changed by this process are dropped right away.
+USER_CACHE_SECONDS = 60
+
+# maximum number of users kept in memory
+USER_CACHE_SIZE = 10000
+
+# username -> (expiry time, ((column name, value), ...))
+_user_cache = {}
+
+# columns that the queue workers also change, which are always read
+# from the database
+_UNCACHED_COLUMNS = ("amount_used",)
+
+def _refresh_visible_projects(owner_id, user_id=None):
+    """Recomputes the visible_projects rows for the owner's projects,
+    for the follower user_id or for all of the owner's followers: the
+    projects the owner shares with everyone, with the follower or with
+    one of the owner's groups that the follower is in."""
+    connections = Connection.__table__
+    everyone = EveryoneSharing.__table__
+    users = UserSharing.__table__
+    groups = GroupSharing.__table__
+    members = GroupMembership.__table__
+    visible = VisibleProject.__table__
+
+    def shares(table, *conditions):
+        conditions = [connections.c.followed_id == owner_id,
+                      table.c.owner_id == connections.c.followed_id] \
+                     + list(conditions)
+        if user_id is not None:
+            conditions.append(connections.c.following_id == user_id)
+        return select([connections.c.following_id, table.c.owner_id,
+                       table.c.project_name], and_(*conditions))
+
+    query = union(
+        shares(everyone),
+        shares(users, users.c.invited_user_id == connections.c.following_id),
+        shares(groups, groups.c.invited_group_id == members.c.group_id,
+               members.c.user_id == connections.c.following_id))
+    delete = visible.c.owner_id == owner_id
+    if user_id is not None:
+        delete = and_(delete, visible.c.user_id == user_id)
+
+    session = _get_session()
+    session.flush()
+    rows = [dict(user_id=row[0], owner_id=row[1], project_name=row[2])
+            for row in session.execute(query)]
+    session.execute(visible.delete(delete))
+    if rows:
+        session.execute(visible.insert(), rows)
+
+def _forget_access(owner_id, project_name=None, user_id=None):
+    """Drops the cached access levels for the owner's projects,
+    optionally only those for one project and/or one user. Every
+    cached level is dropped again when the session's transaction
+    ends (see CacheExtension)."""
+    _get_session().bespin_sharing_changed = True
+    if project_name is not None and user_id is not None:
+        _acl_cache.pop((owner_id, project_name, user_id), None)
+        return
+    # other threads add levels while we look
+    for key, value in list(_acl_cache.items()):
+        if key[0] == owner_id and project_name in (None, key[1]) \
+                and user_id in (None, key[2]):
+            _acl_cache.pop(key, None)
+
+def _forget_user(username):
+    """Drops the cached copy of the user."""
+    _user_cache.pop(username, None)
+
+def _forget_all(*args):
+    """Drops all of the cached users and access levels. This is a DDL
+    listener on the users table, which is only created or dropped with
+    all of its rows."""
+    _user_cache.clear()
+    _acl_cache.clear()
+
+def _remember_user(user, now):
+    session = object_session(user)
+    if session is not None and (user in session.dirty or user.username
+            in getattr(session, 'bespin_changed_users', ())):
+        # the changes may yet be rolled back
+        return
+    if len(_user_cache) >= USER_CACHE_SIZE:
+        _user_cache.clear()
+    snapshot = tuple((column.key, copy.deepcopy(getattr(user, column.key)))
+                     for column in User.__table__.columns
+                     if column.key not in _UNCACHED_COLUMNS)
+    _user_cache[user.username] = (now + USER_CACHE_SECONDS, snapshot)
+
+def _cached_user(username, now):
+    """Returns the cached user attached to the current session, or
+    None if the user is not cached."""
+    cached = _user_cache.get(username)
+    if cached is None or cached[0] <= now:
+        return None
+    values = dict(cached[1])
+    mapper = class_mapper(User)
+    key = mapper.identity_key_from_primary_key([values['id']])
+    session = _get_session()
+    if key in session.identity_map:
+        return session.identity_map[key]
+    user = mapper.class_manager.new_instance()
+    for name, value in values.items():
+        # the snapshot is shared, the settings dictionary is not
+        set_committed_value(user, name, copy.deepcopy(value))
+    instance_state(user).key = key
+    # the uncached columns are left expired, to be loaded when used
+    return session.merge(user, dont_load=True)
+
+def _user_changed(user):
+    """Drops the cached copy of user, which has been saved or deleted,
+    and keeps it from being cached again until the transaction ends
+    (see CacheExtension)."""
+    _forget_user(user.username)
+    session = object_session(user)
+    if session is not None:
+        if not hasattr(session, 'bespin_changed_users'):
+            session.bespin_changed_users = set()
+        session.bespin_changed_users.add(user.username)
+
+class _UserCacheExtension(MapperExtension):
+    """Drops the cached copies of users that are saved or deleted."""
+    def after_update(self, mapper, connection, instance):
+        _user_changed(instance)
+        return MapperExtension.after_update(self, mapper, connection,
+                                            instance)
+
+    def after_delete(self, mapper, connection, instance):
+        _user_changed(instance)
+        return MapperExtension.after_delete(self, mapper, connection,
+                                            instance)
+
+class CacheExtension(SessionExtension):
+    """Makes the access levels cached during a transaction that
+    changed sharing stale once it is committed or rolled back, and
+    drops the users that it changed, which could have been cached by
+    other sessions meanwhile. config.activate_profile puts it on
+    every session."""
+    def after_commit(self, session):
+        self._end_transaction(session)
+
+    def after_rollback(self, session):
+        self._end_transaction(session)
+
+    def _end_transaction(self, session):
+        global _acl_generation
+        if getattr(session, 'bespin_sharing_changed', False):
+            session.bespin_sharing_changed = False
+            _acl_generation += 1
+        changed = getattr(session, 'bespin_changed_users', None)
+        if changed:
+            for username in changed:
+                _forget_user(username)
+            session.bespin_changed_users = set()
+
 class ConflictError(Exception):
     pass
 
@@ -68,6 +253,9 @@ class Connection(Base):
 
     followed_viewable = Column(Boolean, default=False)
 
+# the primary key covers lookups by followed_id
+Index("connections_following_id", Connection.__table__.c.following_id)
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -79,8 +267,12 @@ class Message(Base):
     def __str__(self):
         return "Message[id=%s, msg=%s]" % (self.id, self.message)
 
+Index("messages_user_id_when", Message.__table__.c.user_id,
+      Message.__table__.c.when)
+
 class User(Base):
     __tablename__ = "users"
+    __mapper_args__ = dict(extension=_UserCacheExtension())
 
     id = Column(Integer, primary_key=True)
     uuid = Column(String(36), unique=True)
@@ -140,14 +332,41 @@ class User(Base):
     def find_user(cls, username, password=None):
         """Looks up a user by username. If password is provided, the password
         will be verified. Returns None if the user is not
-        found or the password does not match."""
-        user = _get_session().query(cls).filter_by(username=username).first()
+        found or the password does not match. Users are cached for
+        USER_CACHE_SECONDS."""
+        now = time.time()
+        user = _cached_user(username, now)
+        if user is None:
+            user = _get_session().query(cls).filter_by(username=username).first()
+            if user is not None:
+                _remember_user(user, now)
         if user and password is not None:
             digest = User.generate_password(password)
             if str(user.password) != digest:
                 user = None
         return user
         
+    @classmethod
+    def find_users(cls, usernames):
+        """Looks up several users by username, with at most one query.
+        Returns a dictionary of username to user for the usernames
+        that were found."""
+        now = time.time()
+        result = {}
+        missing = []
+        for username in usernames:
+            user = _cached_user(username, now)
+            if user is None:
+                missing.append(username)
+            else:
+                result[username] = user
+        if missing:
+            for user in _get_session().query(cls) \
+                    .filter(cls.username.in_(missing)):
+                _remember_user(user, now)
+                result[user.username] = user
+        return result
+
     @classmethod
     def find_by_email(cls, email):
         """Looks up a user by email address."""
@@ -214,11 +433,17 @@ class User(Base):
                 if not name.basename().startswith(".")]
         result = sorted(result, key=lambda item: item.name)
         if include_shared:
-            for followee_connection in self.users_i_follow():
-                followee = followee_connection.followed
-                for project in followee.projects:
-                    if followee.is_project_shared(project, self):
-                        result.append(project)
+            visible = _get_session().query(VisibleProject) \
+                .join(VisibleProject.owner) \
+                .options(contains_eager(VisibleProject.owner)) \
+                .filter(VisibleProject.user_id==self.id) \
+                .order_by(User.username, VisibleProject.project_name)
+            for row in visible:
+                location = row.owner.get_location() / row.project_name
+                # shares outlive the projects they are for
+                if location.isdir():
+                    result.append(Project(row.owner, row.project_name,
+                                          location))
         return result
 
     @property
@@ -273,11 +498,13 @@ class User(Base):
 
     def users_i_follow(self):
         """Retrieve a list of the users that someone follows."""
-        return _get_session().query(Connection).filter_by(following=self).all()
+        return _get_session().query(Connection).filter_by(following=self) \
+            .options(eagerload('followed')).all()
 
     def users_following_me(self):
         """Retrieve a list of the users that someone is following"""
-        return _get_session().query(Connection).filter_by(followed=self).all()
+        return _get_session().query(Connection).filter_by(followed=self) \
+            .options(eagerload('following')).all()
 
     def follow(self, followed_user):
         """Add a follow connection between 2 users"""
@@ -292,6 +519,7 @@ class User(Base):
         except DBAPIError:
             _get_session().rollback()
             raise ConflictError("%s is already following %s" % (following_user_name, followed_user_name))
+        _refresh_visible_projects(followed_user.id, self.id)
 
     def unfollow(self, followed_user):
         """Remove a follow connection between 2 users"""
@@ -303,6 +531,7 @@ class User(Base):
             .delete()
         if rows == 0:
             raise ConflictError("%s is not following %s" % (following_user_name, followed_user_name))
+        _refresh_visible_projects(followed_user.id, self.id)
 
     def get_group(self, group_name, create_on_not_found=False, raise_on_not_found=False):
         """Check to see if the given member name represents a group"""
@@ -362,7 +591,8 @@ class User(Base):
     def _get_user_sharing(self, project=None, invited_user=None):
         """Retrieve a list of the user level shares made by a user, optionally
         filtered by project and by invited user"""
-        query = _get_session().query(UserSharing).filter_by(owner_id=self.id)
+        query = _get_session().query(UserSharing).filter_by(owner_id=self.id) \
+            .options(eagerload('invited'))
         if project != None:
             query = query.filter_by(project_name=project.name)
         if invited_user != None:
@@ -372,7 +602,8 @@ class User(Base):
     def _get_group_sharing(self, project=None, invited_group=None):
         """Retrieve a list of the group level shares made by a user, optionally
         filtered by project and by invited group"""
-        query = _get_session().query(GroupSharing).filter_by(owner_id=self.id)
+        query = _get_session().query(GroupSharing).filter_by(owner_id=self.id) \
+            .options(eagerload('invited'))
         if project != None:
             query = query.filter_by(project_name=project.name)
         if invited_group != None:
@@ -399,56 +630,73 @@ class User(Base):
         }
 
     def is_project_shared(self, project, user, require_write=False):
-        if self._is_project_everyone_shared(project, require_write):
-            return True
-        if self._is_project_user_shared(project, user, require_write):
-            return True
-        groups = self.get_groups(user)
-        for group in groups:
-            if self._is_project_group_shared(project, group, require_write):
-                return True
-        return False
-
-    def _is_project_user_shared(self, project, user, require_write=False):
-        if isinstance(project, Project):
-            project = project.name
-        query = _get_session().query(UserSharing)
-        query = query.filter_by(owner_id=self.id)
-        query = query.filter_by(project_name=project)
-        query = query.filter_by(invited_user_id=user.id)
+        level = self.project_access(project, user)
         if require_write:
-            query = query.filter_by(edit=True)
-        return query.first() != None
+            return level == WRITE_ACCESS
+        return level != NO_ACCESS
 
-    def _is_project_group_shared(self, project, group, require_write=False):
+    def project_access(self, project, user):
+        """Returns the access that user has to this user's project
+        through sharing: NO_ACCESS, READ_ACCESS or WRITE_ACCESS.
+        Levels are cached for ACL_CACHE_SECONDS."""
         if isinstance(project, Project):
             project = project.name
-        query = _get_session().query(GroupSharing)
-        query = query.filter_by(owner_id=self.id)
-        query = query.filter_by(project_name=project)
-        query = query.filter_by(invited_group_id=group.id)
-        if require_write:
-            query = query.filter_by(edit=True)
-        return query.first() != None
-
-    def _is_project_everyone_shared(self, project, require_write=False):
-        if isinstance(project, Project):
-            project = project.name
-        query = _get_session().query(EveryoneSharing)
-        query = query.filter_by(owner_id=self.id)
-        query = query.filter_by(project_name=project)
-        if require_write:
-            query = query.filter_by(edit=True)
-        return query.first() != None
+        key = (self.id, project, user.id)
+        now = time.time()
+        # read before the query, so that a level read before a change
+        # is committed is cached in the generation that the commit ends
+        generation = _acl_generation
+        cached = _acl_cache.get(key)
+        if cached is not None and cached[0] > now \
+                and cached[1] == generation:
+            return cached[2]
+
+        level = self._query_project_access(project, user)
+        if len(_acl_cache) >= ACL_CACHE_SIZE:
+            _acl_cache.clear()
+        _acl_cache[key] = (now + ACL_CACHE_SECONDS, generation, level)
+        return level
+
+    def _query_project_access(self, project_name, user):
+        """Looks up the everyone, user and group shares of the
+        project that apply to user in a single query."""
+        everyone = EveryoneSharing.__table__
+        users = UserSharing.__table__
+        groups = GroupSharing.__table__
+        members = GroupMembership.__table__
+        query = union_all(
+            select([everyone.c.edit], and_(
+                everyone.c.owner_id == self.id,
+                everyone.c.project_name == project_name)),
+            select([users.c.edit], and_(
+                users.c.owner_id == self.id,
+                users.c.project_name == project_name,
+                users.c.invited_user_id == user.id)),
+            select([groups.c.edit], and_(
+                groups.c.owner_id == self.id,
+                groups.c.project_name == project_name,
+                groups.c.invited_group_id == members.c.group_id,
+                members.c.user_id == user.id)))
+        session = _get_session()
+        # shares added in this session have to be in the database
+        session.flush()
+        level = NO_ACCESS
+        for row in session.execute(query):
+            if row[0]:
+                return WRITE_ACCESS
+            level = READ_ACCESS
+        return level
 
     def add_sharing(self, project, member, edit=False, loadany=False):
         if member == 'everyone':
-            return self._add_everyone_sharing(project, edit, loadany)
+            sharing = self._add_everyone_sharing(project, edit, loadany)
         else:
             if isinstance(member, Group):
-                return self._add_group_sharing(project, member, edit, loadany)
+                sharing = self._add_group_sharing(project, member, edit, loadany)
             else:
-                return self._add_user_sharing(project, member, edit, loadany)
+                sharing = self._add_user_sharing(project, member, edit, loadany)
+        self._sharing_changed(project, member)
+        return sharing
 
     def _add_user_sharing(self, project, invited_user, edit=False, loadany=False):
         sharing = UserSharing(self, project.name, invited_user, edit, loadany)
@@ -471,15 +719,29 @@ class User(Base):
             rows += self._remove_user_sharing(project)
             rows += self._remove_group_sharing(project)
             rows += self._remove_everyone_sharing(project)
-            return rows
         else:
             if member == 'everyone':
-                return self._remove_everyone_sharing(project)
+                rows = self._remove_everyone_sharing(project)
             else:
                 if isinstance(member, Group):
-                    return self._remove_group_sharing(project, member)
+                    rows = self._remove_group_sharing(project, member)
                 else:
-                    return self._remove_user_sharing(project, member)
+                    rows = self._remove_user_sharing(project, member)
+        self._sharing_changed(project, member)
+        return rows
+
+    def _sharing_changed(self, project, member):
+        """Updates the cached access levels and the visible projects
+        that a change to the sharing of project (None for all
+        projects) with member (None for every member) could affect."""
+        if project is not None:
+            project = project.name
+        if isinstance(member, User):
+            _forget_access(self.id, project, member.id)
+            _refresh_visible_projects(self.id, member.id)
+        else:
+            _forget_access(self.id, project)
+            _refresh_visible_projects(self.id)
 
     def _remove_user_sharing(self, project, invited_user=None):
         user_query = _get_session().query(UserSharing).filter_by(owner_id=self.id)
@@ -522,6 +784,9 @@ class User(Base):
             _get_session().delete(message)
         return messages
 
+User.__table__.append_ddl_listener('after-create', _forget_all)
+User.__table__.append_ddl_listener('after-drop', _forget_all)
+
 class Group(Base):
     __tablename__ = "groups"
 
@@ -542,14 +807,23 @@ class Group(Base):
 
     def remove(self):
         """Remove a group (and all its members) from the owning users profile"""
-        return _get_session().query(Group). \
+        session = _get_session()
+        # not every database cascades the deletes
+        session.query(GroupMembership).filter_by(group_id=self.id).delete()
+        session.query(GroupSharing) \
+            .filter_by(invited_group_id=self.id).delete()
+        rows = session.query(Group). \
             filter_by(id=self.id). \
             delete()
+        _forget_access(self.owner_id)
+        _refresh_visible_projects(self.owner_id)
+        return rows
 
     def get_members(self):
         """Retrieve a list of the members of a given users group"""
         return _get_session().query(GroupMembership) \
             .filter_by(group_id=self.id) \
+            .options(eagerload('user')) \
             .all()
 
     def add_member(self, other_user):
@@ -558,20 +832,28 @@ class Group(Base):
             raise ConflictError("You can't be a member of your own group")
         membership = GroupMembership(self, other_user)
         _get_session().add(membership)
+        _forget_access(self.owner_id, user_id=other_user.id)
+        _refresh_visible_projects(self.owner_id, other_user.id)
         return membership
 
     def remove_member(self, other_user):
         """Remove a member from a given users group."""
-        return _get_session().query(GroupMembership) \
+        rows = _get_session().query(GroupMembership) \
             .filter_by(group_id=self.id) \
             .filter_by(user_id=other_user.id) \
             .delete()
+        _forget_access(self.owner_id, user_id=other_user.id)
+        _refresh_visible_projects(self.owner_id, other_user.id)
+        return rows
 
     def remove_all_members(self):
         """Remove all the members of a given group"""
-        return _get_session().query(GroupMembership) \
+        rows = _get_session().query(GroupMembership) \
             .filter_by(group_id=self.id) \
             .delete()
+        _forget_access(self.owner_id)
+        _refresh_visible_projects(self.owner_id)
+        return rows
 
 class GroupMembership(Base):
     __tablename__ = "group_memberships"
@@ -590,6 +872,9 @@ class GroupMembership(Base):
     def __str__(self):
         return "GroupMembership[group_id=%s, user_id=%s]" % (self.group_id, self.user_id)
 
+# the primary key covers lookups by group_id
+Index("group_memberships_user_id", GroupMembership.__table__.c.user_id)
+
 class UserSharing(Base):
     __tablename__ = "user_sharing"
 
@@ -660,3 +945,22 @@ class EveryoneSharing(Base):
     @property
     def invited_name(self):
         return 'everyone'
+
+class VisibleProject(Base):
+    """A project of a user that someone follows, which is shared with
+    them. These rows are maintained by the follow, sharing and group
+    methods (see _refresh_visible_projects), so that listing the
+    projects shared with a user is a single query."""
+    __tablename__ = "visible_projects"
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    owner = relation(User, primaryjoin=User.id==owner_id)
+    project_name = Column(String(128), primary_key=True)
+
+    def __str__(self):
+        return "VisibleProject[user_id=%s, owner_id=%s, project=%s]" % (
+            self.user_id, self.owner_id, self.project_name)
+
+# the primary key covers lookups by user_id
+Index("visible_projects_owner_id", VisibleProject.__table__.c.owner_id)
@@ -0,0 +1,46 @@
+from sqlalchemy import *
+from migrate import *
+
+from sqlalchemy.ext.declarative import declarative_base
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+Base = declarative_base(metadata=metadata)
+
+class User(Base):
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True)
+
+class VisibleProject(Base):
+    __tablename__ = "visible_projects"
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    owner_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    project_name = Column(String(128), primary_key=True)
+
+# the same rows as bespin.database._refresh_visible_projects, for everyone
+fill_query = """
+insert into visible_projects (user_id, owner_id, project_name)
+select c.following_id, s.owner_id, s.project_name
+    from connections c join everyone_sharing s on s.owner_id = c.followed_id
+union
+select c.following_id, s.owner_id, s.project_name
+    from connections c join user_sharing s on s.owner_id = c.followed_id
+        and s.invited_user_id = c.following_id
+union
+select c.following_id, s.owner_id, s.project_name
+    from connections c join group_sharing s on s.owner_id = c.followed_id
+        join group_memberships m on m.group_id = s.invited_group_id
+            and m.user_id = c.following_id"""
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    VisibleProject.__table__.create(bind=migrate_engine)
+    conn = migrate_engine.connect()
+    conn.execute(fill_query)
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    VisibleProject.__table__.drop(bind=migrate_engine)
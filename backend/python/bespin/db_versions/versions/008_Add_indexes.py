@@ -0,0 +1,36 @@
+from sqlalchemy import *
+from migrate import *
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+
+# only the indexed columns are needed. The sharing tables need no new
+# indexes, because their unique constraints start with owner_id and
+# project_name.
+connections = Table("connections", metadata,
+    Column("following_id", Integer))
+messages = Table("messages", metadata,
+    Column("user_id", Integer),
+    Column("when", DateTime))
+group_memberships = Table("group_memberships", metadata,
+    Column("user_id", Integer))
+visible_projects = Table("visible_projects", metadata,
+    Column("owner_id", Integer))
+
+indexes = [
+    Index("connections_following_id", connections.c.following_id),
+    Index("messages_user_id_when", messages.c.user_id, messages.c.when),
+    Index("group_memberships_user_id", group_memberships.c.user_id),
+    Index("visible_projects_owner_id", visible_projects.c.owner_id),
+]
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    for index in indexes:
+        index.create()
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    for index in indexes:
+        index.drop()
@@ -25,10 +25,14 @@
 # TODO: Why do we have save in both File and in Project?
 
 """Data classes for working with files/projects/users."""
+from __future__ import with_statement
+
 import os
+import stat
 import time
 import tarfile
 import tempfile
+import shutil
 import mimetypes
 import zipfile
 from datetime import datetime
@@ -36,12 +40,18 @@ import logging
 import re
 import itertools
 import sqlite3
+import heapq
+import threading
+import bisect
+from hashlib import sha1
+from uuid import uuid4
 
 from path import path as path_obj
 from pathutils import LockError as PULockError, Lock, LockFile
 import simplejson
+from cStringIO import StringIO
 
-from bespin import config, jsontemplate
+from bespin import config, jsontemplate, archive, queue, blobstore, symbols
 from bespin.utils import _check_identifiers, BadValue
 from uvc.main import call_uvc, call_uvc_data
 
@@ -50,6 +60,44 @@ log = logging.getLogger("bespin.filesystem")
 # quotas are expressed in 1 megabyte increments
 QUOTA_UNITS = 1048576
 
+# files being uploaded are written next to their destination under
+# this prefix, and renamed into place once they are complete
+UPLOAD_PREFIX = ".bespin-upload-"
+
+# the queue for the trash purges, which are kept apart from the
+# version control jobs on the "vcs" queue (see bespin.queue)
+TRASH_QUEUE = "trash"
+
+# the mtime granularity allowed for: directories modified less than
+# this many seconds before a scan are listed again on the next scan
+# (see ProjectMetadata.rescan), and the hash of a file modified less
+# than this many seconds before it was hashed is not trusted (see
+# ProjectMetadata.get_hash)
+SCAN_MTIME_SLACK = 2
+
+# name of the directory in each user's area that holds deleted
+# projects and directories until they are purged
+TRASH_DIR = ".trash"
+
+# maximum number of file search results kept in memory
+SEARCH_CACHE_SIZE = 500
+
+# (metadata filename, epoch, generation, query, limit, include) -> results
+_search_results = {}
+
+# template directory -> (modification stamps, files), see _get_template
+_template_cache = {}
+
+# maximum number of directory listings kept in memory
+LISTING_CACHE_SIZE = 200
+
+# directory location -> (mtime, sorted names), see _sorted_names
+_listing_cache = {}
+
+# number of entries kept in each project's change log, past which
+# the oldest are dropped (see ProjectMetadata._compact_changes)
+CHANGE_LOG_SIZE = 1000
+
 class FSException(Exception):
     pass
 
@@ -101,14 +149,21 @@ def get_project(user, owner, project_name, create=False, clean=False):
     if location.exists():
         project = ProjectView(user, owner, project_name, location)
         if clean:
-            location.rmtree()
+            space_used = project.metadata.dir_totals()[0]
+            project.metadata.delete()
+            _move_to_trash(owner, location, project_name, "", space_used)
+            owner.amount_used -= space_used
             location.makedirs()
+            project.metadata.rescan()
     else:
         if not create:
             raise FileNotFound("Project %s not found" % project_name)
         log.debug("Creating new project %s", project_name)
         location.makedirs()
         project = ProjectView(user, owner, project_name, location)
+        # start the scan snapshot, so that the directory totals
+        # can be trusted without scanning the project first
+        project.metadata.rescan()
         config.c.stats.incr("projects")
     return project
 
@@ -168,9 +223,11 @@ class Directory(object):
         while name and name.startswith("/"):
             name = name[1:]
             
+        self.project = project
         self.name = name
         
         self.location = project.location / name
+        self._info = None
         
         # we can only properly check directory entries as being symlinks
         # if they don't have the trailing slash, which we ensured is there
@@ -188,6 +245,23 @@ class Directory(object):
     def listdir(self):
         return self.location.listdir()
 
+    @property
+    def info(self):
+        if self._info is None:
+            size, files = self.project.metadata.dir_totals(self.name)
+            self._info = dict(size=size, files=files)
+        return self._info
+
+    @property
+    def saved_size(self):
+        """The size of all of the files under this directory."""
+        return self.info['size']
+
+    @property
+    def file_count(self):
+        """The number of files under this directory."""
+        return self.info['files']
+
 class File(object):
     def __init__(self, project, name):
         if "../" in name:
@@ -219,14 +293,61 @@ class File(object):
         self._info = info
         stat = self.location.stat()
         info['size'] = stat.st_size
-        info['created_time'] = datetime.fromtimestamp(stat.st_ctime)
-        info['modified_time'] = datetime.fromtimestamp(stat.st_mtime)
+        created, modified = stat.st_ctime, stat.st_mtime
+        if stat.st_nlink > 1:
+            # a link to a blob shares the blob's times
+            saved = self.project.metadata.get_link_time(self.name,
+                                                        stat.st_ino)
+            if saved is not None:
+                created = modified = saved
+        info['created_time'] = datetime.fromtimestamp(created)
+        info['modified_time'] = datetime.fromtimestamp(modified)
         return info
 
     @property
     def data(self):
         return self.location.bytes()
 
+    def data_stream(self):
+        """Opens the file and returns a FileIter over its contents."""
+        return FileIter(open(self.location, "rb"))
+
+    @property
+    def content_hash(self):
+        """The SHA-1 hex digest of the file's contents. This comes from
+        the project metadata when the file has not changed since its
+        hash was recorded, and otherwise the file is read (and the
+        hash recorded)."""
+        stat = self.location.stat()
+        metadata = self.project.metadata
+        digest = metadata.get_hash(self.name, stat)
+        if digest is None:
+            digest = _hash_file(self.location)
+            metadata.set_hash(self.name, digest, stat)
+        return digest
+
+    @property
+    def recorded_hash(self):
+        """The hash recorded for the file in the metadata, or None if
+        the file does not exist, has no hash recorded or has changed
+        since. Unlike content_hash, this never reads the file."""
+        try:
+            stat = os.stat(self.location)
+        except OSError:
+            return None
+        return self.project.metadata.get_hash(self.name, stat)
+
+    def _record_hash(self, digest):
+        self.project.metadata.set_hash(self.name, digest,
+                                       os.stat(self.location))
+
+    def _record_link(self):
+        """Records the time of the save that has just made the file a
+        link to a blob (see blobstore)."""
+        stat = os.stat(self.location)
+        if stat.st_nlink > 1:
+            self.project.metadata.set_link_times([(self.name, stat.st_ino)])
+
     @property
     def mimetype(self):
         """Returns the mimetype of the file, or application/octet-stream
@@ -249,37 +370,191 @@ class File(object):
         return self.info['modified_time']
 
     def save(self, contents):
+        if config.c.blob_store:
+            if isinstance(contents, unicode):
+                contents = contents.encode("utf-8")
+            blob = blobstore.store_bytes(contents)
+            if blobstore.link_into(blob, self.location):
+                self._record_link()
+                return
+        blobstore.break_link(self.location)
         _save(self.location, contents)
 
     def __repr__(self):
         return "File: %s" % (self.name)
 
-def _get_file_list(directory):
-    total = 0
-    files = []
-    for f in directory.walkfiles():
-        if ".hg" in f or ".svn" in f or ".bzr" in f or ".git" in f:
+class FileIter(object):
+    """Iterates over the contents of fileobj from start up to stop (or
+    the end of the file), a chunk at a time, for use as a WSGI
+    app_iter. size is the size of the whole file when it was opened.
+    WebOb answers Range requests with app_iter_range, which reads only
+    the requested bytes."""
+
+    def __init__(self, fileobj, start=0, stop=None):
+        self.fileobj = fileobj
+        self.size = os.fstat(fileobj.fileno()).st_size
+        self.start = start
+        if stop is None or stop > self.size:
+            stop = self.size
+        self.stop = stop
+
+    def __iter__(self):
+        fileobj = self.fileobj
+        fileobj.seek(self.start)
+        remaining = self.stop - self.start
+        while remaining > 0:
+            data = fileobj.read(min(remaining, archive.CHUNK_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def app_iter_range(self, start, stop):
+        if stop is not None:
+            stop += self.start
+        return FileIter(self.fileobj, self.start + start, stop)
+
+    def close(self):
+        self.fileobj.close()
+
+class ListingEntry(object):
+    """One entry in a directory listing (see Project.list_directory),
+    filled in from a single stat. short_name is the name within the
+    directory, which ends in a slash for directories. Files have a
+    size and created and modified datetimes. Directories have the
+    size and number of the files under them."""
+    __slots__ = ("short_name", "size", "created", "modified", "files")
+
+    def __init__(self, short_name, size, created=None, modified=None,
+                 files=None):
+        self.short_name = short_name
+        self.size = size
+        self.created = created
+        self.modified = modified
+        self.files = files
+
+    @property
+    def is_directory(self):
+        return self.short_name.endswith("/")
+
+def _sorted_names(location):
+    """Returns the sorted names in the directory at location, with a
+    slash at the end of the subdirectory names. Symlinks (which are
+    not supported) and uploads in progress are left out. The list is
+    cached until the directory's mtime changes, except for directories
+    changed in the last SCAN_MTIME_SLACK seconds, whose mtime may not
+    show the next change."""
+    mtime = os.stat(location).st_mtime
+    cached = _listing_cache.get(location)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    names = []
+    for name in os.listdir(location):
+        if name.startswith(UPLOAD_PREFIX):
             continue
-        total += f.size
-        files.append(directory.relpathto(f))
-    return total, files
-
-def _get_space_used(directory):
-    total = 0
-    for f in directory.walkfiles():
-        if ".hg" in f or ".svn" in f or ".bzr" in f or ".git" in f:
+        try:
+            mode = os.lstat(os.path.join(location, name)).st_mode
+        except OSError:
+            # removed while we were listing
             continue
-        total += f.size
-    return total
-
-def _regexp(expr, item):
-    if expr is None:
-        return False
-    # only search on basenames
-    p = path_obj(item)
-    item = p.basename()
-    return re.search(expr, item, re.UNICODE|re.I) is not None
-    
+        if stat.S_ISDIR(mode):
+            names.append(name + "/")
+        elif stat.S_ISREG(mode):
+            names.append(name)
+    names.sort()
+
+    if mtime < time.time() - SCAN_MTIME_SLACK:
+        if len(_listing_cache) >= LISTING_CACHE_SIZE:
+            _listing_cache.clear()
+        _listing_cache[location] = (mtime, names)
+    return names
+
+def _is_vcs_path(filename):
+    return ".hg" in filename or ".svn" in filename \
+        or ".bzr" in filename or ".git" in filename
+
+def _dirname_of(filename):
+    """Returns the directory part of a project relative filename,
+    with a trailing slash, or '' for files at the top."""
+    slash = filename.rfind("/")
+    return filename[:slash+1]
+
+def _get_template(source_dir):
+    """Returns the files of the project template in source_dir as a
+    list of (destination directory, filename, filename template,
+    body). The filename template is None for filenames that have
+    nothing to expand. The body is the contents of a file with nothing
+    to expand, or else its jsontemplate.Template. Each template
+    directory is read and compiled once, and again only when one of
+    its files or directories changes."""
+    cached = _template_cache.get(source_dir)
+    if cached is not None:
+        stamps, files = cached
+        try:
+            for filename, stamp in stamps.iteritems():
+                st = os.stat(filename)
+                if (st.st_mtime, st.st_size) != stamp:
+                    break
+            else:
+                return files
+        except OSError:
+            pass
+
+    stamps = {}
+    files = []
+    common_path_len = len(source_dir) + 1
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        st = os.stat(dirpath)
+        stamps[dirpath] = (st.st_mtime, st.st_size)
+        destdir = dirpath[common_path_len:]
+        if '.svn' in destdir:
+            continue
+        for f in filenames:
+            filepath = os.path.join(dirpath, f)
+            st = os.stat(filepath)
+            stamps[filepath] = (st.st_mtime, st.st_size)
+            if "{" in f:
+                name_template = jsontemplate.Template(f)
+            else:
+                name_template = None
+            body = jsontemplate.Template(open(filepath).read())
+            statements = body._program.Statements()
+            if all(isinstance(s, basestring) for s in statements):
+                body = "".join(statements)
+            files.append((destdir, f, name_template, body))
+    _template_cache[source_dir] = (stamps, files)
+    return files
+
+def _dir_and_parents(dirname):
+    """Returns dirname (which ends in a slash, or is '' for the top)
+    followed by each of the directories that contain it."""
+    result = [dirname]
+    while dirname:
+        dirname = _dirname_of(dirname[:-1])
+        result.append(dirname)
+    return result
+
+def _search_chars(filename):
+    """Returns the set of lower cased characters in the basename of
+    filename. These are the keys under which the file is indexed
+    for filename searches."""
+    if isinstance(filename, str):
+        filename = filename.decode("utf-8", "replace")
+    return set(filename.rsplit("/", 1)[-1].lower())
+
+def _matches_query(query, filename):
+    """Returns True if the characters of the (lower cased) query
+    appear in order in the basename of filename."""
+    name = filename.rsplit("/", 1)[-1].lower()
+    pos = 0
+    for char in query:
+        pos = name.find(char, pos)
+        if pos == -1:
+            return False
+        pos += 1
+    return True
+
 def rescan_project(qi):
     """Runs an asynchronous rescan of a project"""
     from bespin import database
@@ -288,13 +563,143 @@ def rescan_project(qi):
     s = database._get_session()
     user = database.User.find_user(message['user'])
     project = get_project(user, user, message['project'])
-    project.scan_files()
+    project.rescan()
     retvalue = database.Message(user_id=user.id, message=simplejson.dumps(
             dict(asyncDone=True,
             jobid=qi.id, output="Rescan complete")))
     s.add(retvalue)
     
 
+def _trash_location(owner):
+    return owner.get_location() / TRASH_DIR
+
+def _move_to_trash(owner, location, project_name, path, size):
+    """Moves a project (path is '') or a directory in it into the
+    owner's trash and schedules the purge. The trash entry holds
+    the moved tree as 'item' and what is needed to restore it in
+    'info.json'. Entry names start with the time of deletion, which
+    is what the purge goes by. Returns the entry name."""
+    trash = _trash_location(owner)
+    deleted = int(time.time())
+    trash_id = "%d-%s" % (deleted, uuid4().hex)
+    entry = trash / trash_id
+    entry.makedirs()
+    (entry / "info.json").write_bytes(simplejson.dumps(dict(
+        project=project_name, path=path, size=size, deleted=deleted)))
+    path_obj(location.rstrip("/")).rename(entry / "item")
+    if config.c.queue:
+        queue.enqueue(TRASH_QUEUE, dict(trash=str(trash)),
+                      execute="bespin.filesystem:purge_trash", use_db=False,
+                      delay=config.c.trash_keep_seconds)
+    else:
+        # the purge runs in this request, so it does not pause
+        _purge_trash(trash, pause=False)
+    return trash_id
+
+_trash_id_re = re.compile(r'^\d+-[0-9a-f]{32}$')
+
+def _trash_entry(owner, trash_id):
+    if not _trash_id_re.match(trash_id):
+        raise BadValue("Invalid trash entry: %s" % trash_id)
+    entry = _trash_location(owner) / trash_id
+    info_file = entry / "info.json"
+    if not info_file.exists():
+        raise FileNotFound("There is no %s in the trash" % trash_id)
+    info = simplejson.loads(info_file.bytes())
+    info['id'] = trash_id
+    return entry, info
+
+def list_trash(owner):
+    """Returns a list of the owner's projects and directories that
+    are in the trash, most recently deleted first. Each is a
+    dictionary of id, project, path (which is '' for a whole
+    project), size and deleted (the time of deletion)."""
+    trash = _trash_location(owner)
+    if not trash.exists():
+        return []
+    result = []
+    for name in trash.listdir():
+        try:
+            entry, info = _trash_entry(owner, name.basename())
+        except FSException:
+            # partially created or already purged
+            continue
+        result.append(info)
+    result.sort(key=lambda info: info['deleted'], reverse=True)
+    return result
+
+def restore_from_trash(owner, trash_id):
+    """Puts a project or a directory from the trash back where it
+    was deleted from. Raises FileConflict if something has been
+    created there since. Returns the project."""
+    entry, info = _trash_entry(owner, trash_id)
+    if not owner.check_save(info['size']):
+        raise OverQuota()
+    project_name = info['project']
+    if not info['path']:
+        location = owner.get_location() / project_name
+        if location.exists():
+            raise FileConflict("Cannot restore project %s, because a "
+                "project with that name already exists." % project_name)
+        (entry / "item").rename(location)
+        project = ProjectView(owner, owner, project_name, location)
+        owner.amount_used += project.metadata.rescan()[0]
+        config.c.stats.incr("projects")
+    else:
+        project = get_project(owner, owner, project_name)
+        location = project.location / info['path']
+        if location.exists():
+            raise FileConflict("Cannot restore %s in project %s, because "
+                "it already exists." % (info['path'], project_name))
+        parent = path_obj(location.rstrip("/")).dirname()
+        if not parent.exists():
+            parent.makedirs()
+        (entry / "item").rename(location.rstrip("/"))
+        project.rescan()
+    entry.rmtree()
+    return project
+
+def purge_trash(qi):
+    """Runs the purge of a trash directory (see _purge_trash)."""
+    _purge_trash(path_obj(qi.message['trash']))
+
+def _purge_trash(trash, pause=True):
+    """Removes the trash entries that have been there for more than
+    config.c.trash_keep_seconds, pausing now and then (if pause is
+    True) to let other disk users through."""
+    if not trash.exists():
+        return
+    expired = time.time() - config.c.trash_keep_seconds
+    for entry in trash.dirs():
+        try:
+            deleted = int(entry.basename().split("-")[0])
+        except ValueError:
+            continue
+        if deleted > expired:
+            continue
+        try:
+            _remove_slowly(entry, pause)
+        except OSError, e:
+            # another purge may be removing the same entry
+            log.warn("Could not purge %s: %s", entry, e)
+
+def _remove_slowly(directory, pause=True):
+    batch_size = config.c.purge_batch_size
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(directory, topdown=False):
+        for name in filenames:
+            os.remove(os.path.join(dirpath, name))
+            removed += 1
+            if pause and removed % batch_size == 0:
+                time.sleep(config.c.purge_pause)
+        for name in dirnames:
+            subdir = os.path.join(dirpath, name)
+            if os.path.islink(subdir):
+                os.remove(subdir)
+            else:
+                os.rmdir(subdir)
+    os.rmdir(directory)
+
 class Revision(object):
     """ A class to wrap up a revision, according to the data stored speced in
     https://wiki.mozilla.org/Labs/Bespin/DesignDocs/TimeMachine """
@@ -333,7 +738,72 @@ class Project(object):
         directories as needed in between. If last_edit is not provided,
         the file must not be opened for editing. Otherwise, the
         last_edit parameter should include the last edit ID received by
-        the user."""
+        the user. Saving the contents the file already has does
+        nothing."""
+        if isinstance(contents, unicode):
+            encoded = contents.encode("utf-8")
+        else:
+            encoded = contents
+        digest = None
+        if encoded is not None:
+            digest = sha1(encoded).hexdigest()
+            file = File(self, destpath)
+            try:
+                size = os.path.getsize(file.location)
+            except OSError:
+                size = None
+            # content_hash only reads the file when its recorded hash
+            # cannot be trusted
+            if size == len(encoded) and file.content_hash == digest:
+                return file
+
+        saved_size = len(contents) if contents is not None else 0
+        if not self.owner.check_save(saved_size):
+            raise OverQuota()
+
+        file = self._file_to_save(destpath)
+        with self.metadata.batch():
+            self._record_save(file, saved_size)
+            file.save(contents)
+            if digest is not None:
+                file._record_hash(digest)
+        self._index_symbols()
+        return file
+
+    def save_file_stream(self, destpath, source, length=None):
+        """Saves the contents of the file object source (such as
+        wsgi.input) to the file path provided, reading it a chunk at a
+        time. length is the number of bytes to read, if known. The
+        quota is checked against length before anything is read and
+        against the bytes read so far as the upload goes. The file is
+        written under a temporary name and renamed into place, so it
+        is replaced only by a complete upload, and not at all when the
+        upload has the contents the file already has."""
+        if length is not None and not self.owner.check_save(length):
+            raise OverQuota()
+
+        file = self._file_to_save(destpath)
+        if file.exists():
+            old_size = file.saved_size
+            old_digest = file.recorded_hash
+        else:
+            old_size = old_digest = None
+        saved_size, digest = _save_stream(file.location,
+                                  _UploadReader(source, length, self.owner),
+                                  old_digest)
+        if digest == old_digest:
+            return file
+        with self.metadata.batch():
+            self._record_save(file, saved_size, old_size)
+            file._record_hash(digest)
+            if config.c.blob_store:
+                file._record_link()
+        self._index_symbols()
+        return file
+
+    def _file_to_save(self, destpath):
+        """Returns the File for saving at destpath, after checking
+        the path and creating the directories leading to it."""
         if "../" in destpath:
             raise BadValue("Relative directories are not allowed")
 
@@ -341,10 +811,6 @@ class Project(object):
         while destpath and destpath.startswith("/"):
             destpath = destpath[1:]
 
-        saved_size = len(contents) if contents is not None else 0
-        if not self.owner.check_save(saved_size):
-            raise OverQuota()
-
         file_loc = self.location / destpath
 
         if file_loc.isdir():
@@ -356,16 +822,26 @@ class Project(object):
         if not file_dir.exists():
             file_dir.makedirs()
 
-        file = File(self, destpath)
-        if file.exists():
-            size_delta = saved_size - file.saved_size
-        else:
+        return File(self, destpath)
+
+    def _record_save(self, file, saved_size, old_size=False):
+        """Updates the metadata and amount_used for saving saved_size
+        bytes to file. old_size is the size of the file before it was
+        saved (None if it did not exist); by default, the file has not
+        been saved yet and is looked at for it."""
+        if old_size is False:
+            if file.exists():
+                old_size = file.saved_size
+            else:
+                old_size = None
+        if old_size is None:
             size_delta = saved_size
-            self.metadata.cache_add(destpath)
+            self.metadata.cache_add(file.name, saved_size)
             config.c.stats.incr("files")
-        file.save(contents)
+        else:
+            size_delta = saved_size - old_size
+            self.metadata.cache_set_size(file.name, saved_size)
         self.owner.amount_used += size_delta
-        return file
 
     def save_temp_file(self, destpath, contents=None):
         """Save a temporary version of the given path, that's in parallel with
@@ -409,6 +885,9 @@ class Project(object):
                     % destpath)
         else:
             file_loc.makedirs()
+            if not destpath.endswith("/"):
+                destpath += "/"
+            self.metadata.log_directory(destpath)
 
     def install_template_file(self, path, options):
         """Installs a single template file at the path
@@ -484,25 +963,26 @@ class Project(object):
         variables['project'] = self.name
         variables['username'] = self.owner.username
 
-        common_path_len = len(source_dir) + 1
-        for dirpath, dirnames, filenames in os.walk(source_dir):
-            destdir = dirpath[common_path_len:]
-            if '.svn' in destdir:
-                continue
-            for f in filenames:
-                if "{" in f:
-                    dest_f = jsontemplate.expand(f, variables)
-                else:
-                    dest_f = f
+        members = []
+        for destdir, f, name_template, body in _get_template(source_dir):
+            if name_template is not None:
+                dest_f = name_template.expand(variables)
+            else:
+                dest_f = f
 
-                if destdir:
-                    destpath = "%s/%s" % (destdir, dest_f)
-                else:
-                    destpath = dest_f
-                contents = open(os.path.join(dirpath, f)).read()
+            if destdir:
+                destpath = "%s/%s" % (destdir, dest_f)
+            else:
+                destpath = dest_f
+            if isinstance(body, jsontemplate.Template):
                 variables['filename'] = dest_f
-                contents = jsontemplate.expand(contents, variables)
-                self.save_file(destpath, contents)
+                contents = body.expand(variables)
+                if isinstance(contents, unicode):
+                    contents = contents.encode("utf-8")
+            else:
+                contents = body
+            members.append((destpath, len(contents), contents))
+        self._import_members(members, StringIO)
 
     def list_files(self, path=""):
         """Retrieve a list of files at the path. Directories will have
@@ -517,6 +997,8 @@ class Project(object):
 
         result = []
         for name in names:
+            if name.basename().startswith(UPLOAD_PREFIX):
+                continue
             try:
                 if name.isdir():
                     result.append(Directory(self, self.location.relpathto(name)))
@@ -529,6 +1011,50 @@ class Project(object):
 
         return sorted(result, key=lambda item: item.name)
 
+    def list_directory(self, path="", after=None, limit=None):
+        """Returns a list of ListingEntry for the directory at path,
+        sorted by name. To get the listing a page at a time, pass the
+        short_name of the last entry on the previous page as after
+        and the page size as limit. Only the entries on the page are
+        looked at beyond their names."""
+        d = Directory(self, path)
+        location = d.location
+        try:
+            names = _sorted_names(location)
+        except OSError:
+            if not location.isdir():
+                raise FileNotFound("Directory %s in %s does not exist"
+                                  % (path, self.name))
+            raise
+
+        start = 0
+        if after is not None:
+            if isinstance(after, unicode):
+                after = after.encode("utf-8")
+            start = bisect.bisect_right(names, after)
+        if limit is None:
+            names = names[start:]
+        else:
+            names = names[start:start + limit]
+
+        totals = self.metadata.dir_totals_for(
+            [d.name + name for name in names if name.endswith("/")])
+
+        result = []
+        for name in names:
+            if name.endswith("/"):
+                size, files = totals.get(d.name + name, (0, 0))
+                result.append(ListingEntry(name, size, files=files))
+                continue
+            try:
+                st = os.stat(os.path.join(location, name))
+            except OSError:
+                continue
+            result.append(ListingEntry(name, st.st_size,
+                datetime.fromtimestamp(st.st_ctime),
+                datetime.fromtimestamp(st.st_mtime)))
+        return result
+
     def _check_and_get_file(self, path):
         """Returns the file object."""
         file_obj = File(self, path)
@@ -552,7 +1078,9 @@ class Project(object):
         """Deletes a file, as long as it is not opened. If the file is
         open, a FileConflict is raised. If the path is a directory,
         the directory and everything underneath it will be deleted.
-        If the path is empty, the project will be deleted."""
+        If the path is empty, the project will be deleted. Projects
+        and directories are moved to the owner's trash, from which
+        they can be restored until they are purged."""
         # deleting the project?
         if not path or path.endswith("/"):
             dir_obj = Directory(self, path)
@@ -566,14 +1094,15 @@ class Project(object):
                     raise FileNotFound("Directory %s in project %s does not exist" %
                             (path, self.name))
 
-            space_used = _get_space_used(location)
+            space_used = self.metadata.dir_totals(dir_obj.name)[0]
 
             if not path:
                 self.metadata.delete()
             else:
                 self.metadata.cache_delete(path, True)
 
-            location.rmtree()
+            _move_to_trash(self.owner, location, self.name, dir_obj.name,
+                           space_used)
             config.c.stats.decr("projects")
             self.owner.amount_used -= space_used
         else:
@@ -596,9 +1125,12 @@ class Project(object):
         max_import_file_size = config.c.max_import_file_size
         info = list(pfile)
 
-        base = _find_common_base(member.name for member in info)
+        # tarfile drops the trailing slash from directory names
+        base = _find_common_base(member.name + "/" if member.isdir()
+                                 else member.name for member in info)
         base_len = len(base)
 
+        members = []
         for member in info:
             # save the files, directories are created automatically
             # note that this does not currently support empty directories.
@@ -606,8 +1138,8 @@ class Project(object):
                 if member.size > max_import_file_size:
                     raise FSException("File %s too large (max is %s bytes)"
                         % (member.name, max_import_file_size))
-                self.save_file(member.name[base_len:],
-                    pfile.extractfile(member).read())
+                members.append((member.name[base_len:], member.size, member))
+        self._import_members(members, pfile.extractfile)
 
     def import_zipfile(self, filename, file_obj):
         """Imports the zip file in the file_obj into the project
@@ -621,25 +1153,99 @@ class Project(object):
         base = _find_common_base(member.filename for member in info)
         base_len = len(base)
 
-        for member in pfile.infolist():
+        members = []
+        for member in info:
             if member.filename.endswith("/"):
                 continue
             if member.file_size > max_import_file_size:
                 raise FSException("File %s too large (max is %s bytes)"
                     % (member.filename, max_import_file_size))
-            self.save_file(member.filename[base_len:],
-                pfile.read(member.filename))
-
-    def export_tarball(self):
-        """Exports the project as a tarball, returning a
-        NamedTemporaryFile object. You can either use that
-        open file handle or use the .name property to get
-        at the file."""
-        temporaryfile = tempfile.NamedTemporaryFile()
-
-        mtime = time.time()
-        tfile = tarfile.open(temporaryfile.name, "w:gz")
+            members.append((member.filename[base_len:], member.file_size,
+                            member))
+        if hasattr(pfile, "open"):
+            open_member = pfile.open
+        else:
+            # ZipFile.open is new in Python 2.6
+            def open_member(member):
+                return StringIO(pfile.read(member.filename))
+        self._import_members(members, open_member)
+
+    def _import_members(self, members, open_member):
+        """Saves archive (or template) members into the project.
+        members is a list of (destpath, size, member) and
+        open_member(member) returns a file object for reading the
+        member's contents, which are copied to disk a chunk at a
+        time. The quota is checked once for all of the members, and
+        the search cache and amount_used are updated once at the end,
+        for whatever was written."""
+        location = self.location
+        files = []
+        total_size = 0
+        for destpath, size, member in members:
+            if "../" in destpath:
+                raise BadValue("Relative directories are not allowed")
+            while destpath and destpath.startswith("/"):
+                destpath = destpath[1:]
+            file_loc = location / destpath
+            if file_loc.isdir():
+                raise FileConflict("Cannot save file at %s in project "
+                    "%s, because there is already a directory with that "
+                    "name." % (destpath, self.name))
+            files.append((destpath, file_loc, member))
+            total_size += size
+
+        if not self.owner.check_save(total_size):
+            raise OverQuota()
 
+        added = []
+        resized = []
+        linked = []
+        size_delta = 0
+        known_dirs = set()
+        try:
+            for destpath, file_loc, member in files:
+                file_dir = file_loc.dirname()
+                if file_dir not in known_dirs:
+                    if not file_dir.exists():
+                        file_dir.makedirs()
+                    known_dirs.add(file_dir)
+
+                if file_loc.exists():
+                    old_size = file_loc.size
+                else:
+                    old_size = None
+
+                source = open_member(member)
+                try:
+                    saved_size = _save_stream(file_loc, source)[0]
+                finally:
+                    source.close()
+                if config.c.blob_store:
+                    stat = os.stat(file_loc)
+                    if stat.st_nlink > 1:
+                        linked.append((destpath, stat.st_ino))
+
+                if old_size is None:
+                    added.append((destpath, saved_size))
+                    size_delta += saved_size
+                else:
+                    resized.append((destpath, saved_size))
+                    size_delta += saved_size - old_size
+        finally:
+            if linked:
+                self.metadata.set_link_times(linked)
+            if added or resized:
+                self.metadata.cache_import(added, resized)
+                config.c.stats.incr("files", len(added))
+                self.owner.amount_used += size_delta
+                self._index_symbols()
+
+    def export_tarball_stream(self):
+        """Generates the project as a gzipped tarball, a piece
+        at a time, walking the project as it goes."""
+        return archive.tar_gz_stream(self._tarball_members())
+
+    def _tarball_members(self):
         location = self.location
         project_name = self.name
 
@@ -649,58 +1255,37 @@ class Project(object):
             bname = dir.basename()
             if bname == "." or bname == "..":
                 continue
-            tarinfo = tarfile.TarInfo(project_name + "/"
-                        + location.relpathto(dir))
-            tarinfo.type = tarfile.DIRTYPE
-            # we don't know the original permissions.
-            # we'll default to read/execute for all, write only by user
-            tarinfo.mode = 493
-            tarinfo.mtime = mtime
-            tfile.addfile(tarinfo)
+            yield (project_name + "/" + location.relpathto(dir), None)
             for file in dir.files():
                 bname = file.basename()
                 if bname == "." or bname == ".." or bname.startswith(".bespin"):
                     continue
-                tarinfo = tarfile.TarInfo(project_name + "/"
-                                + location.relpathto(file))
-                tarinfo.mtime = mtime
-                # we don't know the original permissions.
-                # we'll default to read for all, write only by user
-                tarinfo.mode = 420
-                tarinfo.size = file.size
-                fileobj = open(file)
-                tfile.addfile(tarinfo, fileobj)
-
-        tfile.close()
-        temporaryfile.seek(0)
-        return temporaryfile
+                yield (project_name + "/" + location.relpathto(file), file)
+
+    def export_zipfile_stream(self):
+        """Generates the project as a zip file, a piece at a time,
+        walking the project as it goes."""
+        return archive.zip_stream(self._zipfile_members())
+
+    def _zipfile_members(self):
+        location = self.location
+        project_name = self.name
+        for file in location.walkfiles():
+            yield (project_name + "/" + location.relpathto(file), file)
+
+    def export_tarball(self):
+        """Exports the project as a tarball, returning a
+        NamedTemporaryFile object. You can either use that
+        open file handle or use the .name property to get
+        at the file."""
+        return _stream_to_tempfile(self.export_tarball_stream())
 
     def export_zipfile(self):
         """Exports the project as a zip file, returning a
         NamedTemporaryFile object. You can either use that
         open file handle or use the .name property to get
         at the file."""
-        temporaryfile = tempfile.NamedTemporaryFile()
-
-        zfile = zipfile.ZipFile(temporaryfile, "w", zipfile.ZIP_DEFLATED)
-        ztime = time.gmtime()[:6]
-
-        project_name = self.name
-        location = self.location
-
-        for file in self.location.walkfiles():
-            zipinfo = zipfile.ZipInfo(project_name + "/"
-                            + location.relpathto(file))
-            # we don't know the original permissions.
-            # we'll default to read for all, write only by user
-            zipinfo.external_attr = 420 << 16L
-            zipinfo.date_time = ztime
-            zipinfo.compress_type = zipfile.ZIP_DEFLATED
-            zfile.writestr(zipinfo, file.bytes())
-
-        zfile.close()
-        temporaryfile.seek(0)
-        return temporaryfile
+        return _stream_to_tempfile(self.export_zipfile_stream())
 
     def rename(self, new_name):
         """Renames this project to new_name, assuming there is
@@ -708,43 +1293,91 @@ class Project(object):
         _check_identifiers("Project name", new_name)
         old_location = self.location
         new_location = self.location.parent / new_name
-        self.metadata.rename(new_name)
         if new_location.exists():
             raise FileConflict("Cannot rename project %s to %s, because"
                 " a project with the new name already exists."
                 % (self.name, new_name))
+        self.metadata.rename(new_name)
         old_location.rename(new_location)
         self.name = new_name
         self.location = new_location
 
     def scan_files(self):
-        """Looks through the files, computes how much space they
-        take and updates the cached file list."""
-        space_used, files = _get_file_list(self.location)
-        self.metadata.cache_replace(files)
+        """Looks through all of the files, computes how much space
+        they take and updates the cached file list. Unlike rescan,
+        this also finds the files that were rewritten in place, which
+        is what repairing amount_used (User.recompute_files) needs."""
+        space_used, delta = self.metadata.rescan(full=True)
+        self._index_symbols()
         return space_used
 
+    def rescan(self):
+        """Updates the cached file list like scan_files, and applies
+        the change in space used to the owner's amount_used. Only the
+        directories that changed since the last scan are listed. The
+        first scan of a project only records the snapshot, because
+        it is not known what amount_used already accounts for."""
+        space_used, delta = self.metadata.rescan()
+        if delta:
+            self.owner.amount_used += delta
+        self._index_symbols()
+        return space_used
+
+    def _index_symbols(self):
+        """Queues the symbol indexing of the files that the metadata
+        marked as new or changed (see bespin.symbols)."""
+        if self.metadata.symbols_pending():
+            queue.enqueue("vcs", dict(project=self.name,
+                                      location=str(self.location)),
+                          execute="bespin.symbols:index_project",
+                          use_db=False)
+
+    def changes_since(self, cursor=None, limit=None):
+        """Returns the changes to the project's files since cursor
+        (see ProjectMetadata.changes_since)."""
+        return self.metadata.changes_since(cursor, limit)
+
+    def find_symbols(self, query, limit=20):
+        """Looks up the definitions whose names match query (see
+        bespin.symbols.find)."""
+        return symbols.find(self.metadata, query, limit)
+
     def search_files(self, query, limit=20, include=""):
         """Scans the files for filenames that match the queries."""
 
         # make the query lower case so that the match boosting
         # in _SearchMatch can use it
         query = query.lower()
-        if isinstance(query, unicode):
-            query = query.encode('utf-8')
-        escaped_query = [re.escape(char) for char in query]
-        search_re = ".*".join(escaped_query)
-        files = self.metadata.search_files(search_re)
-        match_list = [_SearchMatch(query, f) for f in files]
-        all_results = [str(match) for match in sorted(match_list)]
-        
+        if isinstance(query, str):
+            query = query.decode("utf-8")
+
+        metadata = self.metadata
+        key = (metadata.filename,) + metadata.search_generation + \
+              (query, limit, include)
+        try:
+            return list(_search_results[key])
+        except KeyError:
+            pass
+
+        files = metadata.search_files(query)
+
         # check now if the files are within the include folder
         # if the include folder is empty just take them all
         if include != "":
             includes = re.compile('|'.join(include.split(';')))
-            return [file for file in all_results if includes.match(file)][:limit]
+            files = [file for file in files if includes.match(file)]
+
+        match_list = [_SearchMatch(query, f) for f in files]
+        if 0 <= limit < len(match_list):
+            match_list = heapq.nsmallest(limit, match_list)
         else:
-            return all_results[:limit]
+            match_list = sorted(match_list)[:limit]
+        result = [str(match) for match in match_list]
+
+        if len(_search_results) >= SEARCH_CACHE_SIZE:
+            _search_results.clear()
+        _search_results[key] = result
+        return list(result)
 
     def _isotime_to_bespintime(self, isotime):
         localtime = time.strptime(isotime[:19], "%Y-%m-%d %H:%M:%S")
@@ -849,15 +1482,211 @@ class ProjectView(Project):
         file_obj = File(self, path)
         # self.reset_edits(user, project, path)
 
+def _stream_to_tempfile(stream):
+    temporaryfile = tempfile.NamedTemporaryFile()
+    for data in stream:
+        temporaryfile.write(data)
+    temporaryfile.seek(0)
+    return temporaryfile
+
 def get_temp_file_name(project, path):
     return "." + project + "-mobwrite/" + path
 
+def _save_stream(path, source, unchanged=None):
+    """Saves the contents of the file object source at path, reading
+    it a chunk at a time. The contents are written to a temporary file
+    in the same directory, which is renamed to path once it is
+    complete. If the SHA-1 of the contents turns out to be unchanged,
+    path is left as it is. Returns a tuple of the number of bytes
+    saved and their SHA-1 hex digest."""
+    if config.c.blob_store:
+        blob, size, stored = blobstore.store_stream(source, reopen=True)
+        try:
+            digest = os.path.basename(blob)
+            if digest == unchanged or blobstore.link_into(blob, path):
+                return size, digest
+            # the link can fail because collect_garbage has already
+            # removed the blob, so the copy is made from stored
+            return _write_stream(path, stored, unchanged)
+        finally:
+            stored.close()
+    return _write_stream(path, source, unchanged)
+
+def _write_stream(path, source, unchanged):
+    """The part of _save_stream that writes a copy of source."""
+    tempname = path.dirname() / (UPLOAD_PREFIX + uuid4().hex)
+    fd = os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+    hash = sha1()
+    try:
+        dest = os.fdopen(fd, "wb")
+        try:
+            while True:
+                data = source.read(archive.CHUNK_SIZE)
+                if not data:
+                    break
+                hash.update(data)
+                dest.write(data)
+            size = dest.tell()
+        finally:
+            dest.close()
+        digest = hash.hexdigest()
+        if digest == unchanged:
+            os.remove(tempname)
+        else:
+            os.rename(tempname, path)
+    except:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+    return size, digest
+
+def _hash_file(location):
+    """Returns the SHA-1 hex digest of the file at location."""
+    hash = sha1()
+    f = open(location, "rb")
+    try:
+        while True:
+            data = f.read(archive.CHUNK_SIZE)
+            if not data:
+                break
+            hash.update(data)
+    finally:
+        f.close()
+    return hash.hexdigest()
+
+class _UploadReader(object):
+    """Wraps the file object an upload is read from. Reads no more
+    than length bytes, if length is given, and raises OverQuota as soon
+    as the bytes read are more than the owner can save."""
+
+    def __init__(self, source, length, owner):
+        self.source = source
+        self.remaining = length
+        self.owner = owner
+        self.total = 0
+
+    def read(self, size):
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if not size:
+                return ""
+        data = self.source.read(size)
+        if self.remaining is not None:
+            if not data:
+                raise FSException("Upload ended after %s bytes, "
+                    "expected %s" % (self.total, self.total + self.remaining))
+            self.remaining -= len(data)
+        self.total += len(data)
+        if not self.owner.check_save(self.total):
+            raise OverQuota()
+        return data
+
 def _save(path, contents):
     if isinstance(contents, unicode):
         path.write_text(contents, encoding='utf-8')
     else:
         path.write_bytes(contents)
 
+class _ConnectionPool(object):
+    """Keeps the sqlite connections to project metadata files open
+    between requests, keyed by metadata filename. A connection is
+    used by only one ProjectMetadata at a time and goes back into
+    the pool when that ProjectMetadata is closed. Beyond
+    config.c.metadata_pool_size idle connections, the least recently
+    used are closed."""
+
+    def __init__(self):
+        # filename -> list of [last_used, inode, connection]
+        self._idle = {}
+        self._count = 0
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def checkout(self, filename):
+        """Returns an idle connection to filename, or None."""
+        try:
+            inode = os.stat(filename).st_ino
+        except OSError:
+            inode = None
+        self._lock.acquire()
+        try:
+            entries = self._idle.get(filename)
+            if not entries:
+                return None
+            if entries[-1][1] == inode:
+                stale = []
+                connection = entries.pop()[2]
+            else:
+                # the file was deleted or replaced underneath us
+                stale = entries[:]
+                del entries[:]
+                connection = None
+            if not entries:
+                del self._idle[filename]
+            self._count -= len(stale) + (connection is not None)
+        finally:
+            self._lock.release()
+        for entry in stale:
+            entry[2].close()
+        return connection
+
+    def checkin(self, filename, connection):
+        """Returns the connection to the pool."""
+        try:
+            inode = os.stat(filename).st_ino
+        except OSError:
+            connection.close()
+            return
+        evicted = []
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(filename, []).append(
+                [self._clock.next(), inode, connection])
+            self._count += 1
+            while self._count > config.c.metadata_pool_size:
+                oldest = min(self._idle, key=lambda f: self._idle[f][0][0])
+                entries = self._idle[oldest]
+                evicted.append(entries.pop(0)[2])
+                if not entries:
+                    del self._idle[oldest]
+                self._count -= 1
+        finally:
+            self._lock.release()
+        for connection in evicted:
+            connection.close()
+
+    def discard(self, filename):
+        """Closes the idle connections to filename."""
+        self._lock.acquire()
+        try:
+            entries = self._idle.pop(filename, [])
+            self._count -= len(entries)
+        finally:
+            self._lock.release()
+        for entry in entries:
+            entry[2].close()
+
+_metadata_pool = _ConnectionPool()
+
+class _WriteBatch(object):
+    """Context manager returned by ProjectMetadata.batch."""
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def __enter__(self):
+        self.metadata._batch_depth += 1
+        return self.metadata
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metadata = self.metadata
+        metadata._batch_depth -= 1
+        if metadata._batch_depth == 0 and metadata._connection:
+            if exc_type is None:
+                metadata._connection.commit()
+            else:
+                metadata._connection.rollback()
+
 class ProjectMetadata(dict):
     """Provides access to Bespin-specific project information.
     This metadata is stored in an sqlite database in the user's
@@ -869,22 +1698,33 @@ class ProjectMetadata(dict):
         self.filename = self.project_location / ".." / \
                         (".%s_metadata" % self.project_name)
         self._connection = None
-        self._regexp_initialized = False
+        self._batch_depth = 0
 
     @property
     def connection(self):
-        """Opens the database. This is generally done automatically
-        by the methods that use the DB."""
+        """Opens the database, reusing a pooled connection if there
+        is one. This is generally done automatically by the methods
+        that use the DB."""
         if self._connection:
             return self._connection
 
+        conn = _metadata_pool.checkout(self.filename)
+        if conn is not None:
+            self._connection = conn
+            return conn
+
         is_new = not self.filename.exists()
 
-        conn = sqlite3.connect(self.filename)
+        # pooled connections move between the server's threads,
+        # but only one thread uses a connection at a time
+        conn = sqlite3.connect(self.filename, check_same_thread=False)
         self._connection = conn
 
+        c = conn.cursor()
+        if sqlite3.sqlite_version_info >= (3, 7, 0):
+            c.execute("pragma journal_mode=wal")
+            c.execute("pragma synchronous=normal")
         if is_new:
-            c = conn.cursor()
             c.execute('''create table keyvalue (
     key text primary key,
     value text
@@ -892,36 +1732,524 @@ class ProjectMetadata(dict):
             c.execute('''create table search_cache (
     filename
 )''')
-            conn.commit()
-            c.close()
+        tables = set(row[0] for row in c.execute(
+            "select name from sqlite_master where type='table'"))
+        if "search_info" not in tables:
+            # metadata from before the search index existed
+            self._create_search_index(c)
+            rows = list(c.execute("select rowid, filename from search_cache"))
+            for rowid, filename in rows:
+                self._index_file(c, rowid, filename)
+        if "scan_files" not in tables:
+            self._create_scan_snapshot(c)
+        if "dir_totals" not in tables:
+            self._create_dir_totals(c)
+        if "file_hashes" in tables and "recorded" not in [row[1]
+                for row in c.execute("pragma table_info(file_hashes)")]:
+            # hashes recorded without the time, which cannot tell
+            # whether the file changed right after it was hashed
+            c.execute("drop table file_hashes")
+            tables.discard("file_hashes")
+        if "file_hashes" not in tables:
+            self._create_file_hashes(c)
+        if "link_times" not in tables:
+            self._create_link_times(c)
+        if "symbols" in tables and "seq" not in [row[1]
+                for row in c.execute("pragma table_info(symbol_dirty)")]:
+            # marks without a seq, which update cannot tell apart from
+            # a later one; every file is indexed again
+            c.execute("drop table symbol_dirty")
+            self._create_symbol_marks(c)
+        if "symbols" not in tables:
+            self._create_symbol_index(c)
+        if "changes" not in tables:
+            self._create_change_log(c)
+        conn.commit()
+        c.close()
         return conn
 
+    def _commit(self):
+        if not self._batch_depth:
+            self._connection.commit()
+
+    def batch(self):
+        """Returns a context manager that makes the writes inside
+        of it a single transaction, which is committed at the end
+        (or rolled back if there is an exception)::
+
+            with metadata.batch():
+                metadata['remote_url'] = url
+                metadata['push'] = push
+        """
+        return _WriteBatch(self)
+
+    def _create_search_index(self, c):
+        """The search index maps each character that appears in
+        a file's basename to the search_cache rows for the files.
+        search_info holds a generation counter that changes with
+        every change to the file list, so that search results
+        can be cached. The epoch keeps the generations of a
+        deleted and recreated project apart."""
+        c.execute('''create table search_chars (
+    ch text,
+    file_id integer
+)''')
+        c.execute("create index search_chars_ch on search_chars (ch, file_id)")
+        c.execute('''create table search_info (
+    epoch text,
+    generation integer
+)''')
+        c.execute("insert into search_info values (?, 0)", (uuid4().hex,))
+
+    def _create_scan_snapshot(self, c):
+        """The scan snapshot records the size of every file and the
+        mtime of every directory as of the last scan (see rescan).
+        Directories are stored with a trailing slash, and the project
+        directory itself is stored as ''."""
+        c.execute('''create table scan_files (
+    filename text primary key,
+    dirname text,
+    size integer
+)''')
+        c.execute("create index scan_files_dirname on scan_files (dirname)")
+        c.execute('''create table scan_dirs (
+    dirname text primary key,
+    mtime real
+)''')
+
+    def _create_dir_totals(self, c):
+        """dir_totals holds the size and number of the files in the
+        scan snapshot under each directory, subdirectories included,
+        so that directory sizes can be looked up rather than walked.
+        The project directory itself is ''."""
+        c.execute('''create table dir_totals (
+    dirname text primary key,
+    size integer,
+    files integer
+)''')
+        rows = list(c.execute("""select dirname, sum(size), count(*)
+                                 from scan_files group by dirname"""))
+        for dirname, size, files in rows:
+            self._add_to_totals(c, dirname, size, files)
+
+    def _create_file_hashes(self, c):
+        """file_hashes holds the SHA-1 of the contents of files, along
+        with the inode, size and mtime the file had when it was hashed
+        and the time it was recorded. A hash is only good while the
+        file still has that inode, size and mtime (see get_hash)."""
+        c.execute('''create table file_hashes (
+    filename text primary key,
+    hash text,
+    inode integer,
+    size integer,
+    mtime real,
+    recorded real
+)''')
+
+    def _create_link_times(self, c):
+        """link_times holds the time each file that is a link to a
+        blob was saved, which the file's own times cannot tell. A time
+        is only good while the file is still that inode."""
+        c.execute('''create table link_times (
+    filename text primary key,
+    inode integer,
+    saved real
+)''')
+
+    def _create_symbol_index(self, c):
+        """The symbol index holds the definitions found in the
+        project's source files (see bespin.symbols)."""
+        c.execute('''create table symbol_files (
+    file_id integer primary key autoincrement,
+    filename text unique
+)''')
+        c.execute('''create table symbols (
+    name text,
+    lname text,
+    kind text,
+    file_id integer,
+    line integer
+)''')
+        c.execute("create index symbols_lname on symbols (lname)")
+        c.execute("create index symbols_file_id on symbols (file_id)")
+        self._create_symbol_marks(c)
+
+    def _create_symbol_marks(self, c):
+        """symbol_dirty lists the files that are new or changed since
+        they were last indexed; all of the files are listed when it is
+        created. Marking a file again gives it a higher seq, so that
+        the indexer can tell whether a mark is still the one it
+        read."""
+        c.execute('''create table symbol_dirty (
+    filename text primary key,
+    seq integer
+)''')
+        self._mark_for_symbols(c, [row[0] for row in
+                               c.execute("select filename from search_cache")])
+
+    def _create_change_log(self, c):
+        """The change log records the changes to the file list in
+        order, for clients that keep a copy of it (see changes_since).
+        Directories end in a slash. change_info holds the newest seq
+        that has been dropped from the log, and the seq at which it
+        was last compacted."""
+        c.execute('''create table changes (
+    seq integer primary key autoincrement,
+    action text,
+    path text
+)''')
+        c.execute('''create table change_info (
+    truncated integer,
+    compacted integer
+)''')
+        c.execute("insert into change_info values (0, 0)")
+
     def delete(self):
         """Remove this metadata file."""
+        self._discard_connections()
         if self.filename.exists():
-            self.close()
             self.filename.unlink()
+        for suffix in ("-wal", "-shm"):
+            log_file = path_obj(self.filename + suffix)
+            if log_file.exists():
+                log_file.unlink()
 
     def rename(self, new_project_name):
         """Rename this metadata file, because the project name is changing."""
+        if self.filename.exists():
+            # other connections may still have committed changes
+            # in the write-ahead log, which stays behind
+            self.connection.execute("pragma wal_checkpoint")
+        self._discard_connections()
         if self.filename.exists():
             d = self.filename.dirname()
             new_name = d / (".%s_metadata" % new_project_name)
             self.filename.rename(new_name)
             self.filename = new_name
 
+    def _discard_connections(self):
+        """Closes this object's connection and any pooled ones, so that
+        sqlite checkpoints and removes the write-ahead log files."""
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+        _metadata_pool.discard(self.filename)
+
     ######
     #
     # Methods for handling the filename cache
     #
     ######
 
-    def cache_add(self, filename):
-        """Add the file to the search cache."""
+    def _index_file(self, c, rowid, filename):
+        c.executemany("insert into search_chars values (?, ?)",
+                      [(char, rowid) for char in _search_chars(filename)])
+
+    def _bump_generation(self, c):
+        c.execute("update search_info set generation=generation+1")
+
+    def _add_to_totals(self, c, dirname, size, files):
+        dirs = _dir_and_parents(dirname)
+        c.executemany("insert or ignore into dir_totals values (?, 0, 0)",
+                      [(d,) for d in dirs])
+        c.executemany("""update dir_totals set size=size+?, files=files+?
+                         where dirname=?""", [(size, files, d) for d in dirs])
+
+    def _record_size(self, c, filename, size):
+        """Puts the file's size in the scan snapshot and the totals.
+        Like the scans, this skips version control files."""
+        if _is_vcs_path(filename):
+            return
+        row = c.execute("select size from scan_files where filename=?",
+                        (filename,)).fetchone()
+        dirname = _dirname_of(filename)
+        if row is None:
+            c.execute("insert into scan_files values (?, ?, ?)",
+                      (filename, dirname, size))
+            self._add_to_totals(c, dirname, size, 1)
+        elif row[0] != size:
+            c.execute("update scan_files set size=? where filename=?",
+                      (size, filename))
+            self._add_to_totals(c, dirname, size - row[0], 0)
+
+    def _forget_size(self, c, filename):
+        """Takes the file out of the scan snapshot and the totals."""
+        row = c.execute("select size from scan_files where filename=?",
+                        (filename,)).fetchone()
+        if row is not None:
+            c.execute("delete from scan_files where filename=?", (filename,))
+            self._add_to_totals(c, _dirname_of(filename), -row[0], -1)
+
+    def _total_size(self, c):
+        row = c.execute("select size from dir_totals where dirname=''").fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def _ensure_scanned(self):
+        c = self.connection.cursor()
+        scanned = c.execute("select 1 from scan_dirs limit 1").fetchone()
+        c.close()
+        if not scanned:
+            self.rescan()
+
+    def dir_totals_for(self, dirnames):
+        """Returns a dictionary of dirname -> (size, number of files)
+        for the directories in dirnames that have any files, like
+        dir_totals for each of them."""
+        self._ensure_scanned()
+        names = {}
+        for dirname in dirnames:
+            if isinstance(dirname, str):
+                try:
+                    names[dirname.decode("utf-8")] = dirname
+                except UnicodeDecodeError:
+                    # not valid utf-8, so it cannot be in the snapshot
+                    pass
+            else:
+                names[dirname] = dirname
+        keys = names.keys()
+
+        result = {}
+        c = self.connection.cursor()
+        # stay under sqlite's limit on the number of parameters
+        for i in xrange(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            c.execute("""select dirname, size, files from dir_totals
+                where dirname in (%s)""" % ",".join("?" * len(chunk)), chunk)
+            for dirname, size, files in c:
+                result[names[dirname]] = (size, files)
+        c.close()
+        return result
+
+    def dir_totals(self, dirname=""):
+        """Returns a tuple of the size and the number of the files
+        under dirname, which ends in a slash (or is '' for the whole
+        project). This comes from the scan snapshot, so a project
+        that has never been scanned is scanned first."""
+        self._ensure_scanned()
+        c = self.connection.cursor()
+        row = c.execute("select size, files from dir_totals where dirname=?",
+                        (dirname,)).fetchone()
+        c.close()
+        if row is None:
+            return (0, 0)
+        return row
+
+    def _mark_for_symbols(self, c, filenames):
+        c.executemany("""insert or replace into symbol_dirty values
+            (?, (select coalesce(max(seq), 0) + 1 from symbol_dirty))""",
+                      [(filename,) for filename in filenames
+                       if symbols.is_indexed(filename)])
+
+    def _clear_symbols(self, c, filename):
+        c.execute("""delete from symbols where file_id in
+            (select file_id from symbol_files where filename=?)""",
+            (filename,))
+        c.execute("delete from symbol_files where filename=?", (filename,))
+
+    def _forget_symbols(self, c, filename):
+        self._clear_symbols(c, filename)
+        c.execute("delete from symbol_dirty where filename=?", (filename,))
+
+    def _log_changes(self, c, action, paths):
+        """Appends action ("add", "modify" or "delete") for each of
+        paths to the change log."""
+        c.executemany("insert into changes values (null, ?, ?)",
+                      [(action, path) for path in paths
+                       if not _is_vcs_path(path)])
+        seq, compacted = c.execute("""select max(seq),
+            (select compacted from change_info) from changes""").fetchone()
+        if seq is not None and seq - compacted > CHANGE_LOG_SIZE:
+            self._compact_changes(c, seq)
+
+    def _compact_changes(self, c, seq):
+        """Drops the entries for files that have a later entry, and
+        then the oldest entries, to get the log down to
+        CHANGE_LOG_SIZE. The entries for directories are kept, because
+        the deletion of a directory says something about the files
+        in it as well."""
+        c.execute("""delete from changes where substr(path, -1) != '/'
+            and seq not in (select max(seq) from changes group by path)""")
+        count = c.execute("select count(*) from changes").fetchone()[0]
+        if count > CHANGE_LOG_SIZE:
+            oldest_kept = c.execute("""select seq from changes order by seq
+                limit 1 offset ?""", (count - CHANGE_LOG_SIZE,)).fetchone()[0]
+            c.execute("delete from changes where seq < ?", (oldest_kept,))
+            c.execute("update change_info set truncated=?",
+                      (oldest_kept - 1,))
+        c.execute("update change_info set compacted=?", (seq,))
+
+    def _reset_changes(self, c):
+        """Empties the change log, so that every client has to start
+        over with a full listing. Used when the file list itself is
+        rebuilt from scratch."""
+        c.execute("insert into changes values (null, 'reset', '')")
+        c.execute("""update change_info set truncated=(select max(seq)
+            from changes), compacted=(select max(seq) from changes)""")
+        c.execute("delete from changes")
+
+    def log_directory(self, dirname):
+        """Records the creation of a directory (which ends in a
+        slash) in the change log."""
+        c = self.connection.cursor()
+        self._log_changes(c, "add", [dirname])
+        self._commit()
+        c.close()
+
+    def changes_since(self, cursor=None, limit=None):
+        """Returns the changes to the file list made after cursor
+        (a string returned by an earlier call), up to limit of them.
+        The result is a dictionary: changes is a list of (action,
+        path), cursor is the cursor to pass next time, and reset is
+        True if the changes since cursor are no longer known, in
+        which case the client should list the files again. "add" and
+        "modify" both mean that the file now exists, because older
+        entries for a file are dropped when the log is compacted.
+        To start, get a cursor (with no cursor given) before listing
+        the files."""
+        c = self.connection.cursor()
+        epoch = c.execute("select epoch from search_info").fetchone()[0]
+        truncated = c.execute("select truncated from change_info").fetchone()[0]
+        seq = None
+        if cursor:
+            cursor_epoch, sep, cursor_seq = cursor.rpartition("-")
+            if cursor_epoch == epoch and cursor_seq.isdigit() \
+                    and int(cursor_seq) >= truncated:
+                seq = int(cursor_seq)
+
+        if seq is None:
+            latest = c.execute("select max(seq) from changes").fetchone()[0]
+            c.close()
+            return dict(changes=[], reset=True,
+                        cursor="%s-%s" % (epoch, latest or truncated))
+
+        query = "select seq, action, path from changes where seq > ? " \
+                "order by seq"
+        params = (seq,)
+        if limit:
+            query += " limit ?"
+            params += (limit,)
+        changes = []
+        for seq, action, path in c.execute(query, params):
+            changes.append((action, path))
+        c.close()
+        return dict(changes=changes, reset=False,
+                    cursor="%s-%s" % (epoch, seq))
+
+    def symbols_pending(self):
+        """Returns True if there are files to index for symbols."""
+        c = self.connection.cursor()
+        row = c.execute("select 1 from symbol_dirty limit 1").fetchone()
+        c.close()
+        return row is not None
+
+    def get_hash(self, filename, stat):
+        """Returns the hash recorded for filename, if it was recorded
+        when the file had the inode, size and mtime in stat, or None.
+        Like git's index, a hash recorded within SCAN_MTIME_SLACK of
+        the mtime is not trusted, because the file could have been
+        written again since without its mtime moving."""
+        c = self.connection.cursor()
+        row = c.execute("""select hash from file_hashes
+            where filename=? and inode=? and size=? and mtime=?
+            and mtime < recorded - ?""",
+            (filename, stat.st_ino, stat.st_size, stat.st_mtime,
+             SCAN_MTIME_SLACK)).fetchone()
+        c.close()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_hash(self, filename, digest, stat):
+        """Records the hash of filename, which has the inode, size and
+        mtime in stat."""
+        c = self.connection.cursor()
+        c.execute("""insert or replace into file_hashes
+            values (?, ?, ?, ?, ?, ?)""", (filename, digest, stat.st_ino,
+            stat.st_size, stat.st_mtime, time.time()))
+        self._commit()
+        c.close()
+
+    def get_link_time(self, filename, inode):
+        """Returns the time that filename was saved as a link to
+        the blob inode, or None if it was not."""
+        c = self.connection.cursor()
+        row = c.execute("""select saved from link_times
+            where filename=? and inode=?""", (filename, inode)).fetchone()
+        c.close()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_link_times(self, files):
+        """Records now as the time that the files, a list of
+        (filename, inode), were saved as links to blobs."""
+        now = time.time()
+        c = self.connection.cursor()
+        c.executemany("insert or replace into link_times values (?, ?, ?)",
+                      [(filename, inode, now) for filename, inode in files])
+        self._commit()
+        c.close()
+
+    @property
+    def search_generation(self):
+        """The (epoch, generation) pair that identifies the
+        current state of the file list."""
+        c = self.connection.cursor()
+        c.execute("select epoch, generation from search_info")
+        result = c.fetchone()
+        c.close()
+        return result
+
+    def cache_add(self, filename, size=0):
+        """Add the file to the search cache. Version control files
+        are left out, as they are by the scans."""
+        if _is_vcs_path(filename):
+            return
         conn = self.connection
         c = conn.cursor()
         c.execute("""insert into search_cache values (?)""", (filename,))
-        conn.commit()
+        self._index_file(c, c.lastrowid, filename)
+        self._record_size(c, filename, size)
+        self._mark_for_symbols(c, [filename])
+        self._log_changes(c, "add", [filename])
+        self._bump_generation(c)
+        self._commit()
+        c.close()
+
+    def cache_import(self, added, resized):
+        """Record a batch of saved files in a single transaction.
+        added and resized are lists of (filename, size) for new
+        files and for files that were already in the cache."""
+        conn = self.connection
+        c = conn.cursor()
+        for filename, size in added:
+            if _is_vcs_path(filename):
+                continue
+            c.execute("""insert into search_cache values (?)""", (filename,))
+            self._index_file(c, c.lastrowid, filename)
+            self._record_size(c, filename, size)
+        for filename, size in resized:
+            self._record_size(c, filename, size)
+        self._mark_for_symbols(c, [filename for filename, size
+                                   in added + resized])
+        self._log_changes(c, "add", [filename for filename, size in added])
+        self._log_changes(c, "modify",
+                          [filename for filename, size in resized])
+        if added:
+            self._bump_generation(c)
+        self._commit()
+        c.close()
+
+    def cache_set_size(self, filename, size):
+        """Record the new size of a file that is already in the cache."""
+        conn = self.connection
+        c = conn.cursor()
+        self._record_size(c, filename, size)
+        self._mark_for_symbols(c, [filename])
+        self._log_changes(c, "modify", [filename])
+        self._commit()
         c.close()
 
     def cache_delete(self, filename, recursive=False):
@@ -931,38 +2259,197 @@ class ProjectMetadata(dict):
         c = conn.cursor()
 
         if recursive:
-            op = " LIKE "
-            if filename.endswith("/"):
-                filename = filename[:-1]
-            filename += "%"
+            if not filename.endswith("/"):
+                filename += "/"
+            self._delete_tree(c, filename)
         else:
-            op = "="
-
-        c.execute("""delete from search_cache where filename%s?""" % op, (filename,))
-        conn.commit()
+            c.execute("""delete from search_chars where file_id in
+                (select rowid from search_cache where filename=?)""",
+                (filename,))
+            c.execute("delete from search_cache where filename=?", (filename,))
+            c.execute("delete from file_hashes where filename=?", (filename,))
+            c.execute("delete from link_times where filename=?", (filename,))
+            self._forget_symbols(c, filename)
+            self._forget_size(c, filename)
+            self._log_changes(c, "delete", [filename])
+        self._bump_generation(c)
+        self._commit()
         c.close()
 
+    def _delete_tree(self, c, dirname):
+        """Removes everything under dirname (which ends in a slash)
+        from the search cache and the scan snapshot."""
+        if isinstance(dirname, str):
+            dirname = dirname.decode("utf-8")
+        row = c.execute("select size, files from dir_totals where dirname=?",
+                        (dirname,)).fetchone()
+        if row is not None and dirname:
+            self._add_to_totals(c, _dirname_of(dirname[:-1]), -row[0], -row[1])
+        params = (len(dirname), dirname)
+        c.execute("""delete from search_chars where file_id in
+            (select rowid from search_cache
+             where substr(filename, 1, ?)=?)""", params)
+        c.execute("delete from search_cache where substr(filename, 1, ?)=?",
+                  params)
+        c.execute("delete from scan_files where substr(filename, 1, ?)=?",
+                  params)
+        c.execute("delete from file_hashes where substr(filename, 1, ?)=?",
+                  params)
+        c.execute("delete from link_times where substr(filename, 1, ?)=?",
+                  params)
+        c.execute("""delete from symbols where file_id in
+            (select file_id from symbol_files
+             where substr(filename, 1, ?)=?)""", params)
+        c.execute("delete from symbol_files where substr(filename, 1, ?)=?",
+                  params)
+        c.execute("delete from symbol_dirty where substr(filename, 1, ?)=?",
+                  params)
+        c.execute("delete from scan_dirs where substr(dirname, 1, ?)=?",
+                  params)
+        c.execute("delete from dir_totals where substr(dirname, 1, ?)=?",
+                  params)
+        self._log_changes(c, "delete", [dirname])
+
     def cache_replace(self, files):
         """Replace the entire search cache with the list of files provided."""
         conn = self.connection
         c = conn.cursor()
+        c.execute("delete from search_chars")
         c.execute("delete from search_cache")
         for filename in files:
             c.execute("""insert into search_cache values (?)""", (filename,))
-        conn.commit()
+            self._index_file(c, c.lastrowid, filename)
+        self._reset_changes(c)
+        self._bump_generation(c)
+        self._commit()
         c.close()
 
-    def search_files(self, search_expr):
-        """Search the file list with the given regular expression."""
+    def rescan(self, full=False):
+        """Brings the search cache and the scan snapshot up to date
+        with the files on disk. Returns a tuple of the space used by
+        the project and the change in space used since the last scan.
+        The change is None if there was no snapshot to compare against.
+
+        Every directory is stat()ed, but unless full is True, only
+        directories whose mtime differs from the snapshot are listed
+        and have their files stat()ed. Adding, removing or renaming an
+        entry changes the directory's mtime. Rewriting a file in place
+        does not, so the size of such a file is only picked up by a
+        full rescan or once something else in its directory changes
+        (save_file records the new size itself)."""
         conn = self.connection
-        # the sqlite REGEXP support needs a supplied regexp function
-        if not self._regexp_initialized:
-            conn.create_function("regexp", 2, _regexp)
         c = conn.cursor()
-        rs = c.execute(
-            "SELECT filename FROM search_cache WHERE filename REGEXP ?",
-            (search_expr,))
-        result = [item[0] for item in rs]
+        location = self.project_location.decode("utf-8")
+        known_dirs = dict(c.execute("select dirname, mtime from scan_dirs"))
+        if known_dirs:
+            before = self._total_size(c)
+        else:
+            # without a snapshot, there is nothing to diff against
+            before = None
+            c.execute("delete from search_chars")
+            c.execute("delete from search_cache")
+            c.execute("delete from scan_files")
+            c.execute("delete from dir_totals")
+            self._reset_changes(c)
+
+        children = {}
+        for dirname in known_dirs:
+            if dirname:
+                children.setdefault(_dirname_of(dirname[:-1]), []).append(dirname)
+
+        changed = False
+        too_recent = time.time() - SCAN_MTIME_SLACK
+        pending = [""]
+        while pending:
+            dirname = pending.pop()
+            dirloc = os.path.join(location, dirname)
+            mtime = os.stat(dirloc).st_mtime
+            if not full and known_dirs.get(dirname) == mtime:
+                pending.extend(children.get(dirname, []))
+                continue
+            if before is not None and dirname not in known_dirs:
+                self._log_changes(c, "add", [dirname])
+
+            old_files = dict(c.execute(
+                "select filename, size from scan_files where dirname=?",
+                (dirname,)))
+            old_dirs = set(children.get(dirname, []))
+            for name in os.listdir(dirloc):
+                if isinstance(name, str):
+                    # not valid utf-8, so it cannot be in the cache
+                    continue
+                relpath = dirname + name
+                if _is_vcs_path(relpath) or name.startswith(UPLOAD_PREFIX):
+                    continue
+                fullpath = os.path.join(dirloc, name)
+                if os.path.isfile(fullpath):
+                    size = os.path.getsize(fullpath)
+                    old_size = old_files.pop(relpath, None)
+                    if old_size is None:
+                        c.execute("insert into search_cache values (?)",
+                                  (relpath,))
+                        self._index_file(c, c.lastrowid, relpath)
+                        self._record_size(c, relpath, size)
+                        self._mark_for_symbols(c, [relpath])
+                        if before is not None:
+                            self._log_changes(c, "add", [relpath])
+                        changed = True
+                    elif old_size != size:
+                        self._record_size(c, relpath, size)
+                        self._mark_for_symbols(c, [relpath])
+                        self._log_changes(c, "modify", [relpath])
+                elif os.path.isdir(fullpath):
+                    relpath += "/"
+                    old_dirs.discard(relpath)
+                    pending.append(relpath)
+
+            for filename in old_files:
+                c.execute("""delete from search_chars where file_id in
+                    (select rowid from search_cache where filename=?)""",
+                    (filename,))
+                c.execute("delete from search_cache where filename=?",
+                          (filename,))
+                self._forget_size(c, filename)
+                self._forget_symbols(c, filename)
+                self._log_changes(c, "delete", [filename])
+                changed = True
+            for removed in old_dirs:
+                self._delete_tree(c, removed)
+                changed = True
+
+            # a directory that changed within the mtime granularity
+            # could change again without its mtime moving, so it will
+            # be listed again next time
+            if mtime > too_recent:
+                mtime = -1
+            c.execute("insert or replace into scan_dirs values (?, ?)",
+                      (dirname, mtime))
+
+        if changed:
+            self._bump_generation(c)
+        space_used = self._total_size(c)
+        self._commit()
+        c.close()
+        if before is None:
+            return space_used, None
+        return space_used, space_used - before
+
+    def search_files(self, query):
+        """Returns the files with basenames that contain the characters
+        of query in order. The query should already be lower case.
+        The candidates are the files that have every character of
+        the query in the index."""
+        conn = self.connection
+        c = conn.cursor()
+        chars = tuple(set(query))
+        if chars:
+            candidates = " intersect ".join(
+                ["select file_id from search_chars where ch=?"] * len(chars))
+            rs = c.execute("""select filename from search_cache
+                where rowid in (%s)""" % candidates, chars)
+        else:
+            rs = c.execute("select filename from search_cache")
+        result = [item[0] for item in rs if _matches_query(query, item[0])]
         c.close()
         return result
 
@@ -1004,24 +2491,27 @@ class ProjectMetadata(dict):
     def __setitem__(self, key, value):
         conn = self.connection
         c = conn.cursor()
-        c.execute("delete from keyvalue where key=?", (key,))
-        c.execute("""insert into keyvalue (key, value) values (?, ?) """,
-                    (key, value))
-        conn.commit()
+        c.execute("""insert or replace into keyvalue (key, value)
+                     values (?, ?)""", (key, value))
+        self._commit()
         c.close()
 
     def __delitem__(self, key):
         conn = self.connection
         c = conn.cursor()
         c.execute("delete from keyvalue where key=?", (key,))
-        conn.commit()
+        self._commit()
         c.close()
 
     def close(self):
-        """Close the metadata database."""
+        """Give the metadata database connection back to the pool,
+        committing anything that is still pending."""
         if self._connection:
-            self._connection.close()
+            connection = self._connection
             self._connection = None
+            self._batch_depth = 0
+            connection.commit()
+            _metadata_pool.checkin(self.filename, connection)
 
     def __del__(self):
         self.close()
@@ -90,6 +90,7 @@ def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=
             # reply and action are somewhat nasty but needed to allow the
             # profiler to run code by a "action()" string. Why?
             reply = []
+            environ['bespin.docommit'] = True
             def action():
                 if auth and 'REMOTE_USER' not in environ:
                     response = Response(status='401')
@@ -115,8 +116,6 @@ def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=
                         log.error("WARNING: The anti CSRF attack trip wire just went off. This means an unprotected request has been made. This could be a hacking attempt, or incomplete protection. The request has NOT been halted")
                         config.c.stats.incr("csrf_fail_DATE")
 
-                # Do we need to do this?
-                user = request.user
                 _add_base_headers(response)
                 try:
                     reply.append(func(request, response))
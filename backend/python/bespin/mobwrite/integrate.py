@@ -22,6 +22,7 @@
 #
 
 from bespin.database import User, get_project
+from bespin.database import NO_ACCESS, WRITE_ACCESS
 import logging
 
 log = logging.getLogger("mobwrite.integrate")
@@ -86,13 +87,12 @@ class Persister:
 
             if user == owner:
                 return Access.ReadWrite
-            if user != owner:
-                if owner.is_project_shared(project_name, user, require_write=True):
-                    return Access.ReadWrite
-                if owner.is_project_shared(project_name, user, require_write=False):
-                    return Access.ReadOnly
-                else:
-                    return Access.Denied
+            level = owner.project_access(project_name, user)
+            if level == WRITE_ACCESS:
+                return Access.ReadWrite
+            if level != NO_ACCESS:
+                return Access.ReadOnly
+            return Access.Denied
         except:
             log.exception("Error in Persister.check_access() for name=%s, handle=%s", 
                             name, handle)
@@ -114,19 +114,22 @@ class BeanstalkQueue(object):
         else:
             self.conn = beanstalkc.Connection(host=host, port=port)
 
-    def enqueue(self, name, message, execute, error_handler, use_db):
+    def enqueue(self, name, message, execute, error_handler, use_db,
+                delay=0):
         message['__execute'] = execute
         message['__error_handler'] = error_handler
         message['__use_db'] = use_db
+        message['__queue'] = name
         c = self.conn
         c.use(name)
-        id = c.put(simplejson.dumps(message))
+        id = c.put(simplejson.dumps(message), delay=delay)
         return id
 
-    def read_queue(self, name):
+    def read_queue(self, *names):
         c = self.conn
-        log.debug("Starting to read %s on %s", name, c)
-        c.watch(name)
+        log.debug("Starting to read %s on %s", ", ".join(names), c)
+        for name in names:
+            c.watch(name)
 
         while True:
             log.debug("Reserving next job")
@@ -137,6 +140,7 @@ class BeanstalkQueue(object):
                 execute = message.pop('__execute')
                 error_handler = message.pop('__error_handler')
                 use_db = message.pop('__use_db')
+                name = message.pop('__queue', names[0])
                 qi = QueueItem(item.jid, name, message,
                                 execute, error_handler=error_handler,
                                 job=item, use_db=use_db)
@@ -150,10 +154,14 @@ def _resolve_function(namestring):
     module = __import__(modulename, fromlist=[funcname])
     return getattr(module, funcname)
 
-def enqueue(queue_name, message, execute, error_handler=None, use_db=True):
+def enqueue(queue_name, message, execute, error_handler=None, use_db=True,
+            delay=0):
+    """Runs the job named by execute with the message. With a queue
+    configured, the job runs asynchronously, starting no sooner than
+    delay seconds from now. Otherwise, it runs right away."""
     if config.c.queue:
         id = config.c.queue.enqueue(queue_name, message, execute,
-                                    error_handler, use_db)
+                                    error_handler, use_db, delay)
         log.debug("Running job asynchronously (%s)", id)
         return id
     else:
@@ -178,9 +186,15 @@ def process_queue(args=None):
 
     config.activate_profile()
 
+    # the remaining arguments name the queues to work on; a worker
+    # of its own can be run for the trash purges, for instance
+    if not args:
+        from bespin import filesystem
+        args = ["vcs", filesystem.TRASH_QUEUE]
+
     bq = config.c.queue
     log.debug("Queue: %s", bq)
-    for qi in bq.read_queue("vcs"):
+    for qi in bq.read_queue(*args):
         log.info("Processing job %s", qi.id)
         log.debug("Message: %s", qi.message)
         qi.run()
@@ -0,0 +1,168 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Serving the frontend's static files.
+
+The static files are answered by static_middleware, in front of the
+authentication and database middleware that the rest of the
+application needs."""
+
+import os
+import re
+import time
+import rfc822
+from wsgiref import util
+
+import static
+
+# files whose names carry a content hash, like dojo.0f3c9a12.js, are
+# never changed in place and can be cached forever
+FINGERPRINT = re.compile(r"\.[0-9a-fA-F]{8,}\.\w+$")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class StaticFiles(static.Cling):
+    """A static.Cling that sends strong ETags and Content-Length,
+    serves the gzipped copy of a file (file.js.gz next to file.js)
+    to the clients that accept it and lets clients cache fingerprinted
+    files forever. Bodies go out through wsgi.file_wrapper when the
+    server has one, which lets it use sendfile."""
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            headers = [('Allow', 'GET, HEAD')]
+            return self.method_not_allowed(environ, start_response, headers)
+        path_info = environ.get('PATH_INFO', '')
+        full_path = self._full_path(path_info)
+        if not self._is_under_root(full_path):
+            return self.not_found(environ, start_response)
+        if os.path.isdir(full_path):
+            if full_path[-1] != '/' or full_path == self.root:
+                location = util.request_uri(environ, include_query=False) + '/'
+                if environ.get('QUERY_STRING'):
+                    location += '?' + environ.get('QUERY_STRING')
+                headers = [('Location', location)]
+                return self.moved_permanently(environ, start_response, headers)
+            full_path = self._full_path(path_info + self.index_file)
+
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return self.not_found(environ, start_response)
+
+        last_modified = rfc822.formatdate(stat.st_mtime)
+        headers = [('Date', rfc822.formatdate(time.time())),
+                   ('Last-Modified', last_modified)]
+        send_path = full_path
+        etag_suffix = ""
+        gz_stat = self._gzipped(full_path, stat)
+        if gz_stat is not None:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if _accepts_gzip(environ):
+                send_path = full_path + ".gz"
+                stat = gz_stat
+                etag_suffix = "-gz"
+                headers.append(('Content-Encoding', 'gzip'))
+        # the gzipped copy is a different entity, with its own ETag
+        etag = '"%x-%x%s"' % (int(stat.st_mtime), stat.st_size, etag_suffix)
+        headers.append(('ETag', etag))
+        if FINGERPRINT.search(full_path):
+            headers.append(('Cache-Control', IMMUTABLE_CACHE_CONTROL))
+
+        if_none = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none:
+            if if_none.strip() == '*' or etag in _etags(if_none):
+                return self.not_modified(environ, start_response, headers)
+        else:
+            if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
+            if if_modified and (rfc822.parsedate(if_modified)
+                                >= rfc822.parsedate(last_modified)):
+                return self.not_modified(environ, start_response, headers)
+
+        try:
+            file_like = self._file_like(send_path)
+        except IOError:
+            return self.not_found(environ, start_response)
+        headers.append(('Content-Type', self._guess_type(full_path)))
+        headers.append(('Content-Length', str(stat.st_size)))
+        start_response("200 OK", headers)
+        if environ['REQUEST_METHOD'] == 'GET':
+            return self._body(send_path, environ, file_like)
+        file_like.close()
+        return ['']
+
+    def _gzipped(self, full_path, stat):
+        """Returns the stat of the gzipped copy of full_path, or None
+        if there is none that is up to date."""
+        try:
+            gz_stat = os.stat(full_path + ".gz")
+        except OSError:
+            return None
+        if gz_stat.st_mtime < stat.st_mtime:
+            return None
+        return gz_stat
+
+def _accepts_gzip(environ):
+    """Returns True if the client takes gzip content encoding."""
+    for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def _etags(header):
+    """Returns the ETags listed in an If-None-Match header, which
+    compares them weakly."""
+    result = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        result.append(etag)
+    return result
+
+def static_middleware(app, relay, static_apps):
+    """Answers the GET and HEAD requests that the URLRelay relay sends
+    to one of static_apps directly, without going through app. The
+    other requests are passed on to app."""
+    static_apps = list(static_apps)
+    def wrapped(environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path_info = environ.get('PATH_INFO', '')
+        if method in ('GET', 'HEAD') and not path_info.startswith("/getscript"):
+            try:
+                static_app = relay.resolve(path_info, method)[0]
+            except ImportError:
+                static_app = None
+            if static_app in static_apps:
+                return static_app(environ, start_response)
+        return app(environ, start_response)
+    return wrapped
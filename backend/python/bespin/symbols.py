@@ -0,0 +1,208 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""The symbol index, for "go to definition" within a project.
+
+The functions, classes and variables defined in a project's
+JavaScript, Python and CSS files are kept in the symbol tables of the
+project metadata (see ProjectMetadata._create_symbol_index). Whenever
+the metadata learns of a new or changed file (on save, import or
+rescan), it marks the file in symbol_dirty, and the project queues the
+index_project job, which extracts the symbols of just the marked
+files. Deleted files and directories have their symbols removed right
+away by the metadata."""
+from __future__ import with_statement
+
+import os
+import re
+import logging
+
+log = logging.getLogger("bespin.symbols")
+
+# files larger than this are not indexed
+MAX_FILE_SIZE = 1000000
+
+_python_patterns = [
+    (re.compile(r"^[ \t]*class[ \t]+(\w+)", re.M), "class"),
+    (re.compile(r"^[ \t]*def[ \t]+(\w+)", re.M), "function"),
+    (re.compile(r"^(\w+)[ \t]*=(?!=)", re.M), "variable"),
+]
+
+_js_patterns = [
+    (re.compile(r"""\bdojo\.declare\(\s*["']([\w.$]+)["']"""), "class"),
+    (re.compile(r"\bclass[ \t]+([\w$]+)"), "class"),
+    (re.compile(r"\bfunction[ \t]+([\w$]+)[ \t]*\("), "function"),
+    (re.compile(r"(?<![\w$])([\w$]+)[ \t]*[:=][ \t]*function\b"), "function"),
+    (re.compile(r"\b(?:var|let|const)[ \t]+([\w$]+)"), "variable"),
+]
+
+_css_selector = re.compile(r"^([^{}@/]+)\{", re.M)
+_css_name = re.compile(r"[.#][\w-]+")
+
+def _extract_with(patterns, data):
+    result = []
+    for pattern, kind in patterns:
+        for match in pattern.finditer(data):
+            result.append((match.group(1), kind, match.start(1)))
+    return result
+
+def _extract_css(data):
+    result = []
+    for match in _css_selector.finditer(data):
+        offset = match.start(1)
+        for name in _css_name.finditer(match.group(1)):
+            result.append((name.group(0), "selector", offset + name.start()))
+    return result
+
+_extractors = {
+    ".py": lambda data: _extract_with(_python_patterns, data),
+    ".js": lambda data: _extract_with(_js_patterns, data),
+    ".css": _extract_css,
+}
+
+def is_indexed(filename):
+    """Returns True for the files whose symbols are indexed."""
+    return os.path.splitext(filename)[1].lower() in _extractors
+
+def extract(filename, data):
+    """Returns a sorted list of (name, kind, line number) for the
+    definitions in data, the contents of filename."""
+    extractor = _extractors.get(os.path.splitext(filename)[1].lower())
+    if extractor is None:
+        return []
+    result = set()
+    for name, kind, offset in extractor(data):
+        result.add((name, kind, data.count("\n", 0, offset) + 1))
+    return sorted(result, key=lambda item: (item[2], item[0]))
+
+def update(metadata, location):
+    """Indexes the files that the metadata marked, which are relative
+    to location (the project directory). Returns the number of files
+    looked at. A file that is marked again while this runs keeps its
+    new mark, for the next update."""
+    c = metadata.connection.cursor()
+    dirty = list(c.execute("select filename, seq from symbol_dirty"))
+    if not dirty:
+        c.close()
+        return 0
+
+    found = []
+    for filename, seq in dirty:
+        fullpath = os.path.join(location, filename.encode("utf-8"))
+        try:
+            if os.path.getsize(fullpath) > MAX_FILE_SIZE:
+                data = None
+            else:
+                data = open(fullpath, "rb").read()
+        except (IOError, OSError):
+            # removed since it was marked
+            data = None
+        if data is None:
+            found.append((filename, seq, []))
+            continue
+        try:
+            data = data.decode("utf-8")
+        except UnicodeDecodeError:
+            data = data.decode("latin-1")
+        found.append((filename, seq, extract(filename, data)))
+
+    with metadata.batch():
+        for filename, seq, definitions in found:
+            c.execute("delete from symbol_dirty where filename=? and seq=?",
+                      (filename, seq))
+            if not c.rowcount:
+                # marked again or removed since it was read
+                continue
+            metadata._clear_symbols(c, filename)
+            if definitions:
+                c.execute("insert into symbol_files values (null, ?)",
+                          (filename,))
+                file_id = c.lastrowid
+                c.executemany("insert into symbols values (?, ?, ?, ?, ?)",
+                    [(name, name.lower(), kind, file_id, line)
+                     for name, kind, line in definitions])
+    c.close()
+    return len(found)
+
+def index_project(qi):
+    """Runs update for the project in the message."""
+    from path import path as path_obj
+    from bespin import filesystem
+    message = qi.message
+    project = filesystem.Project(None, message['project'],
+                                 path_obj(message['location']))
+    try:
+        count = update(project.metadata, project.location)
+        log.debug("Indexed symbols in %s files of %s", count, project.name)
+    finally:
+        project.metadata.close()
+
+def _rank(query, name):
+    """Sorts exact matches first, then prefixes, then names that
+    contain the query, then the other fuzzy matches, with shorter
+    names first within each."""
+    lname = name.lower()
+    if lname == query:
+        rank = 0
+    elif lname.startswith(query):
+        rank = 1
+    elif query in lname:
+        rank = 2
+    else:
+        rank = 3
+    return (rank, len(name), name)
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def find(metadata, query, limit=20):
+    """Returns up to limit of the symbols whose names start with
+    query or, failing that, contain its characters in order (ignoring
+    case), as a list of dictionaries with name, kind, file and line.
+    Prefix matches come from the index on the lower case names; the
+    fuzzy matches are only looked for when there are not enough of
+    those. Both queries order their matches the way _rank does, so
+    that only the best limit of them are fetched."""
+    query = query.lower()
+    if not query:
+        return []
+    c = metadata.connection.cursor()
+    select = """select name, kind, filename, line from symbols
+        join symbol_files using (file_id) where """
+    # the upper bound of the names that start with query
+    prefix_end = query[:-1] + unichr(ord(query[-1]) + 1)
+    rows = c.execute(select + """lname >= ? and lname < ?
+        order by lname = ? desc, length(name), name limit ?""",
+        (query, prefix_end, query, limit)).fetchall()
+    if len(rows) < limit:
+        fuzzy = "%" + "%".join(_escape_like(ch) for ch in query) + "%"
+        contains = "%" + _escape_like(query) + "%"
+        rows.extend(c.execute(select + """lname like ? escape '\\'
+            and not (lname >= ? and lname < ?)
+            order by lname like ? escape '\\' desc, length(name), name
+            limit ?""", (fuzzy, query, prefix_end, contains,
+                         limit - len(rows))))
+    c.close()
+    rows.sort(key=lambda row: _rank(query, row[0]))
+    return [dict(name=name, kind=kind, file=filename, line=line)
+            for name, kind, filename, line in rows]
@@ -25,10 +25,17 @@
 #from webtest import TestApp
 #import simplejson
 
+import time
+
 import simplejson
-from bespin import config, controllers
+from sqlalchemy import create_engine
+from sqlalchemy.interfaces import ConnectionProxy
+from bespin import config, controllers, database
 from bespin.filesystem import get_project
-from bespin.database import User, Base, ConflictError
+from bespin.database import User, Base, ConflictError, UserSharing
+from bespin.database import GroupMembership, GroupSharing
+from bespin.database import NO_ACCESS, READ_ACCESS, WRITE_ACCESS
+from bespin.mobwrite.integrate import Persister, Access
 
 from nose.tools import assert_equals
 from __init__ import BespinTestApp
@@ -48,6 +55,7 @@ def setup_module(module):
     _reset()
 
 def _reset():
+    database._acl_cache.clear()
     Base.metadata.drop_all(bind=config.c.dbengine)
     Base.metadata.create_all(bind=config.c.dbengine)
     fsroot = config.c.fsroot
@@ -78,6 +86,29 @@ def _reset():
     app = BespinTestApp(app)
     app.post("/register/login/joe", dict(password="joe"))
 
+class _StatementCounter(ConnectionProxy):
+    def __init__(self):
+        self.count = 0
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        self.count += 1
+        return execute(cursor, statement, parameters, context)
+
+def _count_queries(url):
+    """Returns the number of SQL statements run to GET url."""
+    counter = _StatementCounter()
+    # the same database connections, counted
+    engine = create_engine(config.c.dburl, pool=config.c.dbengine.pool,
+                           proxy=counter)
+    session = config.c.session_factory()
+    session.bind = engine
+    try:
+        app.get(url)
+    finally:
+        session.bind = config.c.dbengine
+    return counter.count
+
 def _followed_names(connections):
     return set([connection.followed.username for connection in connections])
 
@@ -277,6 +308,141 @@ def test_sharing():
 
     joes_project.delete()
 
+def test_project_access_levels():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    assert_equals(joe.project_access(joes_project, ev), NO_ACCESS)
+
+    joe.add_sharing(joes_project, ev, False, False)
+    assert_equals(joe.project_access(joes_project, ev), READ_ACCESS)
+    assert_equals(joe.project_access("joes_project", mattb), NO_ACCESS)
+
+    homies = joe.get_group("homies", create_on_not_found=True)
+    joe.add_sharing(joes_project, homies, True, False)
+    assert_equals(joe.project_access(joes_project, mattb), NO_ACCESS)
+    homies.add_member(mattb)
+    homies.add_member(ev)
+    assert_equals(joe.project_access(joes_project, mattb), WRITE_ACCESS)
+    assert_equals(joe.project_access(joes_project, ev), WRITE_ACCESS)
+    assert joe.is_project_shared(joes_project, ev, require_write=True)
+
+    persister = Persister()
+    assert_equals(persister.check_access("joe/joes_project/foo", "ev:127.0.0.1"),
+                  Access.ReadWrite)
+    assert_equals(persister.check_access("joe/joes_project/foo", "tom:127.0.0.1"),
+                  Access.Denied)
+
+    homies.remove_member(ev)
+    assert_equals(joe.project_access(joes_project, ev), READ_ACCESS)
+    joe.remove_sharing(joes_project, homies)
+    assert_equals(joe.project_access(joes_project, mattb), NO_ACCESS)
+    joe.add_sharing(joes_project, 'everyone', False, False)
+    assert_equals(joe.project_access(joes_project, tom), READ_ACCESS)
+    joe.remove_sharing(joes_project)
+    assert_equals(joe.project_access(joes_project, ev), NO_ACCESS)
+    assert_equals(joe.project_access(joes_project, tom), NO_ACCESS)
+
+def test_project_access_is_cached():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    assert_equals(joe.project_access(joes_project, ev), NO_ACCESS)
+
+    # a share made behind the cache's back (as another process would)
+    # is only seen once the cached level expires
+    session.add(UserSharing(joe, "joes_project", ev, True, False))
+    session.flush()
+    assert_equals(joe.project_access(joes_project, ev), NO_ACCESS)
+    old_seconds = database.ACL_CACHE_SECONDS
+    database._acl_cache.clear()
+    database.ACL_CACHE_SECONDS = 0
+    try:
+        assert_equals(joe.project_access(joes_project, ev), WRITE_ACCESS)
+    finally:
+        database.ACL_CACHE_SECONDS = old_seconds
+
+def test_levels_cached_before_a_commit_do_not_outlive_it():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    joe.add_sharing(joes_project, ev, True, False)
+    session.commit()
+    assert_equals(joe.project_access(joes_project, ev), WRITE_ACCESS)
+
+    joe.remove_sharing(joes_project, ev)
+    # another request looks the level up before the revocation is
+    # committed, and caches the old level
+    key = (joe.id, "joes_project", ev.id)
+    database._acl_cache[key] = (time.time() + 30, database._acl_generation,
+                                WRITE_ACCESS)
+    session.commit()
+    assert_equals(joe.project_access(joes_project, ev), NO_ACCESS)
+
+    # nor does a level from a change that is rolled back
+    joe.add_sharing(joes_project, ev, True, False)
+    assert_equals(joe.project_access(joes_project, ev), WRITE_ACCESS)
+    session.rollback()
+    assert_equals(joe.project_access(joes_project, ev), NO_ACCESS)
+
+def _shared_names(user):
+    return [(project.owner.username, project.name)
+            for project in user.get_all_projects(True)
+            if project.owner != user]
+
+def test_shared_project_listing_follows_changes():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    get_project(joe, joe, "secret", create=True)
+    toms_project = get_project(tom, tom, "toms_project", create=True)
+    homies = joe.get_group("homies", create_on_not_found=True)
+    homies.add_member(ev)
+    joe.add_sharing(joes_project, homies, False, False)
+    tom.add_sharing(toms_project, 'everyone', False, False)
+    assert_equals(_shared_names(ev), [])
+
+    ev.follow(joe)
+    ev.follow(tom)
+    assert_equals(_shared_names(ev), [("joe", "joes_project"),
+                                      ("tom", "toms_project")])
+    homies.remove_member(ev)
+    assert_equals(_shared_names(ev), [("tom", "toms_project")])
+    homies.add_member(ev)
+    homies.remove()
+    assert_equals(_shared_names(ev), [("tom", "toms_project")])
+    # without relying on the database to cascade
+    session = config.c.session_factory()
+    assert_equals(session.query(GroupMembership)
+                  .filter_by(group_id=homies.id).count(), 0)
+    assert_equals(session.query(GroupSharing)
+                  .filter_by(invited_group_id=homies.id).count(), 0)
+    joe.add_sharing(joes_project, ev, False, False)
+    assert_equals(_shared_names(ev), [("joe", "joes_project"),
+                                      ("tom", "toms_project")])
+    ev.unfollow(tom)
+    assert_equals(_shared_names(ev), [("joe", "joes_project")])
+
+    # a deleted project is left out even though it is still shared
+    joes_project.delete()
+    assert_equals(_shared_names(ev), [])
+
+def test_listings_take_a_fixed_number_of_queries():
+    _reset()
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    homies = joe.get_group("homies", create_on_not_found=True)
+    joe.add_sharing(joes_project, homies, False, False)
+    urls = ["/network/followers/", "/group/list/homies/",
+            "/share/list/all/"]
+
+    def add_friend(user):
+        joe.follow(user)
+        homies.add_member(user)
+        joe.add_sharing(joes_project, user, False, False)
+        session.commit()
+
+    add_friend(mattb)
+    counts = [_count_queries(url) for url in urls]
+    for user in [zuck, tom, ev]:
+        add_friend(user)
+    assert_equals([_count_queries(url) for url in urls], counts)
+
 # Sharing tests
 def test_sharing_with_app():
     _reset()
@@ -24,14 +24,17 @@
 # 
 
 import os
+import time
+from hashlib import sha1
 from datetime import datetime, timedelta
 from urllib import urlencode
+from cStringIO import StringIO
 
 from __init__ import BespinTestApp
 import simplejson
 from path import path
 
-from bespin import config, controllers, filesystem
+from bespin import config, controllers, filesystem, blobstore, textsearch, symbols
 
 from bespin.filesystem import File, get_project, ProjectView
 from bespin.filesystem import FSException, FileNotFound, OverQuota, FileConflict, BadValue
@@ -145,7 +148,211 @@ def test_amount_used_can_be_recomputed():
     macgyver.amount_used = 0
     macgyver.recompute_files()
     assert macgyver.amount_used == starting_point
-    
+
+def _backdate_dirs(location):
+    old = time.time() - 3600
+    for d in [location] + list(location.walkdirs()):
+        os.utime(d, (old, old))
+
+def test_rescan_applies_changes_made_on_disk():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("top", "12345")
+    bigmac.save_file("deep/er/file", "123")
+    bigmac.save_file("gone/soon", "1")
+    bigmac.save_file(".hg/store", "not counted")
+    assert bigmac.scan_files() == 9
+    _backdate_dirs(bigmac.location)
+    starting_point = macgyver.amount_used
+
+    (bigmac.location / "deep" / "er" / "new_file").write_bytes("1234567")
+    (bigmac.location / "gone").rmtree()
+    assert bigmac.rescan() == 15
+    assert macgyver.amount_used == starting_point + 6
+    files = sorted(bigmac.metadata.get_file_list())
+    assert files == ["deep/er/file", "deep/er/new_file", "top"]
+    assert bigmac.search_files("nf") == ["deep/er/new_file"]
+
+    # a fresh snapshot gives the same answer
+    for table in ["scan_dirs", "scan_files"]:
+        bigmac.metadata.connection.execute("delete from %s" % table)
+    assert bigmac.scan_files() == 15
+    assert sorted(bigmac.metadata.get_file_list()) == files
+
+def test_rescan_skips_unchanged_directories():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a/b/c", "123")
+    bigmac.rescan()
+    _backdate_dirs(bigmac.location)
+    bigmac.rescan()
+
+    # a file changed in place behind our back is not noticed until
+    # something else changes in its directory
+    (bigmac.location / "a" / "b" / "c").write_bytes("1")
+    assert bigmac.rescan() == 3
+    (bigmac.location / "a" / "b" / "d").write_bytes("1234")
+    assert bigmac.rescan() == 5
+
+    # or until a full scan
+    _backdate_dirs(bigmac.location)
+    bigmac.rescan()
+    (bigmac.location / "a" / "b" / "c").write_bytes("123")
+    assert bigmac.rescan() == 5
+    assert bigmac.scan_files() == 7
+
+def test_recompute_files_finds_files_changed_in_place():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a/b/c", "123")
+    bigmac.rescan()
+    _backdate_dirs(bigmac.location)
+    bigmac.rescan()
+    (bigmac.location / "a" / "b" / "c").write_bytes("1234567")
+    starting_point = macgyver.amount_used
+    macgyver.recompute_files()
+    assert macgyver.amount_used == starting_point + 4
+
+def test_directory_totals_follow_changes():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("top", "12345")
+    bigmac.save_file("a/b/c", "123")
+    bigmac.save_file("a/b/d", "1")
+    bigmac.save_file("a/e", "12")
+    metadata = bigmac.metadata
+    assert metadata.dir_totals() == (11, 4)
+    assert metadata.dir_totals("a/") == (6, 3)
+    assert metadata.dir_totals("a/b/") == (4, 2)
+
+    bigmac.save_file("a/b/c", "1234567")
+    assert metadata.dir_totals("a/") == (10, 3)
+    bigmac.delete("a/e")
+    assert metadata.dir_totals("a/") == (8, 2)
+
+    starting_point = macgyver.amount_used
+    bigmac.delete("a/b/")
+    assert macgyver.amount_used == starting_point - 8
+    assert metadata.dir_totals("a/") == (0, 0)
+    assert metadata.dir_totals() == (5, 1)
+    assert bigmac.scan_files() == 5
+
+def test_directory_totals_for_unscanned_projects():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a/b", "123")
+    conn = bigmac.metadata.connection
+    conn.execute("drop table dir_totals")
+    conn.execute("delete from scan_dirs")
+    conn.commit()
+    bigmac.metadata._discard_connections()
+    (bigmac.location / "a" / "new").write_bytes("12")
+    bigmac = get_project(macgyver, macgyver, "bigmac")
+    assert bigmac.metadata.dir_totals("a/") == (5, 2)
+
+def test_blob_store_shares_identical_files():
+    _init_data()
+    config.c.blob_store = True
+    try:
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        other = get_project(macgyver, macgyver, "other", create=True)
+        bigmac.save_file("lib/jquery.js", "var jQuery;")
+        other.save_file("jquery.js", "var jQuery;")
+        first = (bigmac.location / "lib" / "jquery.js").stat()
+        second = (other.location / "jquery.js").stat()
+        assert first.st_ino == second.st_ino
+        assert first.st_nlink == 3
+
+        # saving replaces the link rather than writing through it
+        bigmac.save_file("lib/jquery.js", "var $;")
+        assert (other.location / "jquery.js").bytes() == "var jQuery;"
+        assert (bigmac.location / "lib" / "jquery.js").bytes() == "var $;"
+        assert bigmac.scan_files() == 6
+
+        handle = open(tarfilename)
+        bigmac.import_tarball("ut.tgz", handle)
+        handle.close()
+        handle = open(tarfilename)
+        other.import_tarball("ut.tgz", handle)
+        handle.close()
+        first = (bigmac.location / "config.js").stat()
+        second = (other.location / "config.js").stat()
+        assert first.st_ino == second.st_ino
+    finally:
+        config.c.blob_store = False
+
+    # a linked file is unlinked before it is written in place
+    other.save_file("jquery.js", "var jQuery = 1;")
+    assert (other.location / "jquery.js").stat().st_nlink == 1
+    blob = blobstore.blob_location(sha1("var jQuery;").hexdigest())
+    assert open(blob).read() == "var jQuery;"
+
+def test_linked_files_keep_their_own_mode_and_times():
+    _init_data()
+    config.c.blob_store = True
+    try:
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        other = get_project(macgyver, macgyver, "other", create=True)
+        bigmac.save_file("jquery.js", "var jQuery;")
+        blob = blobstore.blob_location(sha1("var jQuery;").hexdigest())
+        old = time.time() - 3600
+        os.utime(blob, (old, old))
+        other.save_file("jquery.js", "var jQuery;")
+        other.save_file_stream("copy.js", StringIO("var jQuery;"))
+    finally:
+        config.c.blob_store = False
+    mode = (other.location / "jquery.js").stat().st_mode & 0777
+    assert mode == blobstore.FILE_MODE
+    recently = datetime.now() - timedelta(minutes=1)
+    for name in ("jquery.js", "copy.js"):
+        file = other.get_file_object(name)
+        assert file.modified > recently
+        assert file.created > recently
+    assert bigmac.get_file_object("jquery.js").modified > recently
+
+def test_blob_store_garbage_collection():
+    _init_data()
+    config.c.blob_store = True
+    try:
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        bigmac.save_file("a", "shared contents")
+        bigmac.save_file("b", "shared contents")
+        bigmac.save_file("c", "only once")
+    finally:
+        config.c.blob_store = False
+    assert blobstore.collect_garbage() == 0
+    bigmac.delete("a")
+    assert blobstore.collect_garbage() == 0
+    bigmac.delete("c")
+    assert blobstore.collect_garbage() == 1
+    assert bigmac.get_file_object("b").data == "shared contents"
+
+def test_blob_store_falls_back_to_copying():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    opened = []
+    def track_open(*args):
+        handle = open(*args)
+        opened.append(handle)
+        return handle
+    def collect_and_fail(blob, destination):
+        # the blob is collected before it can be linked
+        blobstore.collect_garbage()
+        return False
+    link_into = blobstore.link_into
+    config.c.blob_store = True
+    blobstore.open = track_open
+    blobstore.link_into = collect_and_fail
+    try:
+        bigmac.save_file_stream("foo", StringIO("Some contents"))
+    finally:
+        config.c.blob_store = False
+        del blobstore.open
+        blobstore.link_into = link_into
+    assert (bigmac.location / "foo").bytes() == "Some contents"
+    assert (bigmac.location / "foo").stat().st_nlink == 1
+    assert opened and opened[0].closed
+
 def test_retrieve_file_obj():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -478,7 +685,30 @@ def test_file_search():
     _init_data()
     bigmac = _setup_search_data()
     _run_search_tests(bigmac.search_files)
-    
+
+def test_file_search_sees_new_and_deleted_files():
+    _init_data()
+    bigmac = _setup_search_data()
+    assert bigmac.search_files("bez") == []
+    bigmac.save_file("sub/bez_file", "hi")
+    assert bigmac.search_files("bez") == ["sub/bez_file"]
+    bigmac.delete("sub/")
+    assert bigmac.search_files("bez") == []
+    bigmac.delete("foo_bar")
+    assert bigmac.search_files("fb") == []
+
+def test_file_search_indexes_old_metadata():
+    _init_data()
+    bigmac = _setup_search_data()
+    conn = bigmac.metadata.connection
+    conn.execute("drop table search_chars")
+    conn.execute("drop table search_info")
+    conn.commit()
+    # the schema is only checked when a connection is opened
+    bigmac.metadata._discard_connections()
+    bigmac = get_project(macgyver, macgyver, "bigmac")
+    _run_search_tests(bigmac.search_files)
+
 def _run_search_tests(search_func):
     result = search_func("")
     assert result == [
@@ -621,6 +851,14 @@ def test_good_file_operations_from_web():
     assert data == []
     
     
+def test_directory_sizes_in_listing_from_web():
+    _init_data()
+    app.put("/file/at/bigmac/dir/a", "123")
+    app.put("/file/at/bigmac/dir/sub/b", "12345")
+    resp = app.get("/file/list/bigmac/")
+    data = simplejson.loads(resp.body)
+    assert data == [{'name' : 'dir/', 'size' : 8, 'files' : 2}]
+
 def test_error_conditions_from_web():
     _init_data()
     app.get("/file/at/bigmac/UNKNOWN", status=404)
@@ -694,6 +932,475 @@ def test_preview_mode():
     assert resp.body == "<html><body>Simple HTML file</body></html>"
     assert resp.content_type == "text/html"
     
+def test_range_requests_on_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("big.txt", "0123456789" * 10000)
+
+    resp = app.get("/file/at/bigmac/big.txt")
+    assert resp.body == "0123456789" * 10000
+    assert resp.headers['Content-Length'] == "100000"
+    assert resp.headers['Accept-Ranges'] == "bytes"
+
+    resp = app.get("/file/at/bigmac/big.txt",
+                   headers={"Range": "bytes=99995-99999"}, status=206)
+    assert resp.body == "56789"
+    assert resp.headers['Content-Range'] == "bytes 99995-99999/100000"
+
+    resp = app.get("/preview/at/bigmac/big.txt",
+                   headers={"Range": "bytes=3-"}, status=206)
+    assert resp.body == ("0123456789" * 10000)[3:]
+    assert resp.content_type == "text/plain"
+
+    app.get("/file/at/bigmac/big.txt",
+            headers={"Range": "bytes=200000-"}, status=416)
+
+def test_saving_the_same_contents_does_nothing():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo", "Some contents")
+    file_obj = bigmac.get_file_object("foo")
+    # just saved, so the file could change again within its mtime
+    assert file_obj.recorded_hash is None
+    assert file_obj.content_hash == sha1("Some contents").hexdigest()
+
+    os.utime(file_obj.location, (1000, 1000))
+    assert file_obj.recorded_hash is None
+    assert file_obj.content_hash == sha1("Some contents").hexdigest()
+    assert file_obj.recorded_hash == file_obj.content_hash
+    starting_point = macgyver.amount_used
+    bigmac.save_file("foo", "Some contents")
+    assert file_obj.location.mtime == 1000
+    bigmac.save_file_stream("foo", StringIO("Some contents"))
+    assert file_obj.location.mtime == 1000
+    assert macgyver.amount_used == starting_point
+
+    bigmac.save_file_stream("foo", StringIO("Other contents"))
+    assert file_obj.location.mtime != 1000
+    assert file_obj.content_hash == sha1("Other contents").hexdigest()
+    assert macgyver.amount_used == starting_point + 1
+
+def test_recent_hashes_are_not_trusted():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo", "aaaa")
+    file_obj = bigmac.get_file_object("foo")
+    mtime = time.time()
+    os.utime(file_obj.location, (mtime, mtime))
+    assert file_obj.content_hash == sha1("aaaa").hexdigest()
+
+    # rewritten within the same mtime tick, as a vcs pull could
+    file_obj.location.write_bytes("bbbb")
+    os.utime(file_obj.location, (mtime, mtime))
+    assert file_obj.content_hash == sha1("bbbb").hexdigest()
+    bigmac.save_file("foo", "aaaa")
+    assert file_obj.location.bytes() == "aaaa"
+
+def test_etags_on_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo", "Some contents")
+    etag = '"%s"' % sha1("Some contents").hexdigest()
+
+    resp = app.get("/file/at/bigmac/foo")
+    assert resp.headers['ETag'] == etag
+    assert "no-store" not in resp.headers['Cache-Control']
+    resp = app.get("/file/at/bigmac/foo",
+                   headers={"If-None-Match": etag}, status=304)
+    assert resp.body == ""
+
+    resp = app.get("/file/stats/bigmac/foo")
+    # the stats do not read the file
+    assert 'hash' not in simplejson.loads(resp.body)
+    stats_etag = resp.headers['ETag']
+    app.get("/file/stats/bigmac/foo",
+            headers={"If-None-Match": stats_etag}, status=304)
+
+    app.put("/file/at/bigmac/foo", "New contents")
+    resp = app.get("/file/at/bigmac/foo", headers={"If-None-Match": etag})
+    assert resp.body == "New contents"
+    assert resp.headers['ETag'] == '"%s"' % sha1("New contents").hexdigest()
+    resp = app.get("/file/stats/bigmac/foo",
+                   headers={"If-None-Match": stats_etag})
+    assert resp.headers['ETag'] != stats_etag
+
+def test_batch_fetch_on_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo", "Some contents")
+    bigmac.save_file("dir/bar", u"Unicode \u2603")
+    bigmac.save_file("binary", "\xff\xfe\x00")
+    foo_hash = sha1("Some contents").hexdigest()
+
+    resp = app.post("/file/batch/", simplejson.dumps([
+        "bigmac/foo", "MacGyver+bigmac/dir/bar", "bigmac/binary",
+        dict(path="bigmac/foo", hash=foo_hash),
+        "bigmac/missing", "SomeoneElse+otherproject/foo",
+        "nosuchproject/foo", "Nobody+bigmac/foo", "bigmac"]))
+    assert resp.content_type == "application/json"
+    data = simplejson.loads(resp.body)
+    assert len(data) == 9
+    assert data[0]['contents'] == "Some contents"
+    assert data[0]['hash'] == foo_hash
+    assert data[0]['size'] == 13
+    assert data[1]['path'] == "MacGyver+bigmac/dir/bar"
+    assert data[1]['contents'] == u"Unicode \u2603"
+    assert data[2]['encoding'] == "base64"
+    assert data[2]['contents'].decode("base64") == "\xff\xfe\x00"
+    assert 'contents' not in data[3]
+    assert data[3]['size'] == 13
+    assert data[4]['error'] == "404 Not Found"
+    assert data[5]['error'] == "401 Not Authorized"
+    assert data[6]['error'] == "404 Not Found"
+    assert data[7]['error'] == "404 Not Found"
+    assert data[8]['error'] == "400 Bad Request"
+
+    app.post("/file/batch/", "not json", status=400)
+
+    # an unexpected error is reported for its path alone, since the
+    # response has already started
+    def broken(self):
+        raise IOError("disk on fire")
+    data_property = File.data
+    File.data = property(broken)
+    try:
+        resp = app.post("/file/batch/", simplejson.dumps(["bigmac/foo"]))
+    finally:
+        File.data = data_property
+    data = simplejson.loads(resp.body)
+    assert data == [dict(path="bigmac/foo",
+        error="500 Internal Server Error", message="Internal error")]
+
+def test_paged_listing_on_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    for i in range(10):
+        bigmac.save_file("big/file%s" % i, "x" * i)
+    bigmac.save_file("big/sub/a", "12345")
+
+    resp = app.get("/file/list/bigmac/big/?limit=4")
+    data = simplejson.loads(resp.body)
+    assert [item['name'] for item in data] == \
+        ["file0", "file1", "file2", "file3"]
+    assert data[3]['size'] == 3
+    assert 'modified' in data[3]
+
+    resp = app.get("/file/list/bigmac/big/?limit=4&after=file7")
+    data = simplejson.loads(resp.body)
+    assert [item['name'] for item in data] == ["file8", "file9", "sub/"]
+    assert data[2]['size'] == 5
+    assert data[2]['files'] == 1
+
+    resp = app.get("/file/list/bigmac/big/?after=sub/")
+    assert simplejson.loads(resp.body) == []
+    # like the other listings, a bad limit is ignored
+    resp = app.get("/file/list/bigmac/big/?limit=lots")
+    assert len(simplejson.loads(resp.body)) == 11
+    # and so is one that is not positive
+    resp = app.get("/file/list/bigmac/big/?limit=-5")
+    assert len(simplejson.loads(resp.body)) == 11
+    resp = app.get("/file/list/bigmac/big/?limit=0")
+    assert len(simplejson.loads(resp.body)) == 11
+
+def test_listings_are_cached_until_the_directory_changes():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("dir/foo", "foo")
+    location = bigmac.location / "dir/"
+    os.utime(location, (1000, 1000))
+    assert [e.short_name for e in bigmac.list_directory("dir")] == ["foo"]
+    assert filesystem._listing_cache[location] == (1000, ["foo"])
+
+    bigmac.save_file("dir/bar", "bar")
+    assert [e.short_name for e in bigmac.list_directory("dir")] == \
+        ["bar", "foo"]
+
+def _setup_grep_data():
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo.js", "var x = 1;\n// TODO: fix\nvar todo = 2;\n")
+    bigmac.save_file("sub/bar.py", "import os\n\r\ndef todo():\r\n    pass")
+    bigmac.save_file("image.png", "TODO\0binary")
+    bigmac.save_file(".hg/store", "TODO in version control")
+    bigmac.save_file("empty", "")
+    return bigmac
+
+def test_content_search():
+    _init_data()
+    bigmac = _setup_grep_data()
+    result = sorted(textsearch.search(bigmac, "todo"))
+    assert result == [("foo.js", 2, "// TODO: fix"),
+                      ("foo.js", 3, "var todo = 2;"),
+                      ("sub/bar.py", 3, "def todo():")]
+
+    result = list(textsearch.search(bigmac, "TODO", ignore_case=False))
+    assert result == [("foo.js", 2, "// TODO: fix")]
+
+    result = sorted(textsearch.search(bigmac, r"^var \w+", regex=True))
+    assert [lineno for filename, lineno, line in result] == [1, 3]
+
+    assert len(list(textsearch.search(bigmac, "o", limit=2))) == 2
+    try:
+        textsearch.search(bigmac, "(", regex=True)
+        assert False, "Expected SearchError"
+    except textsearch.SearchError:
+        pass
+
+def test_content_search_with_index():
+    _init_data()
+    config.c.text_index = True
+    try:
+        bigmac = _setup_grep_data()
+        result = sorted(textsearch.search(bigmac, "todo"))
+        assert [(f, n) for f, n, line in result] == \
+            [("foo.js", 2), ("foo.js", 3), ("sub/bar.py", 3)]
+        index = textsearch.TrigramIndex(bigmac)
+        assert index.candidates("import") == ["sub/bar.py"]
+        assert index.candidates("binary") == []
+        assert index.update(["foo.js", "sub/bar.py", "image.png",
+                             "empty"]) == 0
+
+        bigmac.save_file("foo.js", "nothing to do here")
+        bigmac.delete("sub/bar.py")
+        bigmac.save_file("new.txt", "one more TODO")
+        result = list(textsearch.search(bigmac, "todo"))
+        assert result == [("new.txt", 1, "one more TODO")]
+        assert index.candidates("import") == []
+
+        # the ids of the two old files are left in the index until
+        # it is rebuilt
+        conn = bigmac.metadata.connection
+        assert conn.execute("select stale from text_index_info").fetchone() \
+            == (2,)
+        conn.execute("update text_index_info set stale=5000")
+        conn.commit()
+        filenames = [name.encode("utf-8")
+                     for name in bigmac.metadata.get_file_list()]
+        assert index.update(filenames) == 4
+        assert index.candidates("more") == ["new.txt"]
+    finally:
+        config.c.text_index = False
+
+def test_content_search_index_only_looks_at_changed_files():
+    _init_data()
+    config.c.text_index = True
+    try:
+        bigmac = _setup_grep_data()
+        assert len(list(textsearch.search(bigmac, "todo"))) == 3
+
+        statted = []
+        def counting_stat(location):
+            statted.append(os.path.basename(location))
+            return original_stat(location)
+        original_stat = os.stat
+        bigmac.save_file("foo.js", "nothing to do here")
+        bigmac.save_file("other/todo.txt", "another TODO")
+        os.stat = counting_stat
+        try:
+            result = sorted(textsearch.search(bigmac, "todo"))
+            assert result == [("other/todo.txt", 1, "another TODO"),
+                              ("sub/bar.py", 3, "def todo():")]
+            # the changed files are indexed, and the candidates read,
+            # but the other files are not looked at
+            assert set(statted) == set(["foo.js", "todo.txt", "bar.py"])
+
+            bigmac.delete("other/")
+            del statted[:]
+            assert list(textsearch.search(bigmac, "another")) == []
+            assert statted == ["todo.txt"]
+        finally:
+            os.stat = original_stat
+    finally:
+        config.c.text_index = False
+
+def test_content_search_on_the_web():
+    _init_data()
+    _setup_grep_data()
+    resp = app.get("/file/grep/bigmac?q=todo&limit=2")
+    assert resp.content_type == "application/json"
+    assert len(simplejson.loads(resp.body)) == 2
+    resp = app.get("/file/grep/bigmac?q=todo&case=1")
+    data = sorted(simplejson.loads(resp.body))
+    assert data == [["foo.js", 3, "var todo = 2;"],
+                    ["sub/bar.py", 3, "def todo():"]]
+    app.get("/file/grep/bigmac?q=(&regex=1", status=400)
+    app.get("/file/grep/bigmac", status=400)
+
+def test_symbol_extraction():
+    js = 'var count = 0;\nbespin.go = function() {\n};\n' \
+         'dojo.declare("bespin.Editor", null, {\n    paint: function() {}\n});'
+    assert symbols.extract("a.js", js) == [
+        ("count", "variable", 1), ("go", "function", 2),
+        ("bespin.Editor", "class", 4), ("paint", "function", 5)]
+    py = "LIMIT = 3\nclass Thing(object):\n    def run(self):\n        pass\n"
+    assert symbols.extract("a.py", py) == [
+        ("LIMIT", "variable", 1), ("Thing", "class", 2), ("run", "function", 3)]
+    assert symbols.extract("a.css", ".box, #main p {\n}") == [
+        ("#main", "selector", 1), (".box", "selector", 1)]
+    assert symbols.extract("README", "def foo(): pass") == []
+
+def test_symbol_index_follows_changes():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("editor.js", "function paintEditor() {}\nvar painter;")
+    bigmac.save_file("sub/draw.py", "def paint(canvas):\n    pass\n")
+    bigmac.save_file("notes.txt", "def paintNotes(): pass")
+    names = [s['name'] for s in bigmac.find_symbols("paint")]
+    assert names == ["paint", "painter", "paintEditor"]
+    assert bigmac.find_symbols("ped") == [dict(name="paintEditor",
+        kind="function", file="editor.js", line=1)]
+    assert [s['name'] for s in bigmac.find_symbols("paint", limit=1)] == \
+        ["paint"]
+
+    bigmac.save_file("editor.js", "\nfunction paintEditor() {}")
+    assert [(s['name'], s['line']) for s in bigmac.find_symbols("paint")] == \
+        [("paint", 1), ("paintEditor", 2)]
+
+    bigmac.delete("sub/")
+    assert [s['name'] for s in bigmac.find_symbols("paint")] == ["paintEditor"]
+
+    bigmac.scan_files()
+    _backdate_dirs(bigmac.location)
+    (bigmac.location / "new.py").write_bytes("class Painting:\n    pass\n")
+    bigmac.rescan()
+    assert [s['name'] for s in bigmac.find_symbols("paint")] == \
+        ["Painting", "paintEditor"]
+    assert not bigmac.metadata.symbols_pending()
+
+def test_symbol_lookup_ranks_before_limiting():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a.js", "".join("var paint%s;\n" % ("a" * n)
+                                     for n in range(30, 1, -1)))
+    bigmac.save_file("b.js", "var paint;\nvar paintz;\nvar xpaint;\n"
+                             "var pxaxixnxt;")
+    assert [s['name'] for s in bigmac.find_symbols("paint", limit=2)] == \
+        ["paint", "paintz"]
+    assert [s['name'] for s in bigmac.find_symbols("pain", limit=33)][-2:] \
+        == ["xpaint", "pxaxixnxt"]
+    assert [s['name'] for s in bigmac.find_symbols("aint", limit=1)] == \
+        ["paint"]
+
+def test_symbols_marked_during_an_update_stay_marked():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a.js", "var one;")
+    metadata = bigmac.metadata
+    c = metadata.connection.cursor()
+    metadata._mark_for_symbols(c, ["a.js"])
+    metadata.connection.commit()
+    extract = symbols.extract
+    def extract_and_mark(filename, data):
+        # the file is saved again while it is being indexed
+        (bigmac.location / "a.js").write_bytes("var two;")
+        metadata._mark_for_symbols(c, ["a.js"])
+        metadata.connection.commit()
+        return extract(filename, data)
+    symbols.extract = extract_and_mark
+    try:
+        symbols.update(metadata, bigmac.location)
+    finally:
+        symbols.extract = extract
+    assert metadata.symbols_pending()
+    symbols.update(metadata, bigmac.location)
+    assert not metadata.symbols_pending()
+    assert [s['name'] for s in bigmac.find_symbols("two")] == ["two"]
+
+def test_symbol_lookup_on_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo.js", "var a = 1;\nfunction runTests() {}")
+    resp = app.get("/file/symbols/bigmac?q=rt")
+    assert resp.content_type == "application/json"
+    assert simplejson.loads(resp.body) == [dict(name="runTests",
+        kind="function", file="foo.js", line=2)]
+    assert simplejson.loads(app.get("/file/symbols/bigmac").body) == []
+    # a query outside of ASCII does not trip over the byte string
+    assert simplejson.loads(
+        app.get("/file/symbols/bigmac?q=caf%C3%A9").body) == []
+    assert simplejson.loads(app.get("/file/symbols/bigmac?q=%FF").body) == []
+
+def test_change_log_follows_changes():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    start = bigmac.changes_since()
+    assert start['reset'] and not start['changes']
+    bigmac.save_file("a.js", "1")
+    bigmac.save_file("a.js", "12")
+    bigmac.save_file("a.js", "12")
+    bigmac.save_file("sub/b.js", "1")
+    bigmac.create_directory("empty")
+    bigmac.delete("sub/")
+    result = bigmac.changes_since(start['cursor'])
+    assert not result['reset']
+    assert result['changes'] == [("add", "a.js"), ("modify", "a.js"),
+        ("add", "sub/b.js"), ("add", "empty/"), ("delete", "sub/")]
+    assert bigmac.changes_since(result['cursor'])['changes'] == []
+    partial = bigmac.changes_since(start['cursor'], limit=2)
+    assert len(partial['changes']) == 2
+    assert len(bigmac.changes_since(partial['cursor'])['changes']) == 3
+
+    bigmac.scan_files()
+    _backdate_dirs(bigmac.location)
+    cursor = result['cursor']
+    (bigmac.location / "a.js").remove()
+    (bigmac.location / "new").makedirs()
+    (bigmac.location / "new" / "c.py").write_bytes("x")
+    bigmac.rescan()
+    result = bigmac.changes_since(cursor)
+    # the scan had not seen empty/ before, so it is added again
+    assert sorted(result['changes']) == [("add", "empty/"), ("add", "new/"),
+        ("add", "new/c.py"), ("delete", "a.js")]
+
+    # the first scan of a project starts an empty log
+    for table in ["scan_dirs", "scan_files"]:
+        bigmac.metadata.connection.execute("delete from %s" % table)
+    bigmac.rescan()
+    logged = bigmac.metadata.connection.execute(
+        "select count(*) from changes").fetchone()[0]
+    assert logged == 0
+
+    # a cursor from another project (or a recreated one) is refused
+    other = get_project(macgyver, macgyver, "other", create=True)
+    assert other.changes_since(result['cursor'])['reset']
+    assert bigmac.changes_since("junk")['reset']
+
+def test_change_log_compaction():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    old_size = filesystem.CHANGE_LOG_SIZE
+    filesystem.CHANGE_LOG_SIZE = 4
+    try:
+        start = bigmac.changes_since()['cursor']
+        bigmac.save_file("a", "1")
+        bigmac.save_file("b", "1")
+        for i in range(2, 5):
+            bigmac.save_file("a", "1" * i)
+        # the log passed 4 entries, so the older entries for "a" were
+        # dropped, and nothing else
+        result = bigmac.changes_since(start)
+        assert not result['reset']
+        assert result['changes'] == [("add", "b"), ("modify", "a")]
+        for i in range(6):
+            bigmac.save_file("f%s" % i, "1")
+        assert bigmac.changes_since(start)['reset']
+        result = bigmac.changes_since(result['cursor'])
+        assert result['reset']
+        result = bigmac.changes_since(result['cursor'])
+        assert not result['reset'] and result['changes'] == []
+    finally:
+        filesystem.CHANGE_LOG_SIZE = old_size
+
+def test_change_log_on_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    result = simplejson.loads(app.get("/file/changes/bigmac").body)
+    assert result['reset']
+    app.put("/file/at/bigmac/foo.js", "hi")
+    result = simplejson.loads(app.get("/file/changes/bigmac?" +
+        urlencode(dict(since=result['cursor']))).body)
+    assert result['changes'] == [["add", "foo.js"]]
+    assert not result['reset']
+
 def test_quota_limits_on_the_web():
     _init_data()
     old_units = filesystem.QUOTA_UNITS
@@ -704,6 +1411,63 @@ def test_quota_limits_on_the_web():
     finally:
         filesystem.QUOTA_UNITS = old_units
 
+def test_upload_without_a_length_is_empty():
+    _init_data()
+    class EndlessInput(object):
+        def read(self, size=-1):
+            raise AssertionError("read past the body")
+    def without_length(environ, start_response):
+        del environ['CONTENT_LENGTH']
+        environ['wsgi.input'] = EndlessInput()
+        return app.app(environ, start_response)
+    client = BespinTestApp(without_length)
+    client.cookies = app.cookies
+    client.put("/file/at/bigmac/foo", "ignored")
+    bigmac = get_project(macgyver, macgyver, "bigmac")
+    assert bigmac.get_file_object("foo").data == ""
+
+def test_save_file_stream():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    starting_point = macgyver.amount_used
+    contents = "0123456789" * 10000
+    bigmac.save_file_stream("sub/big.txt", StringIO(contents))
+    assert bigmac.get_file_object("sub/big.txt").data == contents
+    assert macgyver.amount_used == starting_point + 100000
+    assert bigmac.search_files("big") == ["sub/big.txt"]
+
+    bigmac.save_file_stream("sub/big.txt", StringIO("short" + contents), 5)
+    assert bigmac.get_file_object("sub/big.txt").data == "short"
+    assert macgyver.amount_used == starting_point + 5
+
+def test_failed_save_file_stream_leaves_file_alone():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo", "original")
+    starting_point = macgyver.amount_used
+
+    try:
+        bigmac.save_file_stream("foo", StringIO("truncated"), 20)
+        assert False, "Expected an exception for the truncated upload"
+    except FSException:
+        pass
+
+    old_units = filesystem.QUOTA_UNITS
+    filesystem.QUOTA_UNITS = starting_point / macgyver.quota + 1000
+    try:
+        try:
+            quota = macgyver.quota * filesystem.QUOTA_UNITS
+            bigmac.save_file_stream("foo", StringIO("x" * quota))
+            assert False, "Expected OverQuota"
+        except OverQuota:
+            pass
+    finally:
+        filesystem.QUOTA_UNITS = old_units
+
+    assert bigmac.get_file_object("foo").data == "original"
+    assert macgyver.amount_used == starting_point
+    assert bigmac.location.listdir() == [bigmac.location / "foo"]
+
 def test_search_from_the_web():
     _init_data()
     bigmac = _setup_search_data()
@@ -26,6 +26,8 @@
 # ***** END LICENSE BLOCK *****
 # 
 
+from __future__ import with_statement
+
 import os
 from cStringIO import StringIO
 import tarfile
@@ -35,9 +37,10 @@ from __init__ import BespinTestApp
 import simplejson
 from path import path
 
-from bespin import config, controllers
+from bespin import config, controllers, archive, filesystem
 
-from bespin.filesystem import get_project, FileNotFound, _find_common_base
+from bespin.filesystem import get_project, FileNotFound, FileConflict, \
+                              OverQuota, _find_common_base
 from bespin.database import User, Base
 
 tarfilename = os.path.join(os.path.dirname(__file__), "ut.tgz")
@@ -119,6 +122,138 @@ def test_customized_template_installation():
 alert("Welcome to bigmac");
 """
     
+def test_deleted_project_can_be_restored():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    starting_point = macgyver.amount_used
+    bigmac.save_file("foo/bar", "1234")
+    bigmac.delete()
+    assert "bigmac" not in [proj.name for proj in macgyver.projects]
+    assert macgyver.amount_used == starting_point
+    trash = filesystem.list_trash(macgyver)
+    assert len(trash) == 1
+    assert trash[0]['project'] == "bigmac"
+    assert trash[0]['path'] == ""
+    assert trash[0]['size'] == 4
+
+    bigmac = filesystem.restore_from_trash(macgyver, trash[0]['id'])
+    assert bigmac.get_file_object("foo/bar").data == "1234"
+    assert macgyver.amount_used == starting_point + 4
+    assert bigmac.search_files("bar") == ["foo/bar"]
+    assert filesystem.list_trash(macgyver) == []
+
+def test_deleted_directory_can_be_restored():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar/baz", "123")
+    bigmac.save_file("foo/other", "12")
+    starting_point = macgyver.amount_used
+    bigmac.delete("foo/bar/")
+    assert macgyver.amount_used == starting_point - 3
+    trash_id = filesystem.list_trash(macgyver)[0]['id']
+
+    bigmac.save_file("foo/bar/baz", "new")
+    try:
+        filesystem.restore_from_trash(macgyver, trash_id)
+        assert False, "Expected a FileConflict"
+    except FileConflict:
+        pass
+    bigmac.delete("foo/bar/")
+
+    bigmac = filesystem.restore_from_trash(macgyver, trash_id)
+    assert bigmac.get_file_object("foo/bar/baz").data == "123"
+    assert macgyver.amount_used == starting_point
+    assert bigmac.metadata.dir_totals("foo/") == (5, 2)
+
+def test_trash_is_purged_after_a_while():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar/baz", "123")
+    bigmac.save_file("foo/other", "12")
+    bigmac.delete("foo/")
+    trash = macgyver.get_location() / filesystem.TRASH_DIR
+    assert len(trash.dirs()) == 1
+
+    old_settings = (config.c.trash_keep_seconds, config.c.purge_batch_size)
+    config.c.trash_keep_seconds = 0
+    config.c.purge_batch_size = 1
+    try:
+        filesystem._purge_trash(trash)
+    finally:
+        config.c.trash_keep_seconds, config.c.purge_batch_size = old_settings
+    assert trash.dirs() == []
+    assert filesystem.list_trash(macgyver) == []
+
+def test_trash_purge_without_a_queue_does_not_pause():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar/baz", "123")
+    bigmac.save_file("foo/other", "12")
+    trash = macgyver.get_location() / filesystem.TRASH_DIR
+
+    old_settings = (config.c.trash_keep_seconds, config.c.purge_batch_size)
+    config.c.trash_keep_seconds = 0
+    config.c.purge_batch_size = 1
+    sleep = filesystem.time.sleep
+    def no_sleeping(seconds):
+        assert False, "The purge paused in the request"
+    filesystem.time.sleep = no_sleeping
+    try:
+        bigmac.delete("foo/")
+    finally:
+        filesystem.time.sleep = sleep
+        config.c.trash_keep_seconds, config.c.purge_batch_size = old_settings
+    assert trash.dirs() == []
+
+def test_trash_purge_has_a_queue_of_its_own():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "123")
+    queued = []
+    class FakeQueue(object):
+        def enqueue(self, name, message, execute, error_handler, use_db,
+                    delay=0):
+            queued.append((name, execute))
+    config.c.queue = FakeQueue()
+    try:
+        bigmac.delete("foo/")
+    finally:
+        config.c.queue = None
+    assert queued == [(filesystem.TRASH_QUEUE,
+                       "bespin.filesystem:purge_trash")]
+
+def test_templates_are_compiled_once():
+    _init_data()
+    source = config.c.fsroot / "templates" / "cached"
+    (source / "sub").makedirs()
+    (source / "static.txt").write_bytes("Nothing to see here")
+    (source / "sub" / "{project}.js").write_bytes("// {project} by {username}\n")
+    config.c.template_path.append(source.dirname())
+    try:
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        starting_point = macgyver.amount_used
+        bigmac.install_template("cached")
+        files = filesystem._template_cache[source][1]
+        bodies = sorted(type(body).__name__ for d, f, n, body in files)
+        assert bodies == ["Template", "str"]
+        assert bigmac.get_file_object("sub/bigmac.js").data == \
+            "// bigmac by MacGyver\n"
+        assert macgyver.amount_used == starting_point + 19 + 22
+        assert bigmac.search_files("static") == ["static.txt"]
+
+        other = get_project(macgyver, macgyver, "other", create=True)
+        other.install_template("cached")
+        assert filesystem._template_cache[source][1] is files
+        assert other.get_file_object("sub/other.js").data == \
+            "// other by MacGyver\n"
+
+        (source / "static.txt").write_bytes("Something new")
+        other.install_template("cached")
+        assert filesystem._template_cache[source][1] is not files
+        assert other.get_file_object("static.txt").data == "Something new"
+    finally:
+        config.c.template_path.remove(source.dirname())
+
 def test_common_base_selection():
     tests = [
         (["foo.js", "bar.js"], ""),
@@ -185,6 +320,92 @@ def test_reimport_wipes_out_the_project():
     for test in tests:
         yield run_one, test[0], test[1]
         
+def _make_zipfile(files):
+    data = StringIO()
+    zfile = zipfile.ZipFile(data, "w")
+    for name, contents in files:
+        zfile.writestr(name, contents)
+    zfile.close()
+    data.seek(0)
+    return data
+
+def test_import_updates_metadata_and_amount_used():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a.js", "old contents")
+    starting_point = macgyver.amount_used
+    big = "x" * (archive.CHUNK_SIZE * 2 + 3)
+    data = _make_zipfile([("top/a.js", "new"), ("top/b/c.js", big)])
+    bigmac.import_zipfile("top.zip", data)
+    assert bigmac.get_file_object("b/c.js").data == big
+    assert bigmac.get_file_object("a.js").data == "new"
+    assert macgyver.amount_used == starting_point + len(big) + 3 - 12
+    assert bigmac.search_files("c.js") == ["b/c.js"]
+    assert bigmac.scan_files() == len(big) + 3
+
+def test_zip_import_closes_members_and_works_without_zipfile_open():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    opened = []
+    original = zipfile.ZipFile
+    class TrackingZipFile(original):
+        def open(self, *args):
+            handle = original.open(self, *args)
+            opened.append(handle)
+            return handle
+    class OldZipFile(original):
+        # like Python 2.5's, which has no open
+        @property
+        def open(self):
+            raise AttributeError("open")
+        def read(self, name):
+            handle = original.open(self, name)
+            try:
+                return handle.read()
+            finally:
+                handle.close()
+    data = _make_zipfile([("top/a.js", "one"), ("top/b.js", "two")])
+    other = _make_zipfile([("top/c.js", "three")])
+    try:
+        filesystem.zipfile.ZipFile = TrackingZipFile
+        bigmac.import_zipfile("top.zip", data)
+        filesystem.zipfile.ZipFile = OldZipFile
+        bigmac.import_zipfile("other.zip", other)
+    finally:
+        filesystem.zipfile.ZipFile = original
+    assert len(opened) == 2
+    assert [handle.closed for handle in opened] == [True, True]
+    assert bigmac.get_file_object("b.js").data == "two"
+    assert bigmac.get_file_object("c.js").data == "three"
+
+def test_import_checks_quota_for_the_whole_archive():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    starting_point = macgyver.amount_used
+    old_units = filesystem.QUOTA_UNITS
+    filesystem.QUOTA_UNITS = 1
+    macgyver.quota = starting_point + 10
+    data = _make_zipfile([("top/a", "x" * 6), ("top/b", "y" * 6)])
+    try:
+        bigmac.import_zipfile("top.zip", data)
+        assert False, "Expected an OverQuota exception"
+    except OverQuota:
+        pass
+    finally:
+        filesystem.QUOTA_UNITS = old_units
+    assert not bigmac.list_files()
+    assert macgyver.amount_used == starting_point
+
+def test_clean_project_gives_back_its_space():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    starting_point = macgyver.amount_used
+    bigmac.save_file("foo/bar", "1234")
+    bigmac = get_project(macgyver, macgyver, "bigmac", clean=True)
+    assert macgyver.amount_used == starting_point
+    assert not bigmac.list_files()
+    assert bigmac.search_files("bar") == []
+
 def test_export_tarfile():
     _init_data()
     handle = open(tarfilename)
@@ -214,6 +435,41 @@ def test_export_zipfile():
     assert 'bigmac/commands/yourcommands.js' in names
 
 
+def test_export_streams():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    big = "".join(chr(i % 251) for i in range(archive.CHUNK_SIZE * 3 + 7))
+    bigmac.save_file("foo/big.bin", big)
+    bigmac.save_file("foo/bar", "INFO!")
+    bigmac.save_file("empty", "")
+
+    stream = bigmac.export_tarball_stream()
+    tfile = tarfile.open("bigmac.tgz", "r:gz", StringIO("".join(stream)))
+    assert tfile.extractfile("bigmac/foo/big.bin").read() == big
+    assert tfile.extractfile("bigmac/foo/bar").read() == "INFO!"
+    assert tfile.getmember("bigmac/foo").isdir()
+
+    stream = bigmac.export_zipfile_stream()
+    zfile = zipfile.ZipFile(StringIO("".join(stream)))
+    assert zfile.testzip() is None
+    assert zfile.read("bigmac/foo/big.bin") == big
+    assert zfile.read("bigmac/empty") == ""
+
+def test_export_zip64_stream():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("a", "A" * 100)
+    bigmac.save_file("b", "B" * 5)
+    old_limit = archive.ZIP64_LIMIT
+    archive.ZIP64_LIMIT = 50
+    try:
+        data = "".join(bigmac.export_zipfile_stream())
+    finally:
+        archive.ZIP64_LIMIT = old_limit
+    zfile = zipfile.ZipFile(StringIO(data))
+    assert zfile.read("bigmac/a") == "A" * 100
+    assert zfile.read("bigmac/b") == "B" * 5
+
 # -------
 # Web tests
 # -------
@@ -286,6 +542,21 @@ def test_delete_project_from_the_web():
     resp = app.delete("/file/at/bigmac/")
     assert len(macgyver.projects) == 2
     
+def test_restore_project_from_the_web():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("README.txt", "This is the readme file.")
+    app.delete("/file/at/bigmac/")
+    resp = app.get("/project/trash/")
+    data = simplejson.loads(resp.body)
+    assert len(data) == 1
+    assert data[0]['project'] == "bigmac"
+    app.post("/project/trash/restore/" + data[0]['id'])
+    resp = app.get("/file/at/bigmac/README.txt")
+    assert resp.body == "This is the readme file."
+    app.post("/project/trash/restore/" + data[0]['id'], status=404)
+    app.post("/project/trash/restore/..", status=400)
+
 def test_rename_project():
     _init_data()
     app.post("/project/rename/bigmac/", "foobar", status=404)
@@ -352,4 +623,56 @@ def test_basic_project_metadata_use():
         assert False, "expected key to be gone from DB"
     except KeyError:
         pass
-    
\ No newline at end of file
+    
+
+def test_metadata_connections_are_pooled():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    metadata = bigmac.metadata
+    metadata['hello'] = "world"
+    conn = metadata.connection
+    metadata.close()
+
+    bigmac = get_project(macgyver, macgyver, "bigmac")
+    assert bigmac.metadata.connection is conn
+    assert bigmac.metadata['hello'] == "world"
+    # while it is in use, another connection is opened
+    other = get_project(macgyver, macgyver, "bigmac")
+    assert other.metadata.connection is not conn
+
+def test_metadata_pool_closes_least_recently_used():
+    _init_data()
+    old_size = config.c.metadata_pool_size
+    config.c.metadata_pool_size = 1
+    try:
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        foo = get_project(macgyver, macgyver, "foo", create=True)
+        bigmac_conn = bigmac.metadata.connection
+        foo_conn = foo.metadata.connection
+        bigmac.metadata.close()
+        foo.metadata.close()
+    finally:
+        config.c.metadata_pool_size = old_size
+    bigmac = get_project(macgyver, macgyver, "bigmac")
+    assert bigmac.metadata.connection is not bigmac_conn
+    foo = get_project(macgyver, macgyver, "foo")
+    assert foo.metadata.connection is foo_conn
+
+def test_metadata_batch_is_one_transaction():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    metadata = bigmac.metadata
+    with metadata.batch():
+        metadata['first'] = "1"
+        metadata['second'] = "2"
+        assert get_project(macgyver, macgyver,
+                           "bigmac").metadata.get('first') is None
+    assert get_project(macgyver, macgyver, "bigmac").metadata['second'] == "2"
+
+    try:
+        with metadata.batch():
+            metadata['first'] = "changed"
+            raise ValueError()
+    except ValueError:
+        pass
+    assert metadata['first'] == "1"
@@ -0,0 +1,116 @@
+import gzip
+
+from bespin import config, controllers
+
+from bespin.tests import BespinTestApp
+
+def setup_module(module):
+    config.set_profile("test")
+    config.activate_profile()
+
+def teardown_module(module):
+    config.c.static_override = None
+
+def _make_app():
+    fsroot = config.c.fsroot
+    if fsroot.exists() and fsroot.basename() == "testfiles":
+        fsroot.rmtree()
+    static_dir = fsroot / "static"
+    static_dir.makedirs()
+    (static_dir / "app.js").write_bytes("var answer = 42;\n")
+    gzfile = gzip.open(static_dir / "app.js.gz", "wb")
+    gzfile.write("var answer = 42;\n")
+    gzfile.close()
+    (static_dir / "app.0f3c9a12.js").write_bytes("var answer = 42;\n")
+    config.c.static_override = static_dir
+    return BespinTestApp(controllers.make_app())
+
+def test_static_files_with_etags():
+    app = _make_app()
+    resp = app.get("/app.js")
+    assert resp.body == "var answer = 42;\n"
+    assert resp.headers['Content-Length'] == str(len(resp.body))
+    assert resp.headers['Vary'] == "Accept-Encoding"
+    assert 'Content-Encoding' not in resp.headers
+    assert 'Cache-Control' not in resp.headers
+    etag = resp.headers['ETag']
+    assert etag.startswith('"') and etag.endswith('"')
+
+    resp = app.get("/app.js", headers={'If-None-Match': etag}, status=304)
+    resp = app.get("/app.js", headers={'If-None-Match': '"other", W/' + etag},
+                   status=304)
+    resp = app.get("/app.js", headers={'If-None-Match': '"other"'})
+    assert resp.body == "var answer = 42;\n"
+
+def test_static_files_are_gzipped():
+    app = _make_app()
+    plain = app.get("/app.js")
+    resp = app.get("/app.js", headers={'Accept-Encoding': 'deflate, gzip'})
+    assert resp.headers['Content-Encoding'] == "gzip"
+    assert resp.headers['Content-Type'] == plain.headers['Content-Type']
+    assert resp.body.startswith("\x1f\x8b")
+    assert resp.headers['ETag'] != plain.headers['ETag']
+
+    resp = app.get("/app.js", headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in resp.headers
+
+def test_fingerprinted_static_files_are_immutable():
+    app = _make_app()
+    resp = app.get("/app.0f3c9a12.js")
+    assert "immutable" in resp.headers['Cache-Control']
+    assert "max-age=31536000" in resp.headers['Cache-Control']
+
+def test_static_files_do_not_shadow_handlers():
+    app = _make_app()
+    resp = app.get("/editor.html", status=302)
+    resp = app.get("/nothere.js", status=404)
+
+def test_scripts_are_wrapped_into_modules():
+    app = _make_app()
+    resp = app.get("/getscript/app.js",
+                   headers={'Accept-Encoding': 'gzip'})
+    assert 'moduleLoaded("/getscript/app.js"' in resp.body
+    assert "var answer = 42;" in resp.body
+    assert resp.headers['Content-Length'] == str(len(resp.body))
+    etag = resp.headers['ETag']
+    assert etag.endswith('-module"')
+    assert "/app.js" in controllers._script_cache
+
+    resp = app.get("/getscript/app.js", headers={'If-None-Match': etag},
+                   status=304)
+    cached = controllers._script_cache["/app.js"]
+    resp = app.get("/getscript/app.js")
+    assert controllers._script_cache["/app.js"] is cached
+
+    script = config.c.static_override / "app.js"
+    script.write_bytes("var answer = 43;\n")
+    script.utime((script.mtime + 10, script.mtime + 10))
+    resp = app.get("/getscript/app.js")
+    assert "var answer = 43;" in resp.body
+    assert resp.headers['ETag'] != etag
+
+def test_wrapped_scripts_do_not_share_request_headers():
+    controllers._script_cache.clear()
+    requests = []
+    def script_app(environ, start_response):
+        requests.append(environ['PATH_INFO'])
+        headers = [('Set-Cookie', 'user=%s' % len(requests)),
+                   ('ETag', '"abc"'), ('Content-Type', 'text/javascript')]
+        if environ.get('HTTP_IF_NONE_MATCH') == '"abc"':
+            start_response("304 Not Modified", headers)
+            return [""]
+        start_response("200 OK", headers)
+        return ["var x;"]
+    app = BespinTestApp(controllers.scriptwrapper_middleware(script_app))
+    resp = app.get("/getscript/x.js")
+    assert resp.headers['Set-Cookie'] == "user=1"
+    resp = app.get("/getscript/x.js")
+    assert resp.headers['Set-Cookie'] == "user=2"
+    assert resp.headers['Content-Type'] == "text/javascript"
+    assert "var x;" in resp.body
+    assert requests == ["/x.js", "/x.js"]
+
+    resp = app.get("/getscript/x.js",
+                   extra_environ=dict(REQUEST_METHOD="HEAD"))
+    assert resp.body == ""
+    assert int(resp.headers['Content-Length']) > len("var x;")
@@ -26,9 +26,11 @@
 # ***** END LICENSE BLOCK *****
 # 
 
+from __future__ import with_statement
+
 import simplejson
 
-from bespin import config, controllers, auth
+from bespin import config, controllers, auth, database
 from bespin.database import User, Base, ConflictError
 from bespin.filesystem import get_project
 
@@ -85,7 +87,82 @@ def test_get_user_returns_none_for_nonexistent():
     s = _get_session(True)
     user = User.find_user("NOT THERE. NO REALLY!")
     assert user is None
-    
+
+def test_users_are_cached_until_changed():
+    s = _get_session(True)
+    User.create_user("BillBixby", "hulkrulez", "bill@bixby.com")
+    User.create_user("Aldus", "foo", "a@b.com")
+    s.commit()
+    config.c.session_factory.remove()
+    user = User.find_user("BillBixby")
+    assert "BillBixby" in database._user_cache
+    config.c.session_factory.remove()
+
+    s = _get_session()
+    with patch("sqlalchemy.orm.Query.__iter__") as iterate:
+        user = User.find_user("BillBixby", "hulkrulez")
+        assert not iterate.called
+    assert user in s
+    assert user is User.find_user("BillBixby")
+    # each session gets its own settings
+    user.settings['tabsize'] = "4"
+    assert user.settings != dict(database._user_cache["BillBixby"][1]) \
+        ['settings']
+
+    user.settings = user.settings
+    user.amount_used = 42
+    s.commit()
+    assert "BillBixby" not in database._user_cache
+    config.c.session_factory.remove()
+    user = User.find_user("BillBixby")
+    assert user.settings == dict(tabsize="4")
+    assert user.amount_used == 42
+
+    found = User.find_users(["BillBixby", "Aldus", "Nobody"])
+    assert sorted(found.keys()) == ["Aldus", "BillBixby"]
+    assert found["Aldus"].email == "a@b.com"
+    assert "Aldus" in database._user_cache
+
+def test_uncommitted_changes_are_not_cached():
+    s = _get_session(True)
+    User.create_user("BillBixby", "hulkrulez", "bill@bixby.com")
+    s.commit()
+    config.c.session_factory.remove()
+
+    s = _get_session()
+    user = User.find_user("BillBixby")
+    user.email = "hulk@bixby.com"
+    s.flush()
+    config.c.session_factory().expunge(user)
+    assert User.find_user("BillBixby").email == "hulk@bixby.com"
+    assert "BillBixby" not in database._user_cache
+    s.rollback()
+    config.c.session_factory.remove()
+    assert User.find_user("BillBixby").email == "bill@bixby.com"
+
+def test_cached_users_do_not_overwrite_amount_used():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post('/register/new/BillBixby', dict(password="foo",
+                                                    email="a@b.com"))
+    config.c.session_factory.remove()
+    User.find_user("BillBixby")
+    assert "BillBixby" in database._user_cache
+    config.c.session_factory.remove()
+
+    # a queue worker changes amount_used behind the cache
+    s = _get_session()
+    s.execute("update users set amount_used = 1000 "
+              "where username = 'BillBixby'")
+    s.commit()
+    config.c.session_factory.remove()
+
+    resp = app.put("/file/at/SampleProject/new.txt", "123456")
+    config.c.session_factory.remove()
+    user = User.find_user("BillBixby")
+    assert user.amount_used == 1006
+
 
 # Controller Tests
 
@@ -168,6 +245,62 @@ def test_static_files_with_auth():
                                                 email="a@b.com"))
     resp = app.get('/editor.html')
 
+def test_editor_page_is_rendered_once():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post('/register/new/Aldus', dict(password="foo",
+                                                email="a@b.com"))
+    resp = app.get('/editor.html')
+    etag = resp.headers['ETag']
+    rendered = controllers._editor_page
+    assert rendered[1] == resp.body
+    resp = app.get('/editor.html', headers={'If-None-Match': etag},
+                   status=304)
+    assert controllers._editor_page is rendered
+
+    app.reset()
+    resp = app.get('/editor.html', headers={'If-None-Match': etag},
+                   status=302)
+
+    old_value = config.c.using_dojo_source
+    config.c.using_dojo_source = not old_value
+    try:
+        resp = app.post('/register/login/Aldus', dict(password="foo"))
+        resp = app.get('/editor.html')
+        assert controllers._editor_page is not rendered
+        # the setting changes the page, which names the dojo build
+        source = (config.c.static_dir / "editor.html").bytes()
+        assert "dojo.js.uncompressed.js" in source
+        assert resp.body != rendered[1]
+        assert resp.headers['ETag'] != etag
+    finally:
+        config.c.using_dojo_source = old_value
+
+def test_static_files_leave_the_database_alone():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post('/register/new/Aldus', dict(password="foo",
+                                                email="a@b.com"))
+    config.c.session_factory.remove()
+    resp = app.get('/favicon.ico')
+    assert not config.c.session_factory.registry.has()
+
+    # a request that only reads is still seen to have used its session
+    s = _get_session()
+    assert not getattr(s, 'bespin_used', False)
+    resp = app.get('/register/userinfo/')
+    assert s.bespin_used is False
+    s.query(User).count()
+    assert s.bespin_used
+
+    # the handlers still get their work committed
+    resp = app.post('/register/new/Bixby', dict(password="foo",
+                                                email="b@b.com"))
+    config.c.session_factory.remove()
+    assert User.find_user("Bixby") is not None
+
 def test_register_existing_user_should_not_authenticate():
     s = _get_session(True)
     app_orig = controllers.make_app()
@@ -0,0 +1,402 @@
+#  ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# ***** END LICENSE BLOCK *****
+#
+
+"""Searching the contents of a project's files ("find in files").
+
+The files in the project's file list (which leaves out version
+control directories) are read by config.c.text_search_workers
+threads, and matching lines are produced as they are found. Binary
+files, recognized by a NUL byte near the start, are skipped.
+
+When config.c.text_index is on, a trigram index of the file contents
+is kept in the project metadata. It is brought up to date before each
+search from the project's change log, by reindexing the files that
+were added or changed since the last search, and a search for a
+literal string of three or more characters only reads the files that
+have all of the string's trigrams."""
+from __future__ import with_statement
+
+import os
+import re
+import Queue
+import threading
+import logging
+from array import array
+
+from bespin import config
+
+log = logging.getLogger("bespin.textsearch")
+
+# files are checked for NUL bytes this far in to see if they're binary
+BINARY_CHECK_SIZE = 8192
+
+# larger files are not searched
+MAX_FILE_SIZE = 10000000
+
+# matching lines are cut off at this many characters
+MAX_LINE_LENGTH = 300
+
+class SearchError(Exception):
+    pass
+
+def search(project, query, regex=False, ignore_case=True, limit=500):
+    """Searches the files of project for query (a regular expression,
+    if regex is True). Returns an iterator of (filename, line number,
+    line) for the first limit matching lines, which reads the files
+    as it goes. Raises SearchError for a bad regular expression."""
+    if isinstance(query, unicode):
+        query = query.encode("utf-8")
+    if not regex:
+        pattern = re.escape(query)
+    else:
+        pattern = query
+    flags = re.MULTILINE
+    if ignore_case:
+        flags |= re.IGNORECASE
+    try:
+        pattern = re.compile(pattern, flags)
+    except re.error, e:
+        raise SearchError("Invalid regular expression: %s" % e)
+
+    filenames = [name.encode("utf-8")
+                 for name in project.metadata.get_file_list()]
+    if config.c.text_index:
+        index = TrigramIndex(project)
+        index.refresh()
+        if not regex and len(query) >= 3:
+            filenames = index.candidates(query)
+    filenames.sort()
+    return _scan(project.location, filenames, pattern, limit,
+                 config.c.text_search_workers)
+
+def _is_binary(data):
+    return "\0" in data[:BINARY_CHECK_SIZE]
+
+def _read_text(location):
+    """Returns the contents of the file at location, or None for
+    binary files and files that are too large to search."""
+    if os.path.getsize(location) > MAX_FILE_SIZE:
+        return None
+    f = open(location, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if _is_binary(data):
+        return None
+    return data
+
+def _search_file(location, pattern):
+    """Returns a list of (line number, line) for the lines of the
+    file at location that match pattern."""
+    data = _read_text(location)
+    if data is None:
+        return []
+    result = []
+    lineno = 1
+    counted = 0
+    next_line = 0
+    for match in pattern.finditer(data):
+        start = match.start()
+        if start < next_line:
+            # another match on a line that's already in the results
+            continue
+        lineno += data.count("\n", counted, start)
+        counted = start
+        line_start = data.rfind("\n", 0, start) + 1
+        line_end = data.find("\n", start)
+        if line_end == -1:
+            line_end = len(data)
+        line = data[line_start:line_end].rstrip("\r")[:MAX_LINE_LENGTH]
+        result.append((lineno, line.decode("utf-8", "replace")))
+        next_line = line_end + 1
+    return result
+
+def _scan(location, filenames, pattern, limit, workers):
+    """Generates the matches in filenames (relative to location),
+    which are read by a number of worker threads. The threads stop
+    when the limit is reached or the generator is closed."""
+    todo = Queue.Queue()
+    for filename in filenames:
+        todo.put(filename)
+    found = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        try:
+            while not stop.isSet():
+                try:
+                    filename = todo.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    matches = _search_file(os.path.join(location, filename),
+                                           pattern)
+                except (IOError, OSError), e:
+                    # removed since the file list was made
+                    log.debug("Skipping %s: %s", filename, e)
+                    continue
+                if matches:
+                    found.put((filename, matches))
+        finally:
+            found.put(None)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(workers, len(filenames))))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    try:
+        running = len(threads)
+        count = 0
+        while running:
+            item = found.get()
+            if item is None:
+                running -= 1
+                continue
+            filename, matches = item
+            filename = filename.decode("utf-8")
+            for lineno, line in matches:
+                yield filename, lineno, line
+                count += 1
+                if limit and count >= limit:
+                    return
+    finally:
+        stop.set()
+
+def _trigrams(data):
+    """Returns the set of trigrams (3 byte strings) in data, ignoring
+    ASCII case."""
+    data = data.lower()
+    return set(data[i:i+3] for i in xrange(len(data) - 2))
+
+def _unpack(blob):
+    ids = array("i")
+    ids.fromstring(str(blob))
+    return ids
+
+class TrigramIndex(object):
+    """The trigram index of a project's file contents, kept in the
+    project metadata database. text_index_files records the size and
+    mtime each file had when it was indexed. text_index holds, for
+    each trigram, the packed array of the ids of the files that
+    contain it.
+
+    When a file changes or goes away, its text_index_files row is
+    removed and the file is indexed again under a new id. The old id
+    is left in the arrays, where it matches no file, until there are
+    more of those than there are files and the index is rebuilt.
+    text_index_info also holds the change log cursor (see
+    ProjectMetadata.changes_since) that the index is up to date
+    with."""
+
+    def __init__(self, project):
+        self.location = project.location
+        self.metadata = project.metadata
+        conn = self.metadata.connection
+        conn.execute("""create table if not exists text_index_files (
+    file_id integer primary key autoincrement,
+    filename text unique,
+    size integer,
+    mtime real
+)""")
+        conn.execute("""create table if not exists text_index (
+    trigram blob primary key,
+    files blob
+)""")
+        conn.execute("""create table if not exists text_index_info (
+    stale integer,
+    cursor text
+)""")
+        columns = [row[1] for row in
+                   conn.execute("pragma table_info(text_index_info)")]
+        if "cursor" not in columns:
+            conn.execute("alter table text_index_info add column cursor text")
+        if conn.execute("select 1 from text_index_info").fetchone() is None:
+            conn.execute("insert into text_index_info values (0, null)")
+        conn.commit()
+
+    def refresh(self):
+        """Reindexes the files that the change log of the project
+        metadata shows were added, changed or deleted since the last
+        refresh, without looking at the other files. Files changed
+        outside of Bespin are picked up once a rescan logs them. If
+        the changes are not known (the first time, or after the file
+        list was rebuilt), or the index is due to be rebuilt, every
+        file is checked with update. Returns the number of files
+        indexed."""
+        c = self.metadata.connection.cursor()
+        cursor, stale = c.execute(
+            "select cursor, stale from text_index_info").fetchone()
+        total = c.execute("select count(*) from text_index_files").fetchone()[0]
+        changes = self.metadata.changes_since(cursor)
+        with self.metadata.batch():
+            if changes["reset"] or stale > max(total, 1000):
+                count = self.update([name.encode("utf-8") for name
+                                     in self.metadata.get_file_list()])
+            else:
+                count = self._apply_changes(c, changes["changes"])
+            c.execute("update text_index_info set cursor=?",
+                      (changes["cursor"],))
+        c.close()
+        return count
+
+    def _apply_changes(self, c, changes):
+        """Reindexes the files named in changes, a list of (action,
+        path) from the change log, and the indexed files under the
+        directories that were deleted. The files are looked at as
+        they are now, so the order of the changes does not matter."""
+        filenames = set()
+        for action, path in changes:
+            if not path.endswith("/"):
+                filenames.add(path)
+            elif action == "delete":
+                filenames.update(row[0] for row in c.execute(
+                    """select filename from text_index_files
+                    where substr(filename, 1, ?)=?""", (len(path), path)))
+
+        stale = 0
+        files = []
+        for filename in filenames:
+            row = c.execute("""select file_id from text_index_files
+                where filename=?""", (filename,)).fetchone()
+            if row is not None:
+                c.execute("delete from text_index_files where file_id=?",
+                          (row[0],))
+                stale += 1
+            filename = filename.encode("utf-8")
+            try:
+                stat = os.stat(os.path.join(self.location, filename))
+            except OSError:
+                continue
+            files.append((filename, stat))
+        c.execute("update text_index_info set stale=stale+?", (stale,))
+        return self._index_files(c, files)
+
+    def update(self, filenames):
+        """Indexes the files in filenames (utf-8 encoded, relative
+        to the project) that changed since they were indexed, and
+        drops the files that are not in filenames. Returns the
+        number of files indexed."""
+        c = self.metadata.connection.cursor()
+        indexed = {}
+        for file_id, filename, size, mtime in c.execute(
+                "select file_id, filename, size, mtime from text_index_files"):
+            indexed[filename.encode("utf-8")] = (file_id, size, mtime)
+        row = c.execute("select stale from text_index_info").fetchone()
+        if row[0] > max(len(indexed), 1000):
+            c.execute("delete from text_index_files")
+            c.execute("delete from text_index")
+            c.execute("update text_index_info set stale=0")
+            indexed = {}
+
+        stale = 0
+        files = []
+        with self.metadata.batch():
+            for filename in filenames:
+                old = indexed.pop(filename, None)
+                try:
+                    stat = os.stat(os.path.join(self.location, filename))
+                except OSError:
+                    continue
+                if old is not None:
+                    if old[1:] == (stat.st_size, stat.st_mtime):
+                        continue
+                    c.execute("delete from text_index_files where file_id=?",
+                              (old[0],))
+                    stale += 1
+                files.append((filename, stat))
+
+            c.executemany("delete from text_index_files where file_id=?",
+                          [(old[0],) for old in indexed.values()])
+            stale += len(indexed)
+            c.execute("update text_index_info set stale=stale+?", (stale,))
+            count = self._index_files(c, files)
+        c.close()
+        return count
+
+    def _index_files(self, c, files):
+        """Reads and indexes files, a list of (utf-8 encoded filename,
+        stat), which must not be in text_index_files. Returns the
+        number of files indexed."""
+        postings = {}
+        count = 0
+        with self.metadata.batch():
+            for filename, stat in files:
+                try:
+                    data = _read_text(os.path.join(self.location, filename))
+                except (IOError, OSError):
+                    continue
+                c.execute("insert into text_index_files values (null, ?, ?, ?)",
+                          (filename.decode("utf-8"), stat.st_size,
+                           stat.st_mtime))
+                file_id = c.lastrowid
+                if data is not None:
+                    for gram in _trigrams(data):
+                        try:
+                            postings[gram].append(file_id)
+                        except KeyError:
+                            postings[gram] = array("i", [file_id])
+                count += 1
+
+            for gram, ids in postings.iteritems():
+                key = buffer(gram)
+                row = c.execute("select files from text_index where trigram=?",
+                                (key,)).fetchone()
+                if row is None:
+                    c.execute("insert into text_index values (?, ?)",
+                              (key, buffer(ids.tostring())))
+                else:
+                    old_ids = _unpack(row[0])
+                    old_ids.extend(ids)
+                    c.execute("update text_index set files=? where trigram=?",
+                              (buffer(old_ids.tostring()), key))
+        return count
+
+    def candidates(self, query):
+        """Returns the (utf-8 encoded) filenames of the files that
+        contain all of the trigrams in query, which must be at least
+        3 bytes long."""
+        c = self.metadata.connection.cursor()
+        ids = None
+        for gram in _trigrams(query):
+            row = c.execute("select files from text_index where trigram=?",
+                            (buffer(gram),)).fetchone()
+            if row is None:
+                ids = set()
+                break
+            if ids is None:
+                ids = set(_unpack(row[0]))
+            else:
+                ids.intersection_update(_unpack(row[0]))
+            if not ids:
+                break
+        result = []
+        if ids:
+            for file_id, filename in c.execute(
+                    "select file_id, filename from text_index_files"):
+                if file_id in ids:
+                    result.append(filename.encode("utf-8"))
+        c.close()
+        return result
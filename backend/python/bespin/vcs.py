@@ -30,6 +30,8 @@ from here:
 
 http://www.codekoala.com/blog/2009/mar/16/aes-encryption-python-using-pycrypto/
 """
+from __future__ import with_statement
+
 import os
 import tempfile
 import random
@@ -233,13 +235,14 @@ def _clone_impl(user, source, qid, dest=None, push=None, remoteauth="write",
                 password)
     
     metadata = project.metadata
-    metadata['remote_url'] = source
+    with metadata.batch():
+        metadata['remote_url'] = source
 
-    if push:
-        metadata['push'] = push
-        
-    if vcsuser:
-        metadata['vcsuser'] = vcsuser
+        if push:
+            metadata['push'] = push
+
+        if vcsuser:
+            metadata['vcsuser'] = vcsuser
     
     space_used = project.scan_files()
     user.amount_used += space_used
@@ -352,6 +355,10 @@ def _run_command_impl(user, project, args, kcpass):
         if output.return_code:
             return dict(command=command_name, success=False,
                 output=output_file.getvalue())
+
+        # pick up the files the command changed, so that they show up
+        # in the file list, the change log and the space used
+        project.rescan()
     finally:        
         metadata.close()
     
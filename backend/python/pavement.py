@@ -49,6 +49,7 @@ options(
         entry_points="""
 [console_scripts]
 bespin_worker=bespin.queue:process_queue
+bespin_blob_gc=bespin.blobstore:command
 queue_stats=bespin.queuewatch:command
 telnet_mobwrite=bespin.mobwrite.mobwrite_daemon:process_mobwrite
 bespin_mobwrite=bespin.mobwrite.mobwrite_web:start_server
@@ -726,6 +726,16 @@ def test():
     from os import system
     system("nosetests backend/python/bespin")
 
+@task
+@cmdopts([('name=', 'n', 'Comma separated benchmarks to run (default: all)')])
+def bench(options):
+    """Run the backend benchmarks on synthetic projects."""
+    from bespin import benchmarks
+    names = None
+    if 'bench' in options:
+        names = options.bench.get('name')
+    benchmarks.run(names)
+
 @task
 def mobwrite():
     from bespin.mobwrite import mobwrite_daemon